@@ -0,0 +1,159 @@
+"""
+Asynchronous actor-learner training: actor processes step CityFlowEnv with the max vehicle count rule
+or a NumPy copy of the Q network, the learner (the training process) fits the Keras model on their transitions
+"""
+
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory, resource_tracker
+import queue
+import numpy as np
+from numpy_policy import mlp_forward
+from replay_buffer import NStepAccumulator
+
+class SharedWeights(object):
+    '''
+    the learner's weights as one flat float32 array in shared memory, plus a version counter and
+    the exploration rate. the learner publish()es, actors pull() when the version changed
+    '''
+    def __init__(self, shapes, ctx=None):
+        ctx = ctx or mp
+        resource_tracker.ensure_running()
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self._lock = ctx.Lock()
+        self._version = ctx.Value('q', -1, lock=False)
+        self._epsilon = ctx.Value('d', 1.0, lock=False)
+        self._shm = shared_memory.SharedMemory(create=True, size=sum(self.sizes) * 4)
+        self._owner = os.getpid() # only the creating process unlinks, also under fork
+        self._attach()
+
+    def _attach(self):
+        self._flat = np.ndarray(sum(self.sizes), dtype=np.float32, buffer=self._shm.buf)
+
+    def __getstate__(self):
+        return {'shapes': self.shapes,
+                'lock': self._lock,
+                'version': self._version,
+                'epsilon': self._epsilon,
+                'name': self._shm.name}
+
+    def __setstate__(self, state):
+        self.shapes = state['shapes']
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self._lock = state['lock']
+        self._version = state['version']
+        self._epsilon = state['epsilon']
+        self._shm = shared_memory.SharedMemory(name=state['name'])
+        self._owner = None
+        self._attach()
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def publish(self, weights, epsilon):
+        with self._lock:
+            self._flat[:] = np.concatenate([np.ravel(w) for w in weights])
+            self._epsilon.value = epsilon
+            self._version.value += 1
+
+    def pull(self):
+        '''
+        return version, [weight arrays], epsilon
+        '''
+        with self._lock:
+            flat = self._flat.copy()
+            version, epsilon = self._version.value, self._epsilon.value
+        weights = np.split(flat, np.cumsum(self.sizes)[:-1])
+        return version, [w.reshape(shape) for w, shape in zip(weights, self.shapes)], epsilon
+
+    def close(self):
+        self._flat = None
+        self._shm.close()
+        if self._owner == os.getpid():
+            self._shm.unlink()
+
+def _actor(index, env_kwargs, memory, weights, results, config):
+    '''
+    run config["num_episodes"] episodes of CityFlowEnv with epsilon greedy actions of the published weights
+    (config["behavior_policy"] 'network') or the max vehicle count rule ('rule'), store the config["n_step"]
+    step transitions after learning_start steps of every episode, send the rewards of every episode
+    '''
+    from cityflow_env import CityFlowEnv
+    from controllers import StateMaxQueueController
+    np.random.seed(config["seed"] + index)
+    env = CityFlowEnv(**env_kwargs)
+    phase_list = config["phase_list"]
+    rule = None
+    if config.get("behavior_policy", "network") == "rule":
+        rule = StateMaxQueueController(env.lane_phase_info, env.intersection_id, phase_list)
+    version, params, epsilon = weights.pull()
+    n_step = NStepAccumulator(config.get("n_step", 1), config["gamma"])
+
+    for episode in range(config["num_episodes"]):
+        env.reset()
+        state = env.get_state()
+        steps = {"step": [], "action": [], "reward": [], "score": []}
+        for episode_length in range(1, config["num_step"] + 1):
+            if episode_length % config["sync_freq"] == 0 and weights.version != version:
+                version, params, epsilon = weights.pull()
+            if rule is not None:
+                action = int(rule.choose_actions(state)[0])
+            elif np.random.rand() <= epsilon:
+                action = np.random.randint(len(phase_list))
+            else:
+                action = int(np.argmax(mlp_forward(params, state)[0]))
+            next_state, reward, score = env.step_n(phase_list[action], config["phase_step"], with_score=True)
+            if episode_length > config["learning_start"]:
+                transition = n_step.push(state, action, reward, next_state)
+                if transition is not None:
+                    memory.append(*transition)
+            state = next_state
+            for key, value in zip(["step", "action", "reward", "score"], [episode_length, phase_list[action], float(reward), float(score)]):
+                steps[key].append(value)
+        for transition in n_step.flush():
+            memory.append(*transition)
+        results.put(('episode', index, episode + 1, steps))
+    results.put(('done', index, None, None))
+    memory.close()
+    weights.close()
+
+class ActorPool(object):
+    '''
+    actor processes, one CityFlowEnv each (env_kwargs: one dict per actor), writing into memory,
+    a SharedReplayBuffer. poll() returns the finished episodes as (actor, episode, steps).
+    memory and weights must be created with the same multiprocessing context, spawn by default
+    (the learner process has TensorFlow initialized, which is not safe to fork)
+    '''
+    def __init__(self, env_kwargs, memory, weights, config, ctx=None):
+        ctx = ctx or mp.get_context('spawn')
+        self.results = ctx.Queue()
+        self.processes = []
+        for index, kwargs in enumerate(env_kwargs):
+            process = ctx.Process(target=_actor, args=(index, kwargs, memory, weights, self.results, config), daemon=True)
+            process.start()
+            self.processes.append(process)
+        self.num_running = len(self.processes)
+
+    def poll(self, timeout=None):
+        episodes = []
+        while True:
+            try:
+                kind, index, episode, steps = self.results.get(timeout=timeout) if timeout else self.results.get_nowait()
+            except queue.Empty:
+                break
+            timeout = None
+            if kind == 'done':
+                self.num_running -= 1
+            else:
+                episodes.append((index, episode, steps))
+        if not episodes:
+            for index, process in enumerate(self.processes):
+                if process.exitcode not in (None, 0):
+                    raise Exception("actor {} exited with code {}".format(index, process.exitcode))
+        return episodes
+
+    def close(self):
+        for process in self.processes:
+            process.join()
@@ -0,0 +1,178 @@
+'''
+step throughput of CityFlowEnv, CityFlowEnvM and CityFlowEnvRay on synthetic grids.
+
+usage (from the repository root):
+    python -m benchmark.bench_env --output bench.json
+    python -m benchmark.bench_env --grids 1x1 4x4 --envs CityFlowEnvM --num_step 500 --engine cityflow
+
+every run reports steps/sec and the seconds spent in engine next_step, engine getters,
+intersection_info, state and reward. state, reward and intersection_info are inclusive
+(state and reward call intersection_info and the getters themselves)
+'''
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+from benchmark import synthetic
+
+GRIDS = ['1x1', '1x6', '4x4', '10x10']
+ENVS = ['CityFlowEnv', 'CityFlowEnvM', 'CityFlowEnvRay']
+
+class Timers(object):
+    '''
+    accumulated seconds and number of calls by name
+    '''
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+                self.calls[name] = self.calls.get(name, 0) + 1
+        return timed
+
+class TimedEngine(object):
+    '''
+    proxy of an engine, next_step and the get_* methods are timed
+    '''
+    def __init__(self, eng, timers):
+        self._eng = eng
+        self._timers = timers
+
+    def __getattr__(self, name):
+        attr = getattr(self._eng, name)
+        if name == 'next_step':
+            return self._timers.wrap('next_step', attr)
+        if name.startswith('get_'):
+            return self._timers.wrap('engine_getters', attr)
+        return attr
+
+def use_engine(engine):
+    '''
+    make "import cityflow" return the fake engine module, must run before cityflow_env is imported
+    '''
+    if engine == 'fake':
+        from benchmark import fake_engine
+        sys.modules['cityflow'] = fake_engine
+    else:
+        import cityflow # fail early if CityFlow is not installed
+
+def make_env(name, config_file, lane_phase_info, num_step):
+    import cityflow_env
+    intersection_id = list(lane_phase_info.keys())
+    if name == 'CityFlowEnv':
+        return cityflow_env.CityFlowEnv(lane_phase_info, intersection_id[0], num_step=num_step,
+                                        cityflow_config_file=config_file)
+    if name == 'CityFlowEnvM':
+        return cityflow_env.CityFlowEnvM(lane_phase_info, intersection_id, num_step=num_step,
+                                         cityflow_config_file=config_file)
+    return cityflow_env.CityFlowEnvRay({"cityflow_config_file": config_file,
+                                        "thread_num": 1,
+                                        "num_step": num_step,
+                                        "intersection_id": intersection_id,
+                                        "lane_phase_info": lane_phase_info})
+
+def bench(name, config_file, num_step, seed, warmup=10):
+    '''
+    num_step env steps with random phases (changed every 10 steps), after warmup untimed steps
+    '''
+    from utility import parse_roadnet
+    config = json.load(open(config_file))
+    lane_phase_info = parse_roadnet(config['dir'] + config['roadnetFile'], cache=False)
+    env = make_env(name, config_file, lane_phase_info, num_step + warmup)
+    env.reset()
+    ids = list(lane_phase_info.keys())
+    rng = random.Random(seed)
+    np.random.seed(seed)
+
+    def random_action():
+        if name == 'CityFlowEnv':
+            return rng.choice(lane_phase_info[ids[0]]['phase'])
+        return {id_: rng.choice(lane_phase_info[id_]['phase']) for id_ in ids}
+
+    action = random_action()
+    for i in range(warmup):
+        env.step(action)
+
+    timers = Timers()
+    env.eng = TimedEngine(env.eng, timers)
+    for method in ['intersection_info', 'get_state', 'get_reward']:
+        setattr(env, method, timers.wrap(method, getattr(env, method)))
+
+    start = time.perf_counter()
+    for i in range(num_step):
+        if i % 10 == 0:
+            action = random_action()
+        env.step(action if name == 'CityFlowEnv' else dict(action)) # CityFlowEnvRay changes the action dict
+    total = time.perf_counter() - start
+    env.eng = env.eng._eng
+
+    return {"env": name,
+            "num_intersections": len(ids) if name != 'CityFlowEnv' else 1,
+            "num_step": num_step,
+            "seconds": total,
+            "steps_per_sec": num_step / total,
+            "time": {key: timers.seconds.get(key, 0.0) for key in
+                     ['next_step', 'engine_getters', 'intersection_info', 'get_state', 'get_reward']},
+            "calls_per_step": {key: value / num_step for key, value in timers.calls.items()}}
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--grids', type=str, nargs='+', default=GRIDS, help='grids to run, rows x cols')
+    parser.add_argument('--envs', type=str, nargs='+', default=ENVS, choices=ENVS, help='environments to run')
+    parser.add_argument('--num_step', type=int, default=300, help='timed steps of every run')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the flows, engine and actions')
+    parser.add_argument('--engine', type=str, default='fake', choices=['fake', 'cityflow'], help='engine to step')
+    parser.add_argument('--data_dir', type=str, default='benchmark/data', help='where the synthetic scenarios are written')
+    parser.add_argument('--output', type=str, default=None, help='json file for the results, printed if not given')
+    args = parser.parse_args()
+
+    use_engine(args.engine)
+    results = []
+    for grid in args.grids:
+        rows, cols = [int(x) for x in grid.split('x')]
+        config_file = synthetic.write_scenario(args.data_dir, rows, cols, seed=args.seed)
+        for name in args.envs:
+            try:
+                result = bench(name, config_file, args.num_step, args.seed)
+            except Exception as e: # e.g. ray is not installed, report and go on with the other runs
+                result = {"env": name, "error": "{}: {}".format(type(e).__name__, e)}
+            result["grid"] = grid
+            results.append(result)
+            print("{:>6} {:<15} {}".format(grid, name, "{:.1f} steps/s".format(result["steps_per_sec"])
+                                                      if "steps_per_sec" in result else result["error"]),
+                  file=sys.stderr)
+
+    report = {"date": datetime.now().isoformat(),
+              "commit": git_commit(),
+              "engine": args.engine,
+              "seed": args.seed,
+              "num_step": args.num_step,
+              "python": platform.python_version(),
+              "machine": platform.machine(),
+              "results": results}
+    if args.output:
+        json.dump(report, open(args.output, 'w'), indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+'''
+pure python stand-in for cityflow.Engine, for benchmarking where CityFlow is not installed.
+
+it reads the same config, roadnet and flow files and implements the getters the environments use.
+the traffic model is crude (vehicles drive at max speed, queue behind the vehicle in front and wait
+at red lights), the point is realistic sizes of the dicts the getters return, not realistic traffic
+'''
+import copy
+import json
+import math
+import pickle
+import random
+
+WAITING_SPEED = 0.1 # same threshold as CityFlow
+
+class Vehicle(object):
+    __slots__ = ['id', 'route', 'road', 'lane', 'distance', 'speed', 'enter_time']
+
+    def __init__(self, id_, route, enter_time):
+        self.id = id_
+        self.route = route
+        self.road = 0 # index in route
+        self.lane = None
+        self.distance = 0.0
+        self.speed = 0.0
+        self.enter_time = enter_time
+
+STATE = ['time', 'lane_vehicles', 'vehicles', 'current_phase', 'next_spawn', 'num_spawned',
+         'finished_travel_time', 'num_finished']
+
+class Archive(object):
+    '''
+    engine state returned by Engine.snapshot()
+    '''
+    def __init__(self, state):
+        self.state = state
+
+    def dump(self, path):
+        pickle.dump(self.state, open(path, 'wb'))
+
+class Engine(object):
+    def __init__(self, config_file, thread_num=1):
+        config = json.load(open(config_file))
+        roadnet = json.load(open(config['dir'] + config['roadnetFile']))
+        flows = json.load(open(config['dir'] + config['flowFile']))
+        self.interval = config.get('interval', 1.0)
+        self.seed = config.get('seed', 0)
+        self.save_replay = config.get('saveReplay', False)
+        self.replay_file = config['dir'] + config.get('replayLogFile', 'replay.txt')
+
+        self.lanes = []
+        self.lane_length = {}
+        self.lane_speed = {}
+        self.road_lanes = {}
+        for road in roadnet['roads']:
+            points = road['points']
+            length = sum(math.hypot(b['x'] - a['x'], b['y'] - a['y']) for a, b in zip(points[:-1], points[1:]))
+            self.road_lanes[road['id']] = []
+            for k, lane in enumerate(road['lanes']):
+                lane_id = "{}_{}".format(road['id'], k)
+                self.lanes.append(lane_id)
+                self.road_lanes[road['id']].append(lane_id)
+                self.lane_length[lane_id] = length
+                self.lane_speed[lane_id] = lane['maxSpeed']
+
+        # (start road, end road) -> (intersection, road link index, start lane indices)
+        self.links = {}
+        self.phases = {}
+        for intersection in roadnet['intersections']:
+            if intersection['virtual']:
+                continue
+            for index, link in enumerate(intersection['roadLinks']):
+                start_lanes = sorted(set(lane_link['startLaneIndex'] for lane_link in link['laneLinks']))
+                self.links[(link['startRoad'], link['endRoad'])] = (intersection['id'], index, start_lanes)
+            self.phases[intersection['id']] = [set(phase['availableRoadLinks'])
+                                               for phase in intersection['trafficLight']['lightphases']]
+        self.flows = flows
+        self.reset()
+
+    def reset(self, seed=False):
+        self.rng = random.Random(self.seed)
+        self.time = 0.0
+        self.lane_vehicles = {lane: [] for lane in self.lanes} # front vehicle first
+        self.vehicles = {}
+        self.current_phase = {id_: 0 for id_ in self.phases}
+        self.next_spawn = [flow['startTime'] for flow in self.flows]
+        self.num_spawned = [0] * len(self.flows)
+        self.finished_travel_time = 0.0
+        self.num_finished = 0
+
+    def _lane_for(self, vehicle):
+        # a lane of the current road leading to the next road of the route
+        route = vehicle.route
+        road = route[vehicle.road]
+        if vehicle.road + 1 < len(route):
+            start_lanes = self.links[(road, route[vehicle.road + 1])][2]
+            return self.road_lanes[road][self.rng.choice(start_lanes)]
+        return self.rng.choice(self.road_lanes[road])
+
+    def _green(self, vehicle):
+        route = vehicle.route
+        if vehicle.road + 1 >= len(route):
+            return True # leaving the roadnet
+        intersection, index, _ = self.links[(route[vehicle.road], route[vehicle.road + 1])]
+        return index in self.phases[intersection][self.current_phase[intersection]]
+
+    def _spawn(self):
+        for k, flow in enumerate(self.flows):
+            end_time = flow['endTime']
+            while self.next_spawn[k] <= self.time and (end_time < 0 or self.next_spawn[k] <= end_time):
+                vehicle = Vehicle("flow_{}_{}".format(k, self.num_spawned[k]), flow['route'], self.time)
+                vehicle.lane = self._lane_for(vehicle)
+                self.lane_vehicles[vehicle.lane].append(vehicle)
+                self.vehicles[vehicle.id] = vehicle
+                self.num_spawned[k] += 1
+                self.next_spawn[k] += flow['interval']
+
+    def next_step(self):
+        self.time += self.interval
+        moved = []
+        for lane, vehicles in self.lane_vehicles.items():
+            length = self.lane_length[lane]
+            front = None
+            keep = []
+            for vehicle in vehicles:
+                limit = length if front is None else front.distance - 7.5 # vehicle length + min gap
+                if front is None and vehicle.distance >= length and self._green(vehicle):
+                    moved.append(vehicle) # crosses the intersection
+                    continue
+                vehicle.speed = max(0.0, min(self.lane_speed[lane], limit - vehicle.distance))
+                vehicle.distance += vehicle.speed * self.interval
+                keep.append(vehicle)
+                front = vehicle
+            self.lane_vehicles[lane] = keep
+        for vehicle in moved:
+            vehicle.road += 1
+            if vehicle.road >= len(vehicle.route):
+                self.finished_travel_time += self.time - vehicle.enter_time
+                self.num_finished += 1
+                del self.vehicles[vehicle.id]
+                continue
+            vehicle.lane = self._lane_for(vehicle)
+            vehicle.distance = 0.0
+            self.lane_vehicles[vehicle.lane].append(vehicle)
+        self._spawn()
+
+    def snapshot(self):
+        state = copy.deepcopy({name: getattr(self, name) for name in STATE}) # vehicles stay shared by lanes and dict
+        state['rng'] = self.rng.getstate()
+        return Archive(state)
+
+    def load(self, archive):
+        state = copy.deepcopy(archive.state)
+        self.rng.setstate(state.pop('rng'))
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def load_from_file(self, path):
+        self.load(Archive(pickle.load(open(path, 'rb'))))
+
+    def set_tl_phase(self, intersection_id, phase_id):
+        self.current_phase[intersection_id] = phase_id
+
+    def get_current_time(self):
+        return self.time
+
+    def get_vehicle_count(self):
+        return len(self.vehicles)
+
+    def get_vehicles(self, include_waiting=False):
+        return list(self.vehicles)
+
+    def get_lane_vehicle_count(self):
+        return {lane: len(vehicles) for lane, vehicles in self.lane_vehicles.items()}
+
+    def get_lane_waiting_vehicle_count(self):
+        return {lane: sum(1 for vehicle in vehicles if vehicle.speed < WAITING_SPEED)
+                for lane, vehicles in self.lane_vehicles.items()}
+
+    def get_lane_vehicles(self):
+        return {lane: [vehicle.id for vehicle in vehicles] for lane, vehicles in self.lane_vehicles.items()}
+
+    def get_vehicle_speed(self):
+        return {id_: vehicle.speed for id_, vehicle in self.vehicles.items()}
+
+    def get_average_travel_time(self):
+        # finished vehicles and the ones still running, like CityFlow
+        running = sum(self.time - vehicle.enter_time for vehicle in self.vehicles.values())
+        total = self.num_finished + len(self.vehicles)
+        return (self.finished_travel_time + running) / total if total else 0.0
+
+    def set_save_replay(self, open_):
+        self.save_replay = open_
+
+    def set_replay_file(self, replay_file):
+        self.replay_file = replay_file
+
+    def set_random_seed(self, seed):
+        # reseeds right away like CityFlow, reset() goes back to this seed
+        self.seed = seed
+        self.rng.seed(seed)
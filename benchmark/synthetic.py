@@ -0,0 +1,112 @@
+'''
+synthetic grid roadnets, flows and cityflow configs in the CityFlow json format
+'''
+import json
+import os
+
+DX = [1, 0, -1, 0] # road direction 0: east, 1: north, 2: west, 3: south
+DY = [0, 1, 0, -1]
+ROAD_LENGTH = 300
+NUM_LANES = 3 # 0: turn left, 1: go straight, 2: turn right
+
+def grid_roadnet(rows, cols):
+    '''
+    rows x cols signalized intersections "intersection_i_j" (1 <= i <= cols, 1 <= j <= rows)
+    surrounded by virtual boundary intersections, roads "road_i_j_d" leave intersection (i, j) in direction d.
+    every intersection has the 9 light phases of the CityFlow examples (phase 0: right turns only)
+    '''
+    def real(i, j):
+        return 1 <= i <= cols and 1 <= j <= rows
+
+    def exists(i, j):
+        # real intersections plus the boundary ones, without the 4 corners
+        return real(i, j) or ((i in (0, cols + 1)) != (j in (0, rows + 1)) and 0 <= i <= cols + 1 and 0 <= j <= rows + 1)
+
+    nodes = [(i, j) for i in range(cols + 2) for j in range(rows + 2) if exists(i, j)]
+    roads = []
+    node_roads = {node: [] for node in nodes}
+    for i, j in nodes:
+        for d in range(4):
+            ni, nj = i + DX[d], j + DY[d]
+            if exists(ni, nj) and (real(i, j) or real(ni, nj)):
+                road_id = "road_{}_{}_{}".format(i, j, d)
+                roads.append({"id": road_id,
+                              "startIntersection": "intersection_{}_{}".format(i, j),
+                              "endIntersection": "intersection_{}_{}".format(ni, nj),
+                              "points": [{"x": i * ROAD_LENGTH, "y": j * ROAD_LENGTH},
+                                         {"x": ni * ROAD_LENGTH, "y": nj * ROAD_LENGTH}],
+                              "lanes": [{"width": 3, "maxSpeed": 11.111} for _ in range(NUM_LANES)]})
+                node_roads[(i, j)].append(road_id)
+                node_roads[(ni, nj)].append(road_id)
+
+    # road link index of (incoming direction d, turn t) is 3 * d + t
+    right_turns = [3 * d + 2 for d in range(4)]
+    phase_links = [[1, 7], [4, 10], [0, 6], [3, 9], [1, 0], [7, 6], [4, 3], [10, 9]]
+    intersections = []
+    for i, j in nodes:
+        road_links = []
+        light_phases = []
+        if real(i, j):
+            for d in range(4):
+                in_road = "road_{}_{}_{}".format(i - DX[d], j - DY[d], d)
+                for turn, (out_d, lane) in enumerate([((d + 1) % 4, 0), (d, 1), ((d + 3) % 4, 2)]):
+                    road_links.append({"type": ["turn_left", "go_straight", "turn_right"][turn],
+                                       "startRoad": in_road,
+                                       "endRoad": "road_{}_{}_{}".format(i, j, out_d),
+                                       "direction": out_d,
+                                       "laneLinks": [{"startLaneIndex": lane, "endLaneIndex": k, "points": []}
+                                                     for k in range(NUM_LANES)]})
+            light_phases = [{"time": 5, "availableRoadLinks": right_turns}] + \
+                           [{"time": 30, "availableRoadLinks": links + right_turns} for links in phase_links]
+        intersections.append({"id": "intersection_{}_{}".format(i, j),
+                              "point": {"x": i * ROAD_LENGTH, "y": j * ROAD_LENGTH},
+                              "width": 0 if not real(i, j) else 15,
+                              "roads": node_roads[(i, j)],
+                              "roadLinks": road_links,
+                              "trafficLight": {"roadLinkIndices": list(range(len(road_links))),
+                                               "lightphases": light_phases},
+                              "virtual": not real(i, j)})
+    return {"intersections": intersections, "roads": roads}
+
+def grid_flow(rows, cols, interval=5.0, end_time=-1):
+    '''
+    one straight-through flow from every boundary entry to the opposite side of the grid
+    '''
+    vehicle = {"length": 5.0, "width": 2.0, "maxPosAcc": 2.0, "maxNegAcc": 4.5, "usualPosAcc": 2.0,
+               "usualNegAcc": 4.5, "minGap": 2.5, "maxSpeed": 11.111, "headwayTime": 2}
+    flows = []
+    entries = [(0, j, 0) for j in range(1, rows + 1)] + [(cols + 1, j, 2) for j in range(1, rows + 1)] + \
+              [(i, 0, 1) for i in range(1, cols + 1)] + [(i, rows + 1, 3) for i in range(1, cols + 1)]
+    for i, j, d in entries:
+        route = []
+        while True:
+            route.append("road_{}_{}_{}".format(i, j, d))
+            i, j = i + DX[d], j + DY[d]
+            if not (1 <= i <= cols and 1 <= j <= rows):
+                break
+        flows.append({"vehicle": vehicle, "route": route, "interval": interval, "startTime": 0, "endTime": end_time})
+    return flows
+
+def write_scenario(out_dir, rows, cols, seed=0, interval=5.0):
+    '''
+    write roadnet, flow and cityflow config of a rows x cols grid, return the config file
+    '''
+    name = "{}x{}".format(rows, cols)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    out_dir = os.path.abspath(out_dir) + "/"
+    json.dump(grid_roadnet(rows, cols), open(out_dir + "roadnet_{}.json".format(name), 'w'))
+    json.dump(grid_flow(rows, cols, interval), open(out_dir + "flow_{}.json".format(name), 'w'))
+    config = {"interval": 1.0,
+              "seed": seed,
+              "dir": out_dir,
+              "roadnetFile": "roadnet_{}.json".format(name),
+              "flowFile": "flow_{}.json".format(name),
+              "rlTrafficLight": True,
+              "laneChange": False,
+              "saveReplay": False,
+              "roadnetLogFile": "replay_roadnet_{}.json".format(name),
+              "replayLogFile": "replay_{}.txt".format(name)}
+    config_file = out_dir + "config_{}.json".format(name)
+    json.dump(config, open(config_file, 'w'), indent=2)
+    return config_file
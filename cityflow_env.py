@@ -1,12 +1,232 @@
 import cityflow
-import pandas as pd
 import os
 import json
 import math
 import numpy as np
-import itertools
+from recorder import PhaseRecorder
+from rewards import make_reward
+from utility import csr_rows
 # from sim_setting import sim_setting_control
 
+class LaneIndex(object):
+    '''
+    fixed lane -> column index of a group of intersections, built once from parse_roadnet output:
+    from the RoadnetIndex arrays of a LanePhaseInfo, or a plain {id_: {"start_lane", "end_lane", ...}} dict.
+    start_lane_index/end_lane_index are (num_intersections, max_lanes) column arrays,
+    rows shorter than max_lanes are padded with the column 'num_lanes', which is always 0
+    '''
+    def __init__(self, lane_phase_info, intersection_id):
+        self.intersection_id = list(intersection_id)
+        self.row = {id_: i for i, id_ in enumerate(self.intersection_id)}
+
+        roadnet_index = getattr(lane_phase_info, 'roadnet_index', None)
+        if roadnet_index is not None:
+            rows = [roadnet_index.row[id_] for id_ in self.intersection_id]
+            start, self.num_start_lane = csr_rows(roadnet_index.start_lane_ptr, roadnet_index.start_lane, rows)
+            end, self.num_end_lane = csr_rows(roadnet_index.end_lane_ptr, roadnet_index.end_lane, rows)
+            lanes = np.unique(np.concatenate([start, end])) # roadnet lane numbers are in name order
+            self.lanes = [roadnet_index.lanes[k] for k in lanes.tolist()]
+            start, end = np.searchsorted(lanes, start), np.searchsorted(lanes, end)
+        else:
+            start_lane = [lane_phase_info[id_]['start_lane'] for id_ in self.intersection_id] # sorted by parse_roadnet
+            end_lane = [lane_phase_info[id_]['end_lane'] for id_ in self.intersection_id]
+            self.lanes = sorted(set(lane for lanes in start_lane + end_lane for lane in lanes))
+            column = {lane: i for i, lane in enumerate(self.lanes)}
+            start = np.array([column[lane] for lanes in start_lane for lane in lanes], dtype=np.int64)
+            end = np.array([column[lane] for lanes in end_lane for lane in lanes], dtype=np.int64)
+            self.num_start_lane = np.array([len(lanes) for lanes in start_lane])
+            self.num_end_lane = np.array([len(lanes) for lanes in end_lane])
+        self.num_lanes = len(self.lanes)
+        self.lane_column = dict(zip(self.lanes, range(self.num_lanes)))
+
+        self.start_lane_index = self._column_index(start, self.num_start_lane)
+        self.end_lane_index = self._column_index(end, self.num_end_lane)
+        self._start_lane = None
+        self._end_lane = None
+
+    def _column_index(self, columns, lengths):
+        max_lanes = int(lengths.max()) if len(lengths) else 0
+        index = np.full((len(lengths), max_lanes), self.num_lanes, dtype=np.int64)
+        index[np.arange(max_lanes) < lengths[:, None]] = columns # row major, in lane order
+        return index
+
+    def _lane_names(self, index, lengths):
+        return [[self.lanes[k] for k in row[:n]] for row, n in zip(index.tolist(), lengths.tolist())]
+
+    @property
+    def start_lane(self):
+        '''
+        start lane names of every intersection, built on first use
+        '''
+        if self._start_lane is None:
+            self._start_lane = self._lane_names(self.start_lane_index, self.num_start_lane)
+        return self._start_lane
+
+    @property
+    def end_lane(self):
+        if self._end_lane is None:
+            self._end_lane = self._lane_names(self.end_lane_index, self.num_end_lane)
+        return self._end_lane
+
+class EngineSnapshot(object):
+    '''
+    lane and vehicle info of the engine at one simulation tick.
+    every getter queries the engine at most once, the snapshot must be
+    dropped as soon as the engine moves on (next_step or reset)
+    '''
+    def __init__(self, eng, lane_index=None):
+        self.eng = eng
+        self.lane_index = lane_index
+        self._lane_vehicle_count = None
+        self._lane_waiting_vehicle_count = None
+        self._lane_vehicles = None
+        self._vehicle_speed = None
+        self._lane_arrays = {} # {name: array of num_lanes + 1}
+        self._lane_views = {} # {(side, name): array of (num_intersections, max_lanes)}
+
+    @property
+    def lane_vehicle_count(self):
+        if self._lane_vehicle_count is None:
+            self._lane_vehicle_count = self.eng.get_lane_vehicle_count() # {lane_id: lane_count, ...}
+        return self._lane_vehicle_count
+
+    @property
+    def lane_waiting_vehicle_count(self):
+        if self._lane_waiting_vehicle_count is None:
+            self._lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count() # {lane_id: lane_waiting_count, ...}
+        return self._lane_waiting_vehicle_count
+
+    @property
+    def lane_vehicles(self):
+        if self._lane_vehicles is None:
+            self._lane_vehicles = self.eng.get_lane_vehicles() # {lane_id: [vehicle1_id, vehicle2_id, ...], ...}
+        return self._lane_vehicles
+
+    @property
+    def vehicle_speed(self):
+        if self._vehicle_speed is None:
+            self._vehicle_speed = self.eng.get_vehicle_speed() # {vehicle_id: vehicle_speed, ...}
+        return self._vehicle_speed
+
+    def lane_array(self, name):
+        '''
+        per lane 'vehicle_count', 'waiting_vehicle_count', 'speed_sum' (summed vehicle speed) or 'speed'
+        (mean vehicle speed) in lane_index column order, with a trailing 0 for the padding column
+        '''
+        if name not in self._lane_arrays:
+            lanes = self.lane_index.lanes
+            values = np.zeros(len(lanes) + 1)
+            if name == 'speed_sum':
+                lane_vehicles = self.lane_vehicles
+                vehicle_speed = self.vehicle_speed
+                values[:-1] = [sum(vehicle_speed[vehicle] for vehicle in lane_vehicles[lane]) for lane in lanes]
+            elif name == 'speed':
+                values[:-1] = self.lane_array('speed_sum')[:-1] / (self.lane_array('vehicle_count')[:-1] + 1e-5)
+            else:
+                lane_values = getattr(self, 'lane_' + name)
+                values[:-1] = [lane_values[lane] for lane in lanes]
+            self._lane_arrays[name] = values
+        return self._lane_arrays[name]
+
+    def lane_view(self, name, side='start'):
+        '''
+        (num_intersections, max_lanes) array of lane_array(name) on the start or end lanes
+        '''
+        if (side, name) not in self._lane_views:
+            index = self.lane_index.start_lane_index if side == 'start' else self.lane_index.end_lane_index
+            self._lane_views[(side, name)] = self.lane_array(name)[index]
+        return self._lane_views[(side, name)]
+
+
+class RollingWindow(object):
+    '''
+    last 'span' samples of a vector of 'size' values (zeros before the first samples),
+    the window mean and variance are updated in O(size) per sample (Welford update for a sliding window)
+    '''
+    def __init__(self, size, span):
+        self.span = span
+        self.values = np.zeros((size, span))
+        self.pointer = 0 # column of the oldest sample
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size) # sum of squared differences from the mean
+
+    def reset(self):
+        self.values[:] = 0
+        self.pointer = 0
+        self.mean[:] = 0
+        self.m2[:] = 0
+
+    def push(self, x):
+        old = self.values[:, self.pointer].copy()
+        old_mean = self.mean.copy()
+        self.mean += (x - old) / self.span
+        self.m2 += (x - old) * (x - self.mean + old - old_mean)
+        self.values[:, self.pointer] = x
+        self.pointer = (self.pointer + 1) % self.span
+
+    def var(self):
+        return np.maximum(self.m2, 0) / self.span
+
+class PhaseCounter(object):
+    '''
+    how many of the last 'span' seconds each phase (1, ..., num_phases) was active, for every intersection
+    '''
+    def __init__(self, num_intersections, num_phases, span):
+        self.span = span
+        self.rows = np.arange(num_intersections)
+        self.phases = np.zeros((num_intersections, span), dtype=np.int64) # 0: no phase recorded yet
+        self.counts = np.zeros((num_intersections, num_phases + 1), dtype=np.int64) # counts[:, 0] counts the empty slots
+        self.reset()
+
+    def reset(self):
+        self.phases[:] = 0
+        self.pointer = 0
+        self.counts[:] = 0
+        self.counts[:, 0] = self.span
+
+    def push(self, phases):
+        '''
+        phases: active phase of every intersection
+        '''
+        self.counts[self.rows, self.phases[:, self.pointer]] -= 1
+        self.counts[self.rows, phases] += 1
+        self.phases[:, self.pointer] = phases
+        self.pointer = (self.pointer + 1) % self.span
+
+class WarmStartPool(object):
+    '''
+    snapshots of an environment after warmup_steps steps of random phases (each kept phase_step seconds),
+    one per rollout. restore() starts an episode from one of them instead of reset(), so the
+    warm-up seconds are simulated once for the whole training, not once per episode.
+    works with CityFlowEnv and CityFlowEnvM
+    '''
+    def __init__(self, env, size, warmup_steps, phase_step=1, seed=0):
+        self.env = env
+        self.warmup_steps = warmup_steps
+        self.rng = np.random.RandomState(seed)
+        self.snapshots = []
+        for _ in range(size):
+            env.reset()
+            for _ in range(warmup_steps):
+                action = self._random_action()
+                for _ in range(phase_step):
+                    env._next_step(action) # no state or reward needed
+            self.snapshots.append(env.snapshot())
+
+    def _random_action(self):
+        phase_list = self.env.phase_list
+        if isinstance(phase_list, dict):
+            return {id_: phase_list[id_][self.rng.randint(len(phase_list[id_]))] for id_ in self.env.intersection_id}
+        return phase_list[self.rng.randint(len(phase_list))]
+
+    def restore(self):
+        '''
+        restore a random snapshot of the pool, return its index
+        '''
+        index = self.rng.randint(len(self.snapshots))
+        self.env.restore(self.snapshots[index])
+        return index
+
 class CityFlowEnv(object):
     def __init__(self,
                 lane_phase_info,
@@ -14,7 +234,8 @@ class CityFlowEnv(object):
                 num_step=1500,
                 thread_num=1,
                 cityflow_config_file='examples/config_1x1.json',
-                replay_data_path='./replay'
+                replay_data_path='./replay',
+                reward='mean_speed'
                 ):
         # cityflow_config['rlTrafficLight'] = rl_control # use RL to control the light or not
         self.eng = cityflow.Engine(cityflow_config_file, thread_num=thread_num)
@@ -22,24 +243,92 @@ class CityFlowEnv(object):
         self.state_size = None
         self.lane_phase_info = lane_phase_info # "intersection_1_1"
         self.intersection_id = intersection_id
-        self.start_lane = self.lane_phase_info[self.intersection_id]['start_lane']
-        self.end_lane = self.lane_phase_info[self.intersection_id]['end_lane']
+        self.lane_index = LaneIndex(self.lane_phase_info, [self.intersection_id])
+        self.start_lane = {self.intersection_id: self.lane_index.start_lane[0]}
+        self.end_lane = {self.intersection_id: self.lane_index.end_lane[0]}
 
         self.phase_list = self.lane_phase_info[self.intersection_id]["phase"]
-        self.phase_startLane_mapping = self.lane_phase_info[self.intersection_id]["phase_startLane_mapping"]
+        self.reward_fn = make_reward(reward) # see rewards.py
 
         self.replay_data_path = replay_data_path
         self.current_phase = {self.intersection_id:self.phase_list[0]}
         self.current_phase_time = {self.intersection_id:0}
         self.yellow_time = 5
         self.state_store_i = 0
+        self._snapshot = None # engine info of the current tick, see get_snapshot()
+        self._info_cache = {} # {id_: intersection_info} of the current tick
         self.get_state() # set self.state_size
-        self.phase_log = []
+        self.recorder = PhaseRecorder([self.intersection_id], capacity=num_step) # phases of the current episode
 
     def reset(self):
         self.eng.reset()
+        self.invalidate_snapshot()
+        self.recorder.reset()
+
+    @property
+    def phase_startLane_mapping(self):
+        return {self.intersection_id: self.lane_phase_info[self.intersection_id]["phase_startLane_mapping"]}
+
+    @property
+    def phase_log(self):
+        return self.recorder.log[:, 0]
+
+    def snapshot(self):
+        '''
+        engine state plus the env bookkeeping, restore() continues from here instead of reset()
+        '''
+        return {'engine': self.eng.snapshot(),
+                'current_phase': dict(self.current_phase),
+                'current_phase_time': dict(self.current_phase_time),
+                'phase_log': self.recorder.log.copy()}
+
+    def restore(self, snapshot):
+        self.eng.load(snapshot['engine'])
+        self.current_phase = dict(snapshot['current_phase'])
+        self.current_phase_time = dict(snapshot['current_phase_time'])
+        self.recorder.reset()
+        self.recorder.extend(snapshot['phase_log'])
+        self.invalidate_snapshot()
+
+    def get_snapshot(self):
+        '''
+        engine info of the current tick, shared by state, reward and score
+        '''
+        if self._snapshot is None:
+            self._snapshot = EngineSnapshot(self.eng, self.lane_index)
+        return self._snapshot
+
+    def invalidate_snapshot(self):
+        self._snapshot = None
+        self._info_cache = {}
 
     def step(self, next_phase):
+        self._next_step(next_phase)
+        return self.get_state(), self.get_reward() # return next_state and reward
+
+    def step_n(self, next_phase, n, reward_reduce='mean', with_score=False, score_reduce='mean'):
+        '''
+        keep next_phase for n seconds. only the reward (and score) is computed every second,
+        the state is built once at the end.
+        reward_reduce: 'mean', 'sum' or 'last' of the n rewards, score_reduce: 'mean' or 'last' of the n scores
+        '''
+        assert reward_reduce in ('mean', 'sum', 'last'), "unknown reward_reduce: {}".format(reward_reduce)
+        assert score_reduce in ('mean', 'last'), "unknown score_reduce: {}".format(score_reduce)
+        reward = 0
+        score = 0
+        for k in range(n):
+            self._next_step(next_phase)
+            reward_ = self.get_reward()
+            reward = reward_ if reward_reduce == 'last' else reward + reward_
+            if with_score and (score_reduce == 'mean' or k == n - 1):
+                score += self.get_score()
+        if reward_reduce == 'mean':
+            reward /= n
+        if with_score:
+            return self.get_state(), reward, score / n if score_reduce == 'mean' else score
+        return self.get_state(), reward
+
+    def _next_step(self, next_phase):
         if self.current_phase[self.intersection_id] == next_phase:
             self.current_phase_time[self.intersection_id] += 1
         else:
@@ -48,13 +337,13 @@ class CityFlowEnv(object):
 
         self.eng.set_tl_phase(self.intersection_id, self.current_phase[self.intersection_id]) # set phase of traffic light
         self.eng.next_step()
-        self.phase_log.append(self.current_phase[self.intersection_id])
-        return self.get_state(), self.get_reward() # return next_state and reward
+        self.invalidate_snapshot()
+        self.recorder.record(self.current_phase[self.intersection_id])
 
     def get_state(self):
         intersection_info = self.intersection_info(self.intersection_id)
         state_dict = intersection_info['start_lane_vehicle_count']
-        return_state = [state_dict[key] for key in sorted(state_dict.keys())] + [intersection_info['current_phase'][self.intersection_id]]
+        return_state = [state_dict[key] for key in sorted(state_dict.keys())] + [intersection_info['current_phase']]
         return self.preprocess_state(return_state)
 
     def preprocess_state(self, state):
@@ -66,13 +355,17 @@ class CityFlowEnv(object):
 
     def intersection_info(self, id_):
         '''
-        info of intersection 'id_'
+        info of intersection 'id_', computed once per tick
         '''
+        if id_ in self._info_cache:
+            return self._info_cache[id_]
+
         state = {}
-        get_lane_vehicle_count = self.eng.get_lane_vehicle_count()
-        get_lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count()
-        get_lane_vehicles = self.eng.get_lane_vehicles()
-        vehicle_speed = self.eng.get_vehicle_speed()
+        snapshot = self.get_snapshot()
+        get_lane_vehicle_count = snapshot.lane_vehicle_count
+        get_lane_waiting_vehicle_count = snapshot.lane_waiting_vehicle_count
+        get_lane_vehicles = snapshot.lane_vehicles
+        vehicle_speed = snapshot.vehicle_speed
 
         state['start_lane_vehicle_count'] = {lane: get_lane_vehicle_count[lane] for lane in self.start_lane[id_]}
         state['end_lane_vehicle_count'] = {lane: get_lane_vehicle_count[lane] for lane in self.end_lane[id_]}
@@ -89,74 +382,32 @@ class CityFlowEnv(object):
         state['current_phase'] = self.current_phase[id_]
         state['current_phase_time'] = self.current_phase_time[id_]
 
+        self._info_cache[id_] = state
         return state
 
-    # def get_reward(self):
-    #     '''
-    #     max vehicle count of the lanes, *-1
-    #     '''
-    #     lane_vehicle_count = self.eng.get_lane_vehicles()
-    #     for key in lane_vehicle_count.keys():
-    #         lane_vehicle_count[key] = len(lane_vehicle_count[key])
-    #     reward = -1 * max(list(lane_vehicle_count.values()))
-    #     return reward
-
-    # def get_reward(self):
-    #     '''
-    #     max vehicle count of all start lanes
-    #     '''
-    #     start_lane_vehicle_count = {lane: self.eng.get_lane_vehicle_count()[lane] for lane in self.start_lane}
-    #     reward = -1 * np.mean(list(start_lane_vehicle_count.values()))
-    #     return reward
-
-    # def get_reward(self):
-    #     '''
-    #     max waiting vehicle count of the lanes, *-1
-    #     '''
-    #     lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count()
-    #     lane_waiting_vehicle_count_list = list(lane_waiting_vehicle_count.values())
-    #     reward = -1 * ( sum(lane_waiting_vehicle_count_list)/len(lane_waiting_vehicle_count_list)  )
-    #     return reward
-    
     def get_reward(self):
         '''
-        mean speed of start lanes
+        reward of the intersection, the kernel selected by 'reward'
         '''
-        intersection_info = self.intersection_info(self.intersection_id)
-
-        start_lane_vehicles = intersection_info["start_lane_vehicle_count"]
-
-        start_lane_vehicles = list(itertools.chain(*start_lane_vehicles))
-        vehicle_speed = self.eng.get_vehicle_speed()
-        start_lane_vehicles_speed = [vehicle_speed[v] for v in start_lane_vehicles]
-        reward = sum(start_lane_vehicles_speed)/(len(start_lane_vehicles_speed) + 1e-5) * 100
-        return reward
-    
-    def _get_pressure(self):
-        return [self.dic_lane_waiting_vehicle_count_current_step[lane] for lane in self.list_entering_lanes] + \
-               [-self.dic_lane_waiting_vehicle_count_current_step[lane] for lane in self.list_exiting_lanes]
-    
-    # def get_reward(self):
-    #     # reward function
-    #     lane_waiting_vehicle_count = self.eng.get_lane_vehicle_count()
-    #     lane_waiting_vehicle_count_list = list(lane_waiting_vehicle_count.values())
-    #     reward = -1 * max(lane_waiting_vehicle_count_list)
-    #     return reward
+        return float(self.reward_fn(self.get_snapshot(), self)[0])
 
     def get_score(self):
-        lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count()
+        lane_waiting_vehicle_count = self.get_snapshot().lane_waiting_vehicle_count
         reward = -1 * sum(list(lane_waiting_vehicle_count.values()))
         metric = (1/(1 + math.exp(-1 * reward))) / self.num_step
         return metric
         # return 0
 
     def log(self):
+        '''
+        phases of the episode to replay_data_path: signal_plan.txt and the compressed phase_log.npz
+        '''
         if not os.path.exists(self.replay_data_path):
             os.makedirs(self.replay_data_path)
         # self.eng.print_log(self.config['replay_data_path'] + "/replay_roadnet.json",
         #                    self.config['replay_data_path'] + "/replay_flow.json")
-        df = pd.DataFrame({self.intersection_id: self.phase_log[:self.num_step]})
-        df.to_csv(os.path.join(self.replay_data_path, 'signal_plan.txt'), index=None)
+        self.recorder.save_signal_plan(os.path.join(self.replay_data_path, 'signal_plan.txt'), self.num_step)
+        self.recorder.save(os.path.join(self.replay_data_path, 'phase_log.npz'))
 
 class CityFlowEnvM(object):
     '''
@@ -167,7 +418,8 @@ class CityFlowEnvM(object):
                 intersection_id,
                 num_step=2000,
                 thread_num=1,
-                cityflow_config_file='example/config_1x2.json'
+                cityflow_config_file='example/config_1x2.json',
+                reward='lane_mean_speed'
                 ):
         self.eng = cityflow.Engine(cityflow_config_file, thread_num=thread_num)
         self.num_step = num_step
@@ -175,31 +427,100 @@ class CityFlowEnvM(object):
         self.state_size = None
         self.lane_phase_info = lane_phase_info # "intersection_1_1"
 
+        self.lane_index = LaneIndex(self.lane_phase_info, self.intersection_id)
         self.current_phase = {}
         self.current_phase_time = {}
-        self.start_lane = {}
-        self.end_lane = {}
         self.phase_list = {}
-        self.phase_startLane_mapping = {}
         self.intersection_lane_mapping = {} #{id_:[lanes]}
 
         for id_ in self.intersection_id:
-            self.start_lane[id_] = self.lane_phase_info[id_]['start_lane']
-            self.end_lane[id_] = self.lane_phase_info[id_]['end_lane']
-            self.phase_startLane_mapping[id_] = self.lane_phase_info[id_]["phase_startLane_mapping"]
-
             self.phase_list[id_] = self.lane_phase_info[id_]["phase"]
             self.current_phase[id_] = self.phase_list[id_][0]
             self.current_phase_time[id_] = 0
+        self.reward_fn = make_reward(reward) # see rewards.py
+        self._snapshot = None # engine info of the current tick, see get_snapshot()
+        self._info_cache = {} # {id_: intersection_info} of the current tick
         self.get_state() # set self.state_size
+        self.recorder = PhaseRecorder(self.intersection_id, capacity=num_step) # phases of the current episode
         
     def reset(self):
         self.eng.reset()
+        self.invalidate_snapshot()
+        self.recorder.reset()
+
+    @property
+    def start_lane(self):
+        return dict(zip(self.intersection_id, self.lane_index.start_lane))
+
+    @property
+    def end_lane(self):
+        return dict(zip(self.intersection_id, self.lane_index.end_lane))
+
+    @property
+    def phase_startLane_mapping(self):
+        return {id_: self.lane_phase_info[id_]["phase_startLane_mapping"] for id_ in self.intersection_id}
+
+    def snapshot(self):
+        '''
+        engine state plus the env bookkeeping, restore() continues from here instead of reset()
+        '''
+        return {'engine': self.eng.snapshot(),
+                'current_phase': dict(self.current_phase),
+                'current_phase_time': dict(self.current_phase_time),
+                'phase_log': self.recorder.log.copy()}
+
+    def restore(self, snapshot):
+        self.eng.load(snapshot['engine'])
+        self.current_phase = dict(snapshot['current_phase'])
+        self.current_phase_time = dict(snapshot['current_phase_time'])
+        self.recorder.reset()
+        self.recorder.extend(snapshot['phase_log'])
+        self.invalidate_snapshot()
+
+    def get_snapshot(self):
+        '''
+        engine info of the current tick, shared by state, reward and score
+        '''
+        if self._snapshot is None:
+            self._snapshot = EngineSnapshot(self.eng, self.lane_index)
+        return self._snapshot
+
+    def invalidate_snapshot(self):
+        self._snapshot = None
+        self._info_cache = {}
 
     def step(self, action):
         '''
         action: {intersection_id: phase, ...}
         '''
+        self._next_step(action)
+        return self.get_state(), self.get_reward()
+
+    def step_n(self, action, n, reward_reduce='mean', with_score=False, score_reduce='mean'):
+        '''
+        keep action for n seconds. only the rewards (and scores) are computed every second,
+        the states are built once at the end.
+        reward_reduce: 'mean', 'sum' or 'last' of the n rewards, score_reduce: 'mean' or 'last' of the n scores
+        '''
+        assert reward_reduce in ('mean', 'sum', 'last'), "unknown reward_reduce: {}".format(reward_reduce)
+        assert score_reduce in ('mean', 'last'), "unknown score_reduce: {}".format(score_reduce)
+        reward = np.zeros(len(self.intersection_id))
+        score = np.zeros(len(self.intersection_id))
+        for k in range(n):
+            self._next_step(action)
+            reward_ = self._reward_array()
+            reward = reward_ if reward_reduce == 'last' else reward + reward_
+            if with_score and (score_reduce == 'mean' or k == n - 1):
+                score += self._score_array()
+        if reward_reduce == 'mean':
+            reward /= n
+        reward = dict(zip(self.intersection_id, reward.tolist()))
+        if with_score:
+            score = score / n if score_reduce == 'mean' else score
+            return self.get_state(), reward, dict(zip(self.intersection_id, score.tolist()))
+        return self.get_state(), reward
+
+    def _next_step(self, action):
         for id_, a in action.items():
             if self.current_phase[id_] == a:
                 self.current_phase_time[id_] += 1
@@ -208,281 +529,57 @@ class CityFlowEnvM(object):
                 self.current_phase_time[id_] = 1
             self.eng.set_tl_phase(id_, self.current_phase[id_]) # set phase of traffic light
         self.eng.next_step()
-        return self.get_state(), self.get_reward()
-
-    def get_state(self):
-        state =  {id_: self.get_state_(id_) for id_ in self.intersection_id}
-        return state
-
-    def get_state_(self, id_):
-        state = self.intersection_info(id_)
-        state_dict = state['start_lane_waiting_vehicle_count']
-        sorted_keys = sorted(state_dict.keys())
-        return_state = [state_dict[key] for key in sorted_keys] + [state['current_phase']]
-        return self.preprocess_state(return_state)
+        self.invalidate_snapshot()
+        self.recorder.record([self.current_phase[id_] for id_ in self.intersection_id])
 
-    def intersection_info(self, id_):
+    def get_state(self, feature='waiting_vehicle_count'):
         '''
-        info of intersection 'id_'
+        feature: 'vehicle_count' gives the states of CityFlowEnv.get_state, for single intersection checkpoints
         '''
-        state = {}
-        # state['lane_vehicle_count'] = self.eng.get_lane_vehicle_count()  # {lane_id: lane_count, ...}
-        # state['start_lane_vehicle_count'] = {lane: self.eng.get_lane_vehicle_count()[lane] for lane in self.start_lane[id_]}
-        # state['lane_waiting_vehicle_count'] = self.eng.get_lane_waiting_vehicle_count()  # {lane_id: lane_waiting_count, ...}
-        # state['lane_vehicles'] = self.eng.get_lane_vehicles()  # {lane_id: [vehicle1_id, vehicle2_id, ...], ...}
-        # state['vehicle_speed'] = self.eng.get_vehicle_speed()  # {vehicle_id: vehicle_speed, ...}
-        # state['vehicle_distance'] = self.eng.get_vehicle_distance() # {vehicle_id: distance, ...}
-        # state['current_time'] = self.eng.get_current_time()
-
-        get_lane_vehicle_count = self.eng.get_lane_vehicle_count()
-        get_lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count()
-        get_lane_vehicles = self.eng.get_lane_vehicles()
-        vehicle_speed = self.eng.get_vehicle_speed()
-
-        state['start_lane_vehicle_count'] = {lane: get_lane_vehicle_count[lane] for lane in self.start_lane[id_]}
-        state['end_lane_vehicle_count'] = {lane: get_lane_vehicle_count[lane] for lane in self.end_lane[id_]}
-        
-        state['start_lane_waiting_vehicle_count'] = {lane: get_lane_waiting_vehicle_count[lane] for lane in self.start_lane[id_]}
-        state['end_lane_waiting_vehicle_count'] = {lane: get_lane_waiting_vehicle_count[lane] for lane in self.end_lane[id_]}
-        
-        state['start_lane_vehicles'] = {lane: get_lane_vehicles[lane] for lane in self.start_lane[id_]}
-        state['end_lane_vehicles'] = {lane: get_lane_vehicles[lane] for lane in self.end_lane[id_]}
-        
-        state['start_lane_speed'] = {lane: np.sum(list(map(lambda vehicle:vehicle_speed[vehicle], get_lane_vehicles[lane]))) / (get_lane_vehicle_count[lane]+1e-5) for lane in self.start_lane[id_]} # compute start lane mean speed
-        state['end_lane_speed'] = {lane: np.sum(list(map(lambda vehicle:vehicle_speed[vehicle], get_lane_vehicles[lane]))) / (get_lane_vehicle_count[lane]+1e-5) for lane in self.end_lane[id_]} # compute end lane mean speed
-        
-        state['current_phase'] = self.current_phase[id_]
-        state['current_phase_time'] = self.current_phase_time[id_]
-
+        state =  {id_: self.get_state_(id_, feature) for id_ in self.intersection_id}
         return state
 
-
-    def preprocess_state(self, state):
-        return_state = np.array(state)
-        if self.state_size is None:
-            self.state_size = len(return_state.flatten())
-        return_state = np.reshape(return_state, [1, self.state_size])
-        return return_state
-
-    def get_reward(self):
-        reward = {id_: self.get_reward_(id_) for id_ in self.intersection_id}
-        return reward
-
-    # def get_reward_(self, id_):
-    #     '''
-    #     every agent/intersection's reward
-    #     '''
-    #     state = self.intersection_info(id_)
-    #     start_lane_waiting_vehicle_count = state['start_lane_waiting_vehicle_count']
-    #     reward = -1 * np.sum(list(start_lane_waiting_vehicle_count.values()))
-    #     return reward
-
-    def get_reward_(self, id_):
+    def get_state_(self, id_, feature='waiting_vehicle_count'):
         '''
-        every agent/intersection's reward
+        waiting vehicle count (or 'feature') of the (sorted) start lanes + current phase
         '''
-        state = self.intersection_info(id_)
-        start_lane_speed = state['start_lane_speed']
-        reward = np.mean(list(start_lane_speed.values())) * 100
-        return reward
-
-    def get_score(self):
-        score = {id_: self.get_score_(id_) for id_ in self.intersection_id}
-        return score
-    
-    def get_score_(self, id_):
-        state = self.intersection_info(id_)
-        start_lane_waiting_vehicle_count = state['start_lane_waiting_vehicle_count']
-        end_lane_waiting_vehicle_count = state['end_lane_waiting_vehicle_count']
-        x = -1 * np.sum(list(start_lane_waiting_vehicle_count.values()) + list(end_lane_waiting_vehicle_count.values()))
-        score = ( 1/(1 + np.exp(-1 * x)) )/self.num_step
-        return score
-
-import ray
-from ray.rllib.env.multi_agent_env import MultiAgentEnv
-from gym.spaces import Discrete, Box
-class CityFlowEnvRay(MultiAgentEnv):
-    '''
-    multi inersection cityflow environment, for the Ray framework
-    '''
-    observation_space = Box(0.0*np.ones((13,)), 100*np.ones((13,)))
-    action_space = Discrete(8) # num of agents
-
-    def __init__(self, config):
-        print("init")
-        self.eng = cityflow.Engine(config["cityflow_config_file"], thread_num=config["thread_num"])
-        # self.eng = config["eng"][0]
-        self.num_step = config["num_step"]
-        self.intersection_id = config["intersection_id"] # list, [intersection_id, ...]
-        self.num_agents = len(self.intersection_id)
-        self.state_size = None
-        self.lane_phase_info = config["lane_phase_info"] # "intersection_1_1"
-        self.time_span_1 = 50
-        self.time_span_2 = 50
-        
-
-        self.current_phase = {}
-        self.current_phase_time = {}
-        self.start_lane = {}
-        self.end_lane = {}
-        self.phase_list = {}
-        self.phase_startLane_mapping = {}
-        self.intersection_lane_mapping = {} #{id_:[lanes]}
-        self.span_count_all = {} #{id_:[the span count for this id_]} 
-        self.preparetime = {}
-
-        for id_ in self.intersection_id:
-            self.start_lane[id_] = self.lane_phase_info[id_]['start_lane']
-            self.end_lane[id_] = self.lane_phase_info[id_]['end_lane']
-            self.phase_startLane_mapping[id_] = self.lane_phase_info[id_]["phase_startLane_mapping"]
-
-            self.phase_list[id_] = self.lane_phase_info[id_]["phase"]
-            self.current_phase[id_] = self.phase_list[id_][0]
-            self.current_phase_time[id_] = 0
-            self.preparetime[id_] = 0
-        self.get_state() # set self.state_size
-        self.num_actions = len(self.phase_list[self.intersection_id[0]])
-
-        # self.observation_space = Box(np.ones(0.0*(self.state_size,)), 20.0*np.ones((self.state_size)))
-        # self.action_space = Discrete(self.num_actions) # num of agents
-        
-        
-        self.count = 0
-        self.done = False
-        self.reset()
-        
-    def reset(self):
-        self.eng.reset()
-        self.done = False
-        self.count = 0
-        return {id_:np.zeros((self.state_size,)) for id_ in self.intersection_id}
-    
-    def prepareid(self,id_,a):
-        sum1 = self.get_span_(id_)[a-1]
-        sum2 = sum(self.get_complex_(id_))
-        state = self.intersection_info(id_)
-        sum4 = sum(state['start_lane_waiting_vehicle_count'].values())/10
-        sum3 = sum1+sum2+sum4
-        if sum3>30:
-            return 6
-        elif sum3 >20:
-            return 4
-        elif sum3 >10:
-            return 2
-        else:
-            return 1
-        
-    def changeaction(self,action):
-        for id_,a in action.items():
-            if self.preparetime[id_]>0:
-                action[id_]=self.current_phase[id_]
-                
-        
-        
-    def preparetime2(self,action):
-        for id_,a in action.items():
-            if self.preparetime[id_] == 0:
-                newtime = self.prepareid(id_,a)
-                self.preparetime[id_] = newtime
-                self.current_phase[id_] = a
-        self.renewtime()
-                
-           
-    def renewtime(self):
-        for id_ in self.intersection_id:
-            self.preparetime[id_] = self.preparetime[id_]-1
-            
-        
-        
-    
-    def showtime(self):
-        for id_ in self.intersection_id:
-            print (self.preparetime[id_])
-    
-   
-        
-        
-
-    def step(self, action):
-        '''
-        action: {intersection_id: phase, ...}
-        '''
-        # print("action:", action)
-        self.changeaction(action)
-        self.preparetime2(action)
-        self.eng.next_step()
-
-        for i in self.intersection_id:
-            self.set_span_(i)
-            self.set_span_state_(i)
-            self.set_complex_(i)
-
-        self.count += 1
-        if self.count > self.num_step:
-            self.done = True
-        state = self.get_state()
-        reward = self.get_reward()
-        done = {id_: self.done for id_ in self.intersection_id} # !
-        done['__all__'] = self.done # !
-        return state, reward, done, {} 
-
-    def get_state(self):
-        state =  {id_: self.get_state_(id_) for id_ in self.intersection_id}
-        return state
-
-    def get_state_(self, id_):
-        state = self.intersection_info(id_)
-        state_dict = state['start_lane_waiting_vehicle_count']
-        sorted_keys = sorted(state_dict.keys())
-        return_state = [state_dict[key] for key in sorted_keys] + [state['current_phase']]
+        i = self.lane_index.row[id_]
+        count = self.get_snapshot().lane_view(feature, 'start')
+        return_state = np.append(count[i, :self.lane_index.num_start_lane[i]], self.current_phase[id_])
         return self.preprocess_state(return_state)
 
     def intersection_info(self, id_):
         '''
-        info of intersection 'id_'
+        info of intersection 'id_', computed once per tick from the lane arrays
         '''
+        if id_ in self._info_cache:
+            return self._info_cache[id_]
+
         state = {}
-        
-        get_lane_vehicle_count = self.eng.get_lane_vehicle_count()
-        get_lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count()
-        get_lane_vehicles = self.eng.get_lane_vehicles()
-        get_vehicle_speed = self.eng.get_vehicle_speed()
-
-        # print(self.intersection_id)
-        # print(id_)
-        # print("start lane", self.start_lane)
-        # print("get_lane_vehicle_count key length:", get_lane_vehicle_count)
-        # print("engine:", self.eng)
-        # print("get_lane_waiting_vehicle_count:", get_lane_waiting_vehicle_count)
-        # print("get_lane_vehicles:", get_lane_vehicles)
-        # print("vehicle_speed:", vehicle_speed)
+        i = self.lane_index.row[id_]
+        snapshot = self.get_snapshot()
+        start_lane = self.lane_index.start_lane[i]
+        end_lane = self.lane_index.end_lane[i]
 
-        state['start_lane_vehicle_count'] = {lane: get_lane_vehicle_count[lane] for lane in self.start_lane[id_]}
-        state['end_lane_vehicle_count'] = {lane: get_lane_vehicle_count[lane] for lane in self.end_lane[id_]}
-        # state['start_lane_vehicle_count'] = {}
-        # state['end_lane_vehicle_count'] = {}
+        def lane_dict(name, side, lanes):
+            return dict(zip(lanes, snapshot.lane_view(name, side)[i, :len(lanes)].tolist()))
 
-        state['start_lane_waiting_vehicle_count'] = {lane: get_lane_waiting_vehicle_count[lane] for lane in self.start_lane[id_]}
-        state['end_lane_waiting_vehicle_count'] = {lane: get_lane_waiting_vehicle_count[lane] for lane in self.end_lane[id_]}
+        state['start_lane_vehicle_count'] = lane_dict('vehicle_count', 'start', start_lane)
+        state['end_lane_vehicle_count'] = lane_dict('vehicle_count', 'end', end_lane)
         
-        state['start_lane_vehicles'] = {lane: get_lane_vehicles[lane] for lane in self.start_lane[id_]}
-        state['end_lane_vehicles'] = {lane: get_lane_vehicles[lane] for lane in self.end_lane[id_]}
+        state['start_lane_waiting_vehicle_count'] = lane_dict('waiting_vehicle_count', 'start', start_lane)
+        state['end_lane_waiting_vehicle_count'] = lane_dict('waiting_vehicle_count', 'end', end_lane)
+        
+        state['start_lane_vehicles'] = {lane: snapshot.lane_vehicles[lane] for lane in start_lane}
+        state['end_lane_vehicles'] = {lane: snapshot.lane_vehicles[lane] for lane in end_lane}
         
-        state['start_lane_speed'] = {lane: np.sum(list(map(lambda vehicle:get_vehicle_speed[vehicle], get_lane_vehicles[lane]))) / (get_lane_vehicle_count[lane]+1e-5) for lane in self.start_lane[id_]} # compute start lane mean speed
-        state['end_lane_speed'] = {lane: np.sum(list(map(lambda vehicle:get_vehicle_speed[vehicle], get_lane_vehicles[lane]))) / (get_lane_vehicle_count[lane]+1e-5) for lane in self.end_lane[id_]} # compute end lane mean speed
+        state['start_lane_speed'] = lane_dict('speed', 'start', start_lane) # start lane mean speed
+        state['end_lane_speed'] = lane_dict('speed', 'end', end_lane) # end lane mean speed
         
         state['current_phase'] = self.current_phase[id_]
         state['current_phase_time'] = self.current_phase_time[id_]
-        
-        state['num_span_1'] = 0
-        state['num_span_2'] = 0
-        state['count'] = np.zeros([8, self.time_span_1])
-        #print (len(state['start_lane_waiting_vehicle_count']))
-        #print (self.time_span_2)
-        state['accum_s'] = np.zeros([len(state['start_lane_waiting_vehicle_count']), self.time_span_2])
-        state['countsum'] = np.zeros([8, 1])
-        state['complex'] = np.zeros([len(state['start_lane_waiting_vehicle_count']),1])
 
+        self._info_cache[id_] = state
         return state
 
 
@@ -490,90 +587,39 @@ class CityFlowEnvRay(MultiAgentEnv):
         return_state = np.array(state)
         if self.state_size is None:
             self.state_size = len(return_state.flatten())
-        return_state = np.reshape(np.array(return_state), [1, self.state_size]).flatten()
+        return_state = np.reshape(return_state, [1, self.state_size])
         return return_state
 
     def get_reward(self):
-        reward = {id_: self.get_reward_(id_) for id_ in self.intersection_id}
-        mean_global_sum = np.sum(list(reward.values()))
-        length = len(self.intersection_id)
-        mean = mean_global_sum/length
-        # return reward
-        reward = {id_:mean for id_ in self.intersection_id}
-        return reward
+        return dict(zip(self.intersection_id, self._reward_array().tolist()))
+
+    def _reward_array(self):
+        '''
+        every agent/intersection's reward in one pass, the kernel selected by 'reward'
+        '''
+        return self.reward_fn(self.get_snapshot(), self)
 
     def get_reward_(self, id_):
         '''
         every agent/intersection's reward
         '''
-        state = self.intersection_info(id_)
-        temp = state['start_lane_waiting_vehicle_count']
-        reward = -np.max(list(temp.values())) 
-        return reward
-    
-    def get_span(self):
-        timespan = {id_: self.get_span_(id_) for id_ in self.intersection_id}
-        return timespan
-       
-        
-    def get_span_(self,id_):
-        state = self.intersection_info(id_)
-        return state['countsum'].reshape(8, 1)
-    
-    def set_span_(self,id_):
-        state = self.intersection_info(id_)
-        state['count'][:, state['num_span_1']] = 0
-        state['count'][self.current_phase[id_]-1, state['num_span_1']] = 1
-        state['num_span_1'] = state['num_span_1'] + 1
-        if state['num_span_1'] is self.time_span_1:
-            state['num_span_1'] = 0
-        state['countsum']= state['count'].sum(axis=1)
-    
-                                    
-    def get_span_state(self):
-        spanstate = {id_: self.get_span_state_(id_) for id_ in self.intersection_id}
-        return spanstate
-                                                                  
-    def get_span_state_(self,id_): 
-        state = self.intersection_info(id_)
-        return state['accum_s']
-    
-    def set_span_state_(self,id_):
-        state = self.intersection_info(id_)
-        state2 = self.get_state_(id_)
-        state2= state2[:-1]
-        for i in range(len(state['start_lane_waiting_vehicle_count'])):
-            #print(type(state2))
-            state['accum_s'][i, state['num_span_2']] = state2[i]
-        state['num_span_2'] = state['num_span_2'] + 1
-        if state['num_span_2'] is self.time_span_2:
-            self.num_span_2 = 0
-    
-    def get_complex(self):
-        co = {id_: self.get_complex_(id_) for id_ in self.intersection_id}
-        return co
-        
-        
-    def get_complex_(self,id_):
-        state=self.intersection_info(id_)
-        return state['complex']
-    
-    def set_complex_(self,id_):
-        state=self.intersection_info(id_)
-        state2 = state['accum_s']
-        for i in range(len(state['start_lane_waiting_vehicle_count'])):
-            state['complex'][i]=np.var(state2[i,:])
-        
-          
-        
+        return self.get_reward()[id_]
+
     def get_score(self):
-        score = {id_: self.get_score_(id_) for id_ in self.intersection_id}
-        return score
+        return dict(zip(self.intersection_id, self._score_array().tolist()))
+
+    def _score_array(self):
+        snapshot = self.get_snapshot()
+        x = -1 * (snapshot.lane_view('waiting_vehicle_count', 'start').sum(axis=1) +
+                  snapshot.lane_view('waiting_vehicle_count', 'end').sum(axis=1))
+        return ( 1/(1 + np.exp(-1 * x)) )/self.num_step
     
     def get_score_(self, id_):
-        state = self.intersection_info(id_)
-        start_lane_waiting_vehicle_count = state['start_lane_waiting_vehicle_count']
-        end_lane_waiting_vehicle_count = state['end_lane_waiting_vehicle_count']
-        x = -1 * np.sum(list(start_lane_waiting_vehicle_count.values()) + list(end_lane_waiting_vehicle_count.values()))
-        score = ( 1/(1 + np.exp(-1 * x)) )/self.num_step
-        return score
\ No newline at end of file
+        return self.get_score()[id_]
+
+def __getattr__(name):
+    # CityFlowEnvRay needs ray and gym, they are imported on first use only
+    if name in ('CityFlowEnvRay', 'worker_cpus'):
+        import cityflow_env_ray
+        return getattr(cityflow_env_ray, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
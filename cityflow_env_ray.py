@@ -0,0 +1,301 @@
+"""
+CityFlowEnvRay, the multi intersection environment of ray_multi_agent.py, apart from cityflow_env
+so that the other environments load without ray and gym
+"""
+
+import cityflow
+import os
+import numpy as np
+import ray
+from ray.rllib.env.multi_agent_env import MultiAgentEnv
+from gym.spaces import Discrete, Box
+from cityflow_env import LaneIndex, EngineSnapshot, RollingWindow, PhaseCounter
+from rewards import make_reward
+
+def worker_cpus():
+    '''
+    number of CPUs ray assigned to the current worker, the CPUs this process may run on outside of a ray worker
+    '''
+    try:
+        cpus = sum(fraction for _, fraction in ray.get_resource_ids().get('CPU', []))
+    except Exception: # not in a ray worker
+        cpus = 0
+    if cpus < 1:
+        cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    return max(1, int(cpus))
+
+class CityFlowEnvRay(MultiAgentEnv):
+    '''
+    multi inersection cityflow environment, for the Ray framework.
+    the engine is read once per step (EngineSnapshot), states, rewards and the rolling
+    features of all intersections are computed from it as arrays in lane_index order
+    '''
+    observation_space = Box(0.0*np.ones((13,)), 100*np.ones((13,)))
+    action_space = Discrete(8) # num of agents
+
+    def __init__(self, config):
+        print("init")
+        self.thread_num = config.get("thread_num") or worker_cpus() # 0 or missing: all CPUs of the worker
+        self.eng = cityflow.Engine(config["cityflow_config_file"], thread_num=self.thread_num)
+        # self.eng = config["eng"][0]
+        self.num_step = config["num_step"]
+        self.intersection_id = config["intersection_id"] # list, [intersection_id, ...]
+        self.num_agents = len(self.intersection_id)
+        self.state_size = None
+        self.lane_phase_info = config["lane_phase_info"] # "intersection_1_1"
+        self.time_span_1 = 50
+        self.time_span_2 = 50
+        
+
+        self.lane_index = LaneIndex(self.lane_phase_info, self.intersection_id)
+        self.current_phase = {}
+        self.current_phase_time = {}
+        self.phase_list = {}
+        self.intersection_lane_mapping = {} #{id_:[lanes]}
+        self.span_count_all = {} #{id_:[the span count for this id_]} 
+        self.preparetime = {}
+
+        for id_ in self.intersection_id:
+            self.phase_list[id_] = self.lane_phase_info[id_]["phase"]
+            self.current_phase[id_] = self.phase_list[id_][0]
+            self.current_phase_time[id_] = 0
+            self.preparetime[id_] = 0
+
+        self.reward_fn = make_reward(config.get("reward", "max_queue")) # see rewards.py, the mean over all agents is the reward of every agent
+        self._snapshot = None # engine info of the current tick, see get_snapshot()
+        self._info_cache = {} # {id_: intersection_info} of the current tick
+
+        # rolling history of all intersections, kept across steps, cleared on reset
+        num_phases = max(max(self.phase_list[id_]) for id_ in self.intersection_id)
+        self.phase_count = PhaseCounter(self.num_agents, num_phases, self.time_span_1) # active phase of the last time_span_1 steps
+        lanes_shape = self.lane_index.start_lane_index.shape # (num_agents, max start lanes), padded lanes stay 0
+        self.waiting_window = RollingWindow(self.num_agents * lanes_shape[1], self.time_span_2) # start lane waiting counts of the last time_span_2 steps
+        self.complex = np.zeros(lanes_shape) # waiting count variance of the start lanes
+        self.get_state() # set self.state_size
+        self.num_actions = len(self.phase_list[self.intersection_id[0]])
+
+        # self.observation_space = Box(np.ones(0.0*(self.state_size,)), 20.0*np.ones((self.state_size)))
+        # self.action_space = Discrete(self.num_actions) # num of agents
+        
+        
+        self.count = 0
+        self.done = False
+        self.reset()
+        
+    def reset(self):
+        self.eng.reset()
+        self.invalidate_snapshot()
+        self.done = False
+        self.count = 0
+        self.phase_count.reset()
+        self.waiting_window.reset()
+        self.complex[:] = 0
+        return {id_:np.zeros((self.state_size,)) for id_ in self.intersection_id}
+
+    @property
+    def start_lane(self):
+        return dict(zip(self.intersection_id, self.lane_index.start_lane))
+
+    @property
+    def end_lane(self):
+        return dict(zip(self.intersection_id, self.lane_index.end_lane))
+
+    @property
+    def phase_startLane_mapping(self):
+        return {id_: self.lane_phase_info[id_]["phase_startLane_mapping"] for id_ in self.intersection_id}
+
+    def get_snapshot(self):
+        '''
+        engine info of the current tick, shared by states, rewards, scores and the rolling features
+        '''
+        if self._snapshot is None:
+            self._snapshot = EngineSnapshot(self.eng, self.lane_index)
+        return self._snapshot
+
+    def invalidate_snapshot(self):
+        self._snapshot = None
+        self._info_cache = {}
+
+    def prepare_times(self, rows, phases):
+        '''
+        seconds to keep the new phases of the intersections in lane_index rows 'rows', from how long each
+        phase was active lately, the waiting count variance and the latest waiting count of the start lanes
+        '''
+        latest = self.waiting_window.values[:, self.waiting_window.pointer - 1].reshape(self.complex.shape)
+        load = self.phase_count.counts[rows, phases] + self.complex[rows].sum(axis=1) + latest[rows].sum(axis=1)/10
+        return np.array([1, 2, 4, 6])[np.searchsorted([10, 20, 30], load)] # > 10: 2, > 20: 4, > 30: 6
+
+    def prepareid(self,id_,a):
+        return int(self.prepare_times([self.lane_index.row[id_]], [a])[0])
+        
+    def changeaction(self,action):
+        for id_,a in action.items():
+            if self.preparetime[id_]>0:
+                action[id_]=self.current_phase[id_]
+                
+        
+        
+    def preparetime2(self,action):
+        ready = [id_ for id_ in action if self.preparetime[id_] == 0]
+        if ready:
+            newtime = self.prepare_times([self.lane_index.row[id_] for id_ in ready], [action[id_] for id_ in ready])
+            for id_, t in zip(ready, newtime.tolist()):
+                self.preparetime[id_] = t
+                self.current_phase[id_] = action[id_]
+        self.renewtime()
+                
+           
+    def renewtime(self):
+        for id_ in self.intersection_id:
+            self.preparetime[id_] = self.preparetime[id_]-1
+            
+        
+        
+    
+    def showtime(self):
+        for id_ in self.intersection_id:
+            print (self.preparetime[id_])
+    
+   
+        
+        
+
+    def step(self, action):
+        '''
+        action: {intersection_id: phase, ...}
+        '''
+        # print("action:", action)
+        self.changeaction(action)
+        self.preparetime2(action)
+        self.eng.next_step()
+        self.invalidate_snapshot()
+
+        self.set_span()
+        self.set_span_state()
+        self.set_complex()
+
+        self.count += 1
+        if self.count > self.num_step:
+            self.done = True
+        state = self.get_state()
+        reward = self.get_reward()
+        done = {id_: self.done for id_ in self.intersection_id} # !
+        done['__all__'] = self.done # !
+        return state, reward, done, {} 
+
+    def get_state(self):
+        waiting_count = self.get_snapshot().lane_view('waiting_vehicle_count', 'start')
+        num_start_lane = self.lane_index.num_start_lane
+        state = {id_: self.preprocess_state(np.append(waiting_count[i, :num_start_lane[i]], self.current_phase[id_]))
+                 for i, id_ in enumerate(self.intersection_id)}
+        return state
+
+    def get_state_(self, id_):
+        '''
+        waiting vehicle count of the (sorted) start lanes + current phase
+        '''
+        i = self.lane_index.row[id_]
+        waiting_count = self.get_snapshot().lane_view('waiting_vehicle_count', 'start')
+        return_state = np.append(waiting_count[i, :self.lane_index.num_start_lane[i]], self.current_phase[id_])
+        return self.preprocess_state(return_state)
+
+    def intersection_info(self, id_):
+        '''
+        info of intersection 'id_', computed once per tick from the lane arrays
+        '''
+        if id_ in self._info_cache:
+            return self._info_cache[id_]
+
+        state = {}
+        i = self.lane_index.row[id_]
+        snapshot = self.get_snapshot()
+        start_lane = self.lane_index.start_lane[i]
+        end_lane = self.lane_index.end_lane[i]
+
+        def lane_dict(name, side, lanes):
+            return dict(zip(lanes, snapshot.lane_view(name, side)[i, :len(lanes)].tolist()))
+
+        state['start_lane_vehicle_count'] = lane_dict('vehicle_count', 'start', start_lane)
+        state['end_lane_vehicle_count'] = lane_dict('vehicle_count', 'end', end_lane)
+
+        state['start_lane_waiting_vehicle_count'] = lane_dict('waiting_vehicle_count', 'start', start_lane)
+        state['end_lane_waiting_vehicle_count'] = lane_dict('waiting_vehicle_count', 'end', end_lane)
+        
+        state['start_lane_vehicles'] = {lane: snapshot.lane_vehicles[lane] for lane in start_lane}
+        state['end_lane_vehicles'] = {lane: snapshot.lane_vehicles[lane] for lane in end_lane}
+        
+        state['start_lane_speed'] = lane_dict('speed', 'start', start_lane) # start lane mean speed
+        state['end_lane_speed'] = lane_dict('speed', 'end', end_lane) # end lane mean speed
+        
+        state['current_phase'] = self.current_phase[id_]
+        state['current_phase_time'] = self.current_phase_time[id_]
+
+        self._info_cache[id_] = state
+        return state
+
+
+    def preprocess_state(self, state):
+        return_state = np.array(state)
+        if self.state_size is None:
+            self.state_size = len(return_state.flatten())
+        return_state = np.reshape(np.array(return_state), [1, self.state_size]).flatten()
+        return return_state
+
+    def get_reward(self):
+        mean = self.reward_fn(self.get_snapshot(), self).mean()
+        reward = {id_:mean for id_ in self.intersection_id}
+        return reward
+
+    def get_reward_(self, id_):
+        '''
+        every agent/intersection's reward
+        '''
+        return self.reward_fn(self.get_snapshot(), self)[self.lane_index.row[id_]]
+    
+    def get_span(self):
+        timespan = {id_: self.get_span_(id_) for id_ in self.intersection_id}
+        return timespan
+       
+        
+    def get_span_(self,id_):
+        return self.phase_count.counts[self.lane_index.row[id_], 1:].reshape(-1, 1)
+    
+    def set_span(self):
+        self.phase_count.push([self.current_phase[id_] for id_ in self.intersection_id])
+    
+                                    
+    def get_span_state(self):
+        spanstate = {id_: self.get_span_state_(id_) for id_ in self.intersection_id}
+        return spanstate
+                                                                  
+    def get_span_state_(self,id_): 
+        i = self.lane_index.row[id_]
+        values = self.waiting_window.values.reshape(self.complex.shape + (self.time_span_2,))
+        return values[i, :self.lane_index.num_start_lane[i]]
+    
+    def set_span_state(self):
+        self.waiting_window.push(self.get_snapshot().lane_view('waiting_vehicle_count', 'start').ravel())
+    
+    def get_complex(self):
+        co = {id_: self.get_complex_(id_) for id_ in self.intersection_id}
+        return co
+        
+        
+    def get_complex_(self,id_):
+        i = self.lane_index.row[id_]
+        return self.complex[i, :self.lane_index.num_start_lane[i]].reshape(-1, 1)
+    
+    def set_complex(self):
+        self.complex[:] = self.waiting_window.var().reshape(self.complex.shape)
+        
+          
+        
+    def get_score(self):
+        snapshot = self.get_snapshot()
+        x = -1 * (snapshot.lane_view('waiting_vehicle_count', 'start').sum(axis=1) +
+                  snapshot.lane_view('waiting_vehicle_count', 'end').sum(axis=1))
+        score = ( 1/(1 + np.exp(-1 * x)) )/self.num_step
+        return dict(zip(self.intersection_id, score.tolist()))
+    
+    def get_score_(self, id_):
+        return self.get_score()[id_]
@@ -0,0 +1,76 @@
+"""
+Q learning update of the Keras agents built once in the TensorFlow graph
+"""
+
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+def session_config(intra_op_threads=0, inter_op_threads=0):
+    '''
+    tf.ConfigProto with the sizes of the op thread pools, 0 lets TensorFlow choose (all cores)
+    '''
+    return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                          inter_op_parallelism_threads=inter_op_threads)
+
+def set_session_threads(intra_op_threads=0, inter_op_threads=0):
+    '''
+    new Keras session with these thread pools, call it before the models are built
+    '''
+    K.set_session(tf.Session(config=session_config(intra_op_threads, inter_op_threads)))
+
+class CompiledQUpdate(object):
+    '''
+    one gradient step of model on a batch of transitions as a single session call: TD targets
+    rewards + discounts * max_a target_model(next_states) (double: the target_model value of the
+    greedy action of model), importance sampling weighted squared TD error and an Adam step.
+    replaces predict, predict and fit (three graph runs plus the Keras overhead of each) of DQNAgent.replay.
+    inputs are in the order of model.inputs, e.g. [states] or [states, intersections]
+    '''
+    def __init__(self, model, target_model, learning_rate, double=False):
+        self.inputs = [tf.placeholder(x.dtype, x.shape) for x in model.inputs]
+        self.next_inputs = [tf.placeholder(x.dtype, x.shape) for x in model.inputs]
+        self.actions = tf.placeholder(tf.int32, [None]) # action_list index
+        self.rewards = tf.placeholder(tf.float32, [None])
+        self.discounts = tf.placeholder(tf.float32, [None])
+        self.weights = tf.placeholder(tf.float32, [None])
+
+        def call(network, inputs):
+            return network(inputs if len(inputs) > 1 else inputs[0])
+
+        batch_index = tf.range(tf.shape(self.actions)[0])
+        q_next = call(target_model, self.next_inputs)
+        if double:
+            next_actions = tf.argmax(call(model, self.next_inputs), axis=1, output_type=tf.int32)
+            next_values = tf.gather_nd(q_next, tf.stack([batch_index, next_actions], axis=1))
+        else:
+            next_values = tf.reduce_max(q_next, axis=1)
+        q_targets = tf.stop_gradient(self.rewards + self.discounts * next_values)
+        q_values = tf.gather_nd(call(model, self.inputs), tf.stack([batch_index, self.actions], axis=1))
+        self.td_error = q_targets - q_values # new priorities of the transitions
+        loss = tf.reduce_mean(self.weights * tf.square(self.td_error))
+        optimizer = tf.train.AdamOptimizer(learning_rate)
+        train_op = optimizer.minimize(loss, var_list=model.trainable_weights)
+
+        session = K.get_session()
+        session.run(tf.variables_initializer(optimizer.variables()))
+        # feeds and fetches are resolved once, a call only copies the arrays in
+        self._step = session.make_callable([train_op, self.td_error],
+                                           feed_list=self.inputs + self.next_inputs +
+                                                     [self.actions, self.rewards, self.discounts, self.weights])
+
+    def run(self, inputs, next_inputs, actions, rewards, discounts, weights=None, num_steps=1):
+        '''
+        num_steps gradient steps from one sample, as num_steps session calls: step k on the k-th of
+        num_steps equal parts of the transitions, which must be in random order (ReplayBuffer.sample_weighted).
+        return the TD errors of all transitions, each computed right before its step
+        '''
+        weights = np.ones_like(rewards) if weights is None else weights
+        size = len(actions) // num_steps
+        td_errors = []
+        for k in range(num_steps):
+            part = slice(k * size, (k + 1) * size)
+            _, td_error = self._step(*([x[part] for x in inputs] + [x[part] for x in next_inputs] +
+                                       [actions[part], rewards[part], discounts[part], weights[part]]))
+            td_errors.append(td_error)
+        return np.concatenate(td_errors)
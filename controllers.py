@@ -0,0 +1,125 @@
+"""
+Baseline signal controllers (max queue, max pressure, fixed time) for all intersections at once
+"""
+
+import numpy as np
+from sim_setting import sim_setting_default
+
+class PhaseIncidence(object):
+    '''
+    sparse (intersection, phase) x lane incidence of a LaneIndex, as coordinate arrays.
+    score(values) is the matrix-vector product with a lane array of EngineSnapshot
+    (num_lanes + 1 values in lane_index column order), computed with one np.bincount
+    and returned as (num_intersections, max_phases), -inf where an intersection has fewer phases
+    '''
+    def __init__(self, lane_index, phase_list, entries):
+        '''
+        phase_list: {id_: [phase, ...]}, entries: {id_: {phase: [(lane, weight), ...]}}
+        '''
+        num_intersections = len(lane_index.intersection_id)
+        self.max_phases = max(len(phase_list[id_]) for id_ in lane_index.intersection_id)
+        self.phases = np.zeros((num_intersections, self.max_phases), dtype=np.int64) # phase ids, padded with the first one
+        self.valid = np.zeros((num_intersections, self.max_phases), dtype=bool)
+        rows, columns, weights = [], [], []
+        for i, id_ in enumerate(lane_index.intersection_id):
+            self.phases[i] = phase_list[id_][0]
+            for k, phase in enumerate(phase_list[id_]):
+                self.phases[i, k] = phase
+                self.valid[i, k] = True
+                for lane, weight in entries[id_].get(phase, []):
+                    rows.append(i * self.max_phases + k)
+                    columns.append(lane_index.lane_column[lane])
+                    weights.append(weight)
+        self.rows = np.array(rows, dtype=np.int64)
+        self.columns = np.array(columns, dtype=np.int64)
+        self.weights = np.array(weights, dtype=float)
+        self.size = num_intersections * self.max_phases
+
+    def score(self, values):
+        scores = np.bincount(self.rows, weights=self.weights * values[self.columns], minlength=self.size)
+        scores = scores.reshape(self.phases.shape)
+        scores[~self.valid] = -np.inf
+        return scores
+
+def _phase_list(lane_phase_info, lane_index, phase_list):
+    # lane_phase_info phases, replaced by the ones given for some intersections
+    phases = {id_: lane_phase_info[id_]['phase'] for id_ in lane_index.intersection_id}
+    phases.update(phase_list or {})
+    return phases
+
+class MaxQueueController(object):
+    '''
+    phase with the most vehicles (lane_value='vehicle_count') or waiting vehicles
+    ('waiting_vehicle_count') on its start lanes, ties go to the first phase.
+    phase_list: {id_: [phase, ...]} the actions, lane_phase_info[id_]['phase'] for the intersections not in it
+    '''
+    def __init__(self, lane_phase_info, lane_index, lane_value='waiting_vehicle_count', phase_list=None):
+        self.lane_value = lane_value
+        self.incidence = PhaseIncidence(lane_index,
+                                        _phase_list(lane_phase_info, lane_index, phase_list),
+                                        {id_: {phase: [(lane, 1.0) for lane in lanes]
+                                               for phase, lanes in lane_phase_info[id_]['phase_startLane_mapping'].items()}
+                                         for id_ in lane_index.intersection_id})
+
+    def choose_action(self, snapshot):
+        '''
+        (num_intersections,) index in the phase list of every intersection
+        '''
+        return np.argmax(self.incidence.score(snapshot.lane_array(self.lane_value)), axis=1)
+
+    def choose_phases(self, snapshot):
+        '''
+        (num_intersections,) phase of every intersection
+        '''
+        action = self.choose_action(snapshot)
+        return self.incidence.phases[np.arange(len(action)), action]
+
+class MaxPressureController(MaxQueueController):
+    '''
+    phase with the largest pressure, the sum over its lane links of
+    vehicles on the incoming lane - vehicles on the outgoing lane
+    '''
+    def __init__(self, lane_phase_info, lane_index, lane_value='vehicle_count', phase_list=None):
+        self.lane_value = lane_value
+        entries = {}
+        for id_ in lane_index.intersection_id:
+            entries[id_] = {}
+            for phase, links in lane_phase_info[id_]['phase_roadLink_mapping'].items():
+                entries[id_][phase] = [(start, 1.0) for start, _ in links] + [(end, -1.0) for _, end in links]
+        self.incidence = PhaseIncidence(lane_index, _phase_list(lane_phase_info, lane_index, phase_list), entries)
+
+class StateMaxQueueController(object):
+    '''
+    MaxQueueController(lane_value='vehicle_count') of one intersection, computed from CityFlowEnv states
+    (vehicle counts of the sorted start lanes + current phase) instead of the engine, so it also acts
+    for environments stepped in other processes (VecCityFlowEnv, actor_learner)
+    '''
+    def __init__(self, lane_phase_info, intersection_id, phase_list=None):
+        info = lane_phase_info[intersection_id]
+        column = {lane: k for k, lane in enumerate(info['start_lane'])}
+        phase_list = info['phase'] if phase_list is None else phase_list
+        self.incidence = np.zeros((len(phase_list), len(column))) # phase x start lane
+        for k, phase in enumerate(phase_list):
+            for lane in info['phase_startLane_mapping'].get(phase, []):
+                self.incidence[k, column[lane]] += 1
+
+    def choose_actions(self, states):
+        '''
+        states: (num_states, state_size), return the index in the phase list for every state
+        '''
+        counts = np.reshape(states, [-1, self.incidence.shape[1] + 1])[:, :-1]
+        return np.argmax(np.dot(counts, self.incidence.T), axis=1)
+
+class FixedTimeController(object):
+    '''
+    cycle through the light phases with the durations of plan (seconds of phase 0, 1, ...),
+    all intersections in sync
+    '''
+    def __init__(self, lane_index, plan=None):
+        plan = sim_setting_default['plan'] if plan is None else plan
+        self.num_intersections = len(lane_index.intersection_id)
+        self.phase_at = np.repeat(np.arange(len(plan)), plan) # phase of every second of the cycle
+
+    def choose_phases(self, snapshot):
+        t = int(snapshot.eng.get_current_time()) % len(self.phase_at)
+        return np.full(self.num_intersections, self.phase_at[t])
@@ -4,42 +4,55 @@ DQN and Double DQN agent implementation using Keras
 
 import random
 import numpy as np
-from collections import deque
-from keras.models import Sequential
-from keras.layers import Dense
+from keras.models import Sequential, Model
+from keras.layers import Dense, Input, Embedding, Flatten, Concatenate
 from keras.optimizers import Adam
 import keras.backend.tensorflow_backend as KTF
 import tensorflow as tf
 import os
+from replay_buffer import make_replay_buffer
+from profiler import Profiler
+from controllers import MaxQueueController
+from numpy_policy import save_policy
+from compiled_update import CompiledQUpdate
 
 # os.environ["CUDA_VISIBLE_DEVICES"] = "0,1"
 # KTF.set_session(tf.Session(config=tf.ConfigProto(device_count={'gpu':0})))
 
 class DQNAgent(object):
+    double = False # DDQNAgent: target network value of the greedy action of the Q network
+
     def __init__(self, 
             intersection_id,
             state_size=9,
             action_size=8,
             batch_size=32,
             phase_list=[],
-            env=None
+            env=None,
+            memory_size=3000,
+            prioritized=False,
+            update_steps=0
             ):
         self.env = env
         self.intersection_id = intersection_id
         self.state_size = state_size
         self.action_size = action_size
-        self.memory = deque(maxlen=3000)
+        self.memory = make_replay_buffer(memory_size, state_size, prioritized) # prioritized: sum-tree prioritized replay
         self.gamma = 0.95    # discount rate
         self.epsilon = 1.0  # exploration rate
         self.epsilon_min = 0.1
         self.epsilon_decay = 0.9995
         self.learning_rate = 0.001
         self.batch_size = batch_size
+        self.update_steps = update_steps # gradient steps of the compiled update per replay, 0: keras fit
         self.model = self._build_model()
         self.target_model = self._build_model()
         self.update_target_network()
+        self.update = None # CompiledQUpdate, built by the first replay
         
         self.phase_list = phase_list
+        self.profiler = Profiler() # disabled, the training loop may replace it
+        self.rule_controller = None # built by choose_action_ on first use
 
     def _build_model(self):
         # Neural Net for Deep-Q learning Model
@@ -55,9 +68,12 @@ class DQNAgent(object):
         weights = self.model.get_weights()
         self.target_model.set_weights(weights)
 
-    def remember(self, state, action, reward, next_state):
+    def remember(self, state, action, reward, next_state, discount=None):
+        '''
+        discount: factor of the value of next_state, gamma ** n for an n-step return (NStepAccumulator)
+        '''
         action = self.phase_list.index(action) # index
-        self.memory.append((state, action, reward, next_state))
+        self.memory.append(state, action, reward, next_state, self.gamma if discount is None else discount)
 
     def choose_action(self, state):
         if np.random.rand() <= self.epsilon:
@@ -65,39 +81,63 @@ class DQNAgent(object):
         act_values = self.model.predict(state)
         return np.argmax(act_values[0])  # returns action
 
+    def choose_actions(self, states):
+        '''
+        epsilon greedy actions for a batch of states (num_states, state_size), one forward pass
+        '''
+        act_values = self.model.predict(states, batch_size=len(states))
+        actions = np.argmax(act_values, axis=1)
+        explore = np.random.rand(len(states)) <= self.epsilon
+        actions[explore] = np.random.randint(0, self.action_size, size=explore.sum())
+        return actions
+
     def choose_action_(self, state):
         '''
-        choose phase with max waiting count in its start lanes
+        choose phase with max vehicle count in its start lanes
         '''
-        intersection_info = self.env.intersection_info(self.intersection_id)
-        phase_waiting_count = self.phase_list.copy()
-        for index, phase in enumerate(self.phase_list):
-            phase_start_lane = self.env.phase_startLane_mapping[self.intersection_id][phase] # {0:['road_0_1_1_1',], 1:[]...}
-            phase_start_lane_waiting_count = [intersection_info["start_lane_vehicle_count"][lane] for lane  in phase_start_lane] # [num1, num2, ...]
-            sum_count = sum(phase_start_lane_waiting_count)
-            phase_waiting_count[index] = sum_count
-        
-        action = np.argmax(phase_waiting_count)
-        return action
+        if self.rule_controller is None:
+            self.rule_controller = MaxQueueController(self.env.lane_phase_info, self.env.lane_index, lane_value='vehicle_count',
+                                                      phase_list={self.intersection_id: self.phase_list})
+        action = self.rule_controller.choose_action(self.env.get_snapshot())
+        return action[self.env.lane_index.row[self.intersection_id]]
+
+    def compiled_update(self):
+        if self.update is None:
+            self.update = CompiledQUpdate(self.model, self.target_model, self.learning_rate, double=self.double)
+        return self.update
+
+    def replay_compiled(self):
+        '''
+        update_steps batches sampled at once, trained with update_steps session calls of the compiled update
+        '''
+        with self.profiler.section('sample'):
+            states, actions, rewards, next_states, discounts, index, weights = self.memory.sample_weighted(self.update_steps * self.batch_size)
+
+        with self.profiler.section('fit'):
+            td_errors = self.compiled_update().run([states], [next_states], actions, rewards, discounts, weights, self.update_steps)
+            self.memory.update_priorities(index, td_errors)
+
+        if self.epsilon > self.epsilon_min:
+            self.epsilon *= self.epsilon_decay
 
     def replay(self):
-        minibatch = random.sample(self.memory, self.batch_size)
-        states = []
-        q_targets = []
-        for state, action, reward, next_state in minibatch:
-            target = (reward + self.gamma *
-                      np.amax(self.target_model.predict(next_state)[0]))
-            target_f = self.model.predict(state)
-            target_f[0][action] = target # action is a action_list index
-
-            states.append(state)
-            q_targets.append(target_f)
-
-            # self.model.fit(state, target_f, epochs=1, verbose=0)
-        
-        states = np.reshape(np.array(states), [-1, self.state_size])
-        q_targets = np.reshape(np.array(q_targets), [-1, self.action_size])
-        self.model.fit(state, target_f, epochs=2, verbose=0) # batch training
+        if self.update_steps > 0:
+            return self.replay_compiled()
+        with self.profiler.section('sample'):
+            states, actions, rewards, next_states, discounts, index, weights = self.memory.sample_weighted(self.batch_size)
+        batch_index = np.arange(len(actions))
+
+        with self.profiler.section('targets'):
+            q_next = self.target_model.predict(next_states, batch_size=len(next_states))
+            q_targets = self.model.predict(states, batch_size=len(states))
+            targets = rewards + discounts * np.amax(q_next, axis=1)
+            td_errors = targets - q_targets[batch_index, actions]
+            q_targets[batch_index, actions] = targets # action is a action_list index
+
+        with self.profiler.section('fit'):
+            # weights: importance sampling weights of prioritized replay, None for uniform replay
+            self.model.fit(states, q_targets, batch_size=len(states), epochs=2, verbose=0, sample_weight=weights) # batch training
+            self.memory.update_priorities(index, td_errors)
 
         if self.epsilon > self.epsilon_min:
             self.epsilon *= self.epsilon_decay
@@ -109,91 +149,334 @@ class DQNAgent(object):
         self.model.save_weights(name)
         print("model saved:{}".format(name))
 
+    def export(self, path, state_feature='vehicle_count'):
+        '''
+        weights of the Q network to an .npz file for numpy_policy.NumpyPolicy.
+        state_feature: start lane count of the states it was trained on, 'vehicle_count' for CityFlowEnv
+        '''
+        save_policy(path, 'mlp', self.model.get_weights(), phase_list=self.phase_list, state_feature=state_feature)
+
 
 class DDQNAgent(DQNAgent):
-    def __init__(self, config):
-        super(DDQNAgent, self).__init__(config)
+    double = True
 
     # override
     def replay(self):
-        minibatch = random.sample(self.memory, self.batch_size)
-        states = []
-        q_targets = []
-        for state, action, reward, next_state in minibatch:
+        if self.update_steps > 0:
+            return self.replay_compiled()
+        with self.profiler.section('sample'):
+            states, actions, rewards, next_states, discounts, index, weights = self.memory.sample_weighted(self.batch_size)
+        batch_index = np.arange(len(actions))
+
+        with self.profiler.section('targets'):
+            # one pass of the current Q network over states and next states
+            q_values = self.model.predict(np.concatenate([states, next_states]), batch_size=2 * len(states))
+            q_targets, q_next = q_values[:len(states)], q_values[len(states):]
+
             # compute target value, this is the key point of Double DQN
-            
-            # target
-            target_f = self.model.predict(state)
-
-            # choose best action for next state using current Q network
-            actions_for_next_state = np.argmax(self.model.predict(next_state)[0])
-            
-            # compute target value
-            target = (reward + self.gamma *
-                      self.target_model.predict(next_state)[0][actions_for_next_state] )
-            
-            target_f[0][action] = target
-
-            states.append(state)
-            q_targets.append(target_f)
-            # self.model.fit(state, target_f, epochs=1, verbose=0) # train on single sample
-
-        states = np.reshape(np.array(states), [-1, self.state_size])
-        q_targets = np.reshape(np.array(q_targets), [-1, self.action_size])
-        self.model.fit(state, target_f, epochs=1, verbose=0) # batch training
+            # choose best action for next state using current Q network, evaluate it with the target network
+            actions_for_next_state = np.argmax(q_next, axis=1)
+            q_next_target = self.target_model.predict(next_states, batch_size=len(next_states))
+            targets = rewards + discounts * q_next_target[batch_index, actions_for_next_state]
+            td_errors = targets - q_targets[batch_index, actions]
+            q_targets[batch_index, actions] = targets
+
+        with self.profiler.section('fit'):
+            self.model.fit(states, q_targets, batch_size=len(states), epochs=1, verbose=0, sample_weight=weights) # batch training
+            self.memory.update_priorities(index, td_errors)
         
         if self.epsilon > self.epsilon_min:
-            self.epsilon = self.epsilon_decay
+            self.epsilon *= self.epsilon_decay
+
+class SharedDQNAgent(DQNAgent):
+    '''
+    one Q network shared by a group of intersections with the same state/action shape,
+    the intersection is an extra embedding input of the network
+    '''
+    def __init__(self,
+            intersection_id,
+            state_size=9,
+            action_size=8,
+            batch_size=32,
+            phase_list={},
+            env=None,
+            memory_size=3000,
+            embedding_size=8,
+            prioritized=False,
+            update_steps=0
+            ):
+        self.num_intersections = len(intersection_id)
+        self.embedding_size = embedding_size
+        super(SharedDQNAgent, self).__init__(intersection_id,
+                                            state_size=state_size,
+                                            action_size=action_size,
+                                            batch_size=batch_size,
+                                            phase_list=phase_list,
+                                            env=env,
+                                            memory_size=memory_size,
+                                            update_steps=update_steps)
+        self.memory = {id_: make_replay_buffer(memory_size, state_size, prioritized) for id_ in intersection_id}
+
+    def _build_model(self):
+        state = Input(shape=(self.state_size,))
+        intersection = Input(shape=(1,), dtype='int32')
+        embedding = Flatten()(Embedding(self.num_intersections, self.embedding_size)(intersection))
+        hidden = Concatenate()([state, embedding])
+        hidden = Dense(40, activation='relu')(hidden)
+        hidden = Dense(40, activation='relu')(hidden)
+        q_values = Dense(self.action_size, activation='linear')(hidden)
+        model = Model(inputs=[state, intersection], outputs=q_values)
+        model.compile(loss='mse',
+                      optimizer=Adam(lr=self.learning_rate))
+        return model
+
+    def export(self, path):
+        '''
+        embedding and Dense weights, the intersection input of NumpyPolicy is the index in intersection_id
+        '''
+        save_policy(path, 'embedding_mlp', self.model.get_weights(), intersection_id=self.intersection_id,
+                    state_feature='waiting_vehicle_count')
+
+    def remember(self, state, action, reward, next_state, discount=None):
+        '''
+        state, action, reward, next_state: {intersection_id: value, ...}, only this group's ids are used
+        '''
+        discount = self.gamma if discount is None else discount
+        for id_ in self.intersection_id:
+            self.memory[id_].append(state[id_],
+                                    self.phase_list[id_].index(action[id_]),
+                                    reward[id_],
+                                    next_state[id_],
+                                    discount)
+
+    def choose_action(self, state):
+        '''
+        state: {intersection_id: state, ...}, one batched forward pass for the whole group
+        '''
+        states = np.reshape(np.array([state[id_] for id_ in self.intersection_id]), [-1, self.state_size])
+        intersections = np.arange(self.num_intersections).reshape(-1, 1)
+        act_values = self.model.predict([states, intersections], batch_size=len(states))
+        action = np.argmax(act_values, axis=1)
+
+        explore = np.random.rand(self.num_intersections) <= self.epsilon
+        action[explore] = np.random.randint(0, self.action_size, size=explore.sum())
+        return dict(zip(self.intersection_id, action.tolist()))
+
+    def replay_compiled(self):
+        '''
+        update_steps * batch_size transitions of every intersection, every step of the compiled update
+        trains on batch_size of each
+        '''
+        num_steps = self.update_steps
+        with self.profiler.section('sample'):
+            batch = [self.memory[id_].sample_weighted(num_steps * self.batch_size) for id_ in self.intersection_id]
+            states, actions, rewards, next_states, discounts = [np.concatenate(x) for x in list(zip(*batch))[:5]]
+            weights = None if batch[0][6] is None else np.concatenate([b[6] for b in batch])
+            intersections = np.repeat(np.arange(self.num_intersections), num_steps * self.batch_size).reshape(-1, 1)
+            # intersection major to step major
+            order = np.arange(len(actions)).reshape(self.num_intersections, num_steps, self.batch_size).transpose(1, 0, 2).ravel()
+
+        with self.profiler.section('fit'):
+            td_errors = np.empty(len(actions), dtype=np.float32)
+            td_errors[order] = self.compiled_update().run([states[order], intersections[order]],
+                                                          [next_states[order], intersections[order]],
+                                                          actions[order], rewards[order], discounts[order],
+                                                          None if weights is None else weights[order], num_steps)
+            for k, id_ in enumerate(self.intersection_id):
+                self.memory[id_].update_priorities(batch[k][5], td_errors[k * num_steps * self.batch_size:(k + 1) * num_steps * self.batch_size])
+
+        if self.epsilon > self.epsilon_min:
+            self.epsilon *= self.epsilon_decay
+
+    def replay(self):
+        '''
+        batch_size transitions of every intersection, trained in one joint fit
+        '''
+        if self.update_steps > 0:
+            return self.replay_compiled()
+        with self.profiler.section('sample'):
+            batch = [self.memory[id_].sample_weighted(self.batch_size) for id_ in self.intersection_id]
+            states, actions, rewards, next_states, discounts = [np.concatenate(x) for x in list(zip(*batch))[:5]]
+            index = [b[5] for b in batch]
+            weights = None if batch[0][6] is None else np.concatenate([b[6] for b in batch])
+        intersections = np.repeat(np.arange(self.num_intersections), self.batch_size).reshape(-1, 1)
+        batch_index = np.arange(len(actions))
+
+        with self.profiler.section('targets'):
+            q_next = self.target_model.predict([next_states, intersections], batch_size=len(next_states))
+            q_targets = self.model.predict([states, intersections], batch_size=len(states))
+            targets = rewards + discounts * np.amax(q_next, axis=1)
+            td_errors = targets - q_targets[batch_index, actions]
+            q_targets[batch_index, actions] = targets
+
+        with self.profiler.section('fit'):
+            self.model.fit([states, intersections], q_targets, batch_size=len(states), epochs=2, verbose=0, sample_weight=weights) # batch training
+            for k, id_ in enumerate(self.intersection_id):
+                self.memory[id_].update_priorities(index[k], td_errors[k * self.batch_size:(k + 1) * self.batch_size])
+
+        if self.epsilon > self.epsilon_min:
+            self.epsilon *= self.epsilon_decay
 
 class MDQNAgent(object):
+    '''
+    behavior_policy: how choose_action acts, with or without share_params. 'rule': the phase with the most
+    vehicles on its start lanes (MaxQueueController), 'network': epsilon greedy actions of the Q networks
+    '''
     def __init__(self,
         intersection, 
         state_size=17,
         batch_size=32,
         phase_list={},
-        env=None):
+        env=None,
+        memory_size=3000,
+        share_params=False,
+        prioritized=False,
+        update_steps=0,
+        behavior_policy='rule'):
         
+        assert behavior_policy in ('rule', 'network'), "unknown behavior_policy: {}".format(behavior_policy)
         self.intersection = intersection
+        self.share_params = share_params
+        self.behavior_policy = behavior_policy
+        self.phase_list = phase_list # {id_: [phase, ...]}
+        self.prioritized = prioritized # prioritized replay for every agent
+        self.update_steps = update_steps # compiled update steps per replay of every agent, 0: keras fit
+        self.env = env
+        self.rule_controller = None # built by choose_action on first use
         self.agents =  {}
-        self.make_agents(intersection, state_size, batch_size, phase_list, env)
+        if share_params:
+            self.make_shared_agents(intersection, state_size, batch_size, phase_list, env, memory_size)
+        else:
+            self.make_agents(intersection, state_size, batch_size, phase_list, env, memory_size)
+        self.gamma = self.agents[intersection[0]].gamma # same discount rate for every agent
 
-    def make_agents(self, intersection, state_size, batch_size, phase_list, env):
+    def make_agents(self, intersection, state_size, batch_size, phase_list, env, memory_size):
         for id_ in self.intersection: 
             self.agents[id_] = DQNAgent(id_, 
                                 state_size=state_size,
                                 action_size=len(phase_list[id_]),
                                 batch_size=batch_size,
                                 phase_list=phase_list[id_],
-                                env=env
+                                env=env,
+                                memory_size=memory_size,
+                                prioritized=self.prioritized,
+                                update_steps=self.update_steps
+                                )
+
+    def make_shared_agents(self, intersection, state_size, batch_size, phase_list, env, memory_size):
+        '''
+        one SharedDQNAgent for every group of intersections with the same action size
+        '''
+        groups = {} # {action_size: [id_, ...]}
+        for id_ in self.intersection:
+            groups.setdefault(len(phase_list[id_]), []).append(id_)
+        self.shared_agents = {}
+        for action_size, ids in groups.items():
+            agent = SharedDQNAgent(ids,
+                                state_size=state_size,
+                                action_size=action_size,
+                                batch_size=batch_size,
+                                phase_list={id_: phase_list[id_] for id_ in ids},
+                                env=env,
+                                memory_size=memory_size,
+                                prioritized=self.prioritized,
+                                update_steps=self.update_steps
                                 )
+            self.shared_agents[action_size] = agent
+            for id_ in ids:
+                self.agents[id_] = agent
+
+    def set_profiler(self, profiler):
+        for agent in self.agents.values():
+            agent.profiler = profiler
+
+    def memory_len(self):
+        '''
+        number of transitions stored for the first intersection
+        '''
+        id_ = self.intersection[0]
+        memory = self.agents[id_].memory
+        return len(memory[id_]) if self.share_params else len(memory)
 
     def update_target_network(self):
+        if self.share_params:
+            for agent in self.shared_agents.values():
+                agent.update_target_network()
+            return
         for id_ in self.intersection:
             self.agents[id_].update_target_network()
 
-    def remember(self, state, action, reward, next_state):
+    def remember(self, state, action, reward, next_state, discount=None):
+        if self.share_params:
+            for agent in self.shared_agents.values():
+                agent.remember(state, action, reward, next_state, discount)
+            return
         for id_ in self.intersection:
             self.agents[id_].remember(state[id_],
                                     action[id_],
                                     reward[id_],
-                                    next_state[id_])
+                                    next_state[id_],
+                                    discount)
     
+    def set_epsilon(self, epsilon):
+        '''
+        exploration rate of every agent, 0 for greedy actions of loaded checkpoints
+        '''
+        for agent in self.agents.values():
+            agent.epsilon = epsilon
+
     def choose_action(self, state):
         action = {}
+        if self.behavior_policy == 'network':
+            if self.share_params:
+                for agent in self.shared_agents.values():
+                    action.update(agent.choose_action(state))
+                return action
+            for id_ in self.intersection:
+                action[id_] = self.agents[id_].choose_action(state[id_])
+            return action
+        if self.rule_controller is None:
+            self.rule_controller = MaxQueueController(self.env.lane_phase_info, self.env.lane_index, lane_value='vehicle_count',
+                                                      phase_list=self.phase_list)
+        index = self.rule_controller.choose_action(self.env.get_snapshot()) # all intersections at once
         for id_ in self.intersection:
-            action[id_] = self.agents[id_].choose_action_(state[id_])
+            action[id_] = index[self.env.lane_index.row[id_]]
         return action
 
     def replay(self):
+        if self.share_params:
+            for agent in self.shared_agents.values():
+                agent.replay()
+            return
         for id_ in self.intersection:
             self.agents[id_].replay()
 
     def load(self, name):
+        if self.share_params:
+            for action_size, agent in self.shared_agents.items():
+                ckpt = name + '.shared_{}'.format(action_size)
+                assert os.path.exists(ckpt), "Wrong checkpoint, file not exists!"
+                agent.load(ckpt)
+            return
         for id_ in self.intersection:
             assert os.path.exists(name + '.' + id_), "Wrong checkpoint, file not exists!"
             self.agents[id_].load(name + '.' + id_)
 
     def save(self, name):
+        if self.share_params:
+            for action_size, agent in self.shared_agents.items():
+                agent.save(name + '.shared_{}'.format(action_size))
+            return
         for id_ in self.intersection:
             self.agents[id_].save(name + '.' + id_)
 
+    def export(self, name):
+        '''
+        one NumpyPolicy file per agent, named like the checkpoint files plus .npz
+        '''
+        if self.share_params:
+            for action_size, agent in self.shared_agents.items():
+                agent.export(name + '.shared_{}.npz'.format(action_size))
+            return
+        for id_ in self.intersection:
+            self.agents[id_].export(name + '.' + id_ + '.npz', state_feature='waiting_vehicle_count') # CityFlowEnvM states
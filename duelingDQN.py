@@ -5,14 +5,16 @@ Dueling DQN implementation using tensorflow
 import tensorflow as tf
 import numpy as np
 import random 
-from collections import deque
 import copy
+from replay_buffer import make_replay_buffer
+from profiler import Profiler
+from numpy_policy import save_policy
 
 class DuelingDQNAgent(object):
     def __init__(self, config):
         self.state_size = config['state_size']
         self.action_size = config['action_size']
-        self.memory = deque(maxlen=2000)
+        self.memory = make_replay_buffer(config.get('memory_size', 2000), self.state_size, config.get('prioritized', False))
         self.gamma = 0.95 # discount factor
         self.epsilon = 1.0 # exploration rate 
         self.epsilon_min = 0.01
@@ -26,9 +28,13 @@ class DuelingDQNAgent(object):
                             'V':[1],
                             'A':[20, self.action_size]}
         self.global_step = 0
+        self.summary_freq = config.get('summary_freq', 100) # replays between two TensorBoard summaries
+        self.update_steps = max(1, config.get('update_steps', 1)) # gradient steps per replay, on as many batches sampled at once
 
         
-        self.sess = tf.Session(config=tf.ConfigProto(device_count={'gpu':0}))
+        self.sess = tf.Session(config=tf.ConfigProto(device_count={'gpu':0},
+                                                     intra_op_parallelism_threads=config.get('intra_op_threads', 0),
+                                                     inter_op_parallelism_threads=config.get('inter_op_threads', 0)))
         self.sess.__enter__()
         
         self._build_model()
@@ -40,11 +46,15 @@ class DuelingDQNAgent(object):
 
         intersection_id = list(config['lane_phase_info'].keys())[0]
         self.phase_list = config['lane_phase_info'][intersection_id]['phase']
+        self.profiler = Profiler() # disabled, the training loop may replace it
     
     def _build_model(self):
         self.state = tf.placeholder(tf.float32, [None, ] + [self.state_size], name='state')
         self.state_ = tf.placeholder(tf.float32, [None, ] + [self.state_size], name='state_')
-        self.q_target = tf.placeholder(tf.float32, [None, ] + [self.action_size], name='q_target')
+        self.action = tf.placeholder(tf.int32, [None, ], name='action') # action_list index
+        self.reward = tf.placeholder(tf.float32, [None, ], name='reward')
+        self.discount = tf.placeholder(tf.float32, [None, ], name='discount') # gamma ** n of the n-step return
+        self.is_weights = tf.placeholder_with_default(tf.ones_like(self.reward), [None, ], name='is_weights') # importance sampling weights of prioritized replay
         
         # with tf.variable_scope('qnet'):
         #     pass
@@ -55,16 +65,24 @@ class DuelingDQNAgent(object):
         self.qmodel_output = self._build_network('qnet', self.state, self.layer_size)
         self.targte_model_output = self._build_network('target', self.state_, self.layer_size)
         
+        # TD target from the target network, computed in the graph so one update is one sess.run
+        with tf.variable_scope('q_target'):
+            self.q_target = tf.stop_gradient(self.reward + self.discount * tf.reduce_max(self.targte_model_output, axis=1))
+        with tf.variable_scope('q_eval'):
+            batch_index = tf.range(tf.shape(self.action)[0])
+            self.q_eval = tf.gather_nd(self.qmodel_output, tf.stack([batch_index, self.action], axis=1))
+
         # loss, and other operations
         with tf.variable_scope('loss'):
-            self.q_loss = tf.reduce_mean(tf.squared_difference(self.qmodel_output, self.q_target))
+            self.td_error = self.q_target - self.q_eval # new priorities of the sampled transitions
+            self.q_loss = tf.reduce_mean(self.is_weights * tf.squared_difference(self.q_eval, self.q_target))
             tf.summary.scalar('Q net TD loss', self.q_loss)
         with tf.variable_scope('train'):
             self.train_op = tf.train.AdamOptimizer(self.learning_rate).minimize(self.q_loss)
         
         # replace target net with q net
-        self.q_net_params = tf.get_collection('qnet')
-        self.target_net_paprams = tf.get_collection('target')
+        self.q_net_params = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='qnet')
+        self.target_net_paprams = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope='target')
         self.copy_target_op = [tf.assign(t, q) for t, q in zip(self.target_net_paprams, self.q_net_params)]
         self.merged = tf.summary.merge_all()
         
@@ -111,37 +129,51 @@ class DuelingDQNAgent(object):
         q_values = tf.get_default_session().run(self.qmodel_output, feed_dict={self.state: state})
         return np.argmax(q_values[0])
 
-    def replay(self):
-        minibatch = random.sample(self.memory, self.batch_size)
-        states = []
-        q_target = []
-        for state, action, reward, next_state in minibatch:
-            states.append(state)
-            q_eval = tf.get_default_session().run(self.qmodel_output, feed_dict={self.state:state})
-            q_next = tf.get_default_session().run(self.targte_model_output, feed_dict={self.state_:next_state})
-
-            target_value = reward + self.gamma * np.max(q_next)
-            # q_target_ = copy.copy(q_eval)
-            q_target_ = q_eval.copy()
-            q_target_[0][action] = target_value
-            q_target.append(q_target_)
-        
-        states = np.reshape(np.array(states), [-1, self.state_size])
-        q_target = np.reshape(np.array(q_target), [-1, self.action_size])
+    def choose_actions(self, states):
+        '''
+        epsilon greedy actions for a batch of states (num_states, state_size), one forward pass
+        '''
+        q_values = tf.get_default_session().run(self.qmodel_output, feed_dict={self.state: states})
+        actions = np.argmax(q_values, axis=1)
+        explore = np.random.rand(len(states)) <= self.epsilon
+        actions[explore] = np.random.randint(0, self.action_size, size=explore.sum())
+        return actions
 
-        feed_dict = {self.state:states,
-                    self.q_target:q_target}
-        # batch training
-        _, summary= tf.get_default_session().run([self.train_op, self.merged], feed_dict=feed_dict)
-        self.file_writer.add_summary(summary)
+    def replay(self):
+        with self.profiler.section('sample'):
+            states, actions, rewards, next_states, discounts, index, weights = self.memory.sample_weighted(self.update_steps * self.batch_size)
+
+        td_errors = []
+        for k in range(self.update_steps):
+            part = slice(k * self.batch_size, (k + 1) * self.batch_size)
+            feed_dict = {self.state:states[part],
+                        self.state_:next_states[part],
+                        self.action:actions[part],
+                        self.reward:rewards[part],
+                        self.discount:discounts[part]}
+            if weights is not None:
+                feed_dict[self.is_weights] = weights[part]
+            self.global_step += 1
+            # batch training, targets and loss are computed in the same run
+            with self.profiler.section('fit'):
+                if self.global_step % self.summary_freq == 0:
+                    _, td_error, summary = tf.get_default_session().run([self.train_op, self.td_error, self.merged], feed_dict=feed_dict)
+                else:
+                    _, td_error = tf.get_default_session().run([self.train_op, self.td_error], feed_dict=feed_dict)
+                    summary = None
+            td_errors.append(td_error)
+            if summary is not None:
+                with self.profiler.section('io'):
+                    self.file_writer.add_summary(summary, self.global_step)
+        self.memory.update_priorities(index, np.concatenate(td_errors))
 
     
     def update_target_network(self):
         tf.get_default_session().run(self.copy_target_op)
     
-    def remember(self, state, action, reward, next_state):
+    def remember(self, state, action, reward, next_state, discount=None):
         action = self.phase_list.index(action)
-        self.memory.append((state, action, reward, next_state))
+        self.memory.append(state, action, reward, next_state, self.gamma if discount is None else discount)
     
     def save(self, ckpt, epoch):
         self.saver.save(self.sess, ckpt, global_step=epoch)
@@ -149,6 +181,13 @@ class DuelingDQNAgent(object):
 
     def load(self, ckpt):
         self.saver.restore(self.sess, ckpt)
+
+    def export(self, path):
+        '''
+        weights of the Q network to an .npz file for numpy_policy.NumpyPolicy
+        '''
+        save_policy(path, 'dueling', self.sess.run(self.q_net_params), phase_list=self.phase_list,
+                    state_feature='vehicle_count', layers=[len(self.layer_size[key]) for key in ['shared', 'V', 'A']])
         
 
 
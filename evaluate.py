@@ -0,0 +1,238 @@
+'''
+evaluate checkpoints and baseline controllers on several scenarios and seeds with a process pool,
+one table of travel time, throughput, queue and score
+'''
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import time
+from datetime import datetime
+import numpy as np
+
+from cityflow_env import CityFlowEnvM
+from utility import parse_roadnet
+from controllers import MaxQueueController, MaxPressureController, FixedTimeController
+from numpy_policy import NumpyPolicy
+from metrics import MetricsWriter
+
+BASELINES = ['max_queue', 'max_pressure', 'fixed_time']
+COLUMNS = ['travel_time', 'throughput', 'queue', 'score']
+
+class ControllerPolicy(object):
+    '''
+    phases of a baseline controller, fixed time decides every second
+    '''
+    def __init__(self, name, env, phase_step):
+        if name == 'fixed_time':
+            self.controller = FixedTimeController(env.lane_index)
+            self.phase_step = 1
+        else:
+            controller = MaxQueueController if name == 'max_queue' else MaxPressureController
+            self.controller = controller(env.lane_phase_info, env.lane_index)
+            self.phase_step = phase_step
+
+    def __call__(self, env):
+        phases = self.controller.choose_phases(env.get_snapshot())
+        return dict(zip(env.lane_index.intersection_id, phases.tolist()))
+
+class AgentPolicy(object):
+    '''
+    greedy actions of the Q networks of a checkpoint: MDQN (<ckpt>.<intersection_id> files),
+    MDQN --share_params (<ckpt>.shared_<action_size> files) or a single DQN/DDQN file used for
+    every intersection. the single file was trained on CityFlowEnv, so its states are the vehicle
+    counts of the start lanes, the MDQN states are the waiting vehicle counts
+    '''
+    def __init__(self, ckpt, env, phase_step, threads=1):
+        import tensorflow as tf
+        import keras.backend as K
+        from dqn_agent import MDQNAgent # keras only in the workers that evaluate checkpoints
+        K.clear_session() # drop the models of the previous checkpoint
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                       inter_op_parallelism_threads=threads)))
+        self.share_params = len(glob.glob(ckpt + '.shared_*')) > 0
+        self.agent = MDQNAgent(env.intersection_id,
+                               state_size=env.state_size,
+                               phase_list=env.phase_list,
+                               env=env,
+                               share_params=self.share_params,
+                               behavior_policy='network')
+        self.state_feature = 'waiting_vehicle_count'
+        if self.share_params or not os.path.isfile(ckpt):
+            self.agent.load(ckpt)
+        else:
+            for agent in self.agent.agents.values():
+                agent.load(ckpt)
+            self.state_feature = 'vehicle_count' # CityFlowEnv.get_state
+        self.agent.set_epsilon(0)
+        self.phase_step = phase_step
+
+    def __call__(self, env):
+        state = env.get_state(self.state_feature)
+        if self.share_params:
+            action = self.agent.choose_action(state)
+        else:
+            action = {id_: self.agent.agents[id_].choose_action(state[id_]) for id_ in env.intersection_id}
+        return {id_: env.phase_list[id_][a] for id_, a in action.items()}
+
+class NumpyAgentPolicy(object):
+    '''
+    greedy actions of exported networks (numpy_policy), no TensorFlow in the worker. <ckpt>.npz is either
+    one file used for every intersection, or the stem of the files of MDQNAgent.export():
+    <stem>.shared_<action_size>.npz or <stem>.<intersection_id>.npz.
+    states are built from the state_feature of each file, files without it are from before it was
+    exported: a single mlp or dueling file is a run_rl_control (CityFlowEnv, vehicle counts) export
+    '''
+    def __init__(self, ckpt, env, phase_step):
+        stem = ckpt[:-len('.npz')]
+        self.groups = [] # [(policy, [id_, ...], intersection indices for the shared network or None)]
+        if os.path.isfile(ckpt):
+            policy = NumpyPolicy(ckpt)
+            ids = list(env.intersection_id)
+            indices = [policy.intersection_id.index(id_) for id_ in ids] if policy.intersection_id else None
+            if policy.state_feature is None and policy.kind != 'embedding_mlp':
+                policy.state_feature = 'vehicle_count'
+            self.groups.append((policy, ids, indices))
+        elif glob.glob(stem + '.shared_*.npz'):
+            for path in glob.glob(stem + '.shared_*.npz'):
+                policy = NumpyPolicy(path)
+                self.groups.append((policy, policy.intersection_id, list(range(len(policy.intersection_id)))))
+        else:
+            for id_ in env.intersection_id:
+                self.groups.append((NumpyPolicy(stem + '.' + id_ + '.npz'), [id_], None))
+        self.phase_step = phase_step
+
+    def __call__(self, env):
+        states = {} # {state_feature: states of all intersections}
+        phases = {}
+        for policy, ids, indices in self.groups:
+            feature = policy.state_feature or 'waiting_vehicle_count'
+            if feature not in states:
+                states[feature] = env.get_state(feature)
+            state = states[feature]
+            action = policy.choose_actions(np.concatenate([state[id_] for id_ in ids]), indices) # one pass per network
+            phases.update({id_: env.phase_list[id_][a] for id_, a in zip(ids, action)})
+        return phases
+
+def run_episode(env, policy, num_step):
+    '''
+    num_step seconds from the initial state of the env, return travel time, throughput (vehicles that left
+    the roadnet), queue (waiting vehicles on the start lanes of an intersection) and score, both mean per intersection and second
+    '''
+    seen = set()
+    queue = 0
+    score = 0
+    for t in range(num_step):
+        if t % policy.phase_step == 0:
+            action = policy(env)
+        env._next_step(action)
+        snapshot = env.get_snapshot()
+        seen.update(snapshot.vehicle_speed) # ids of the running vehicles
+        queue += snapshot.lane_view('waiting_vehicle_count', 'start').sum(axis=1).mean()
+        score += env._score_array().mean()
+    return {'travel_time': env.eng.get_average_travel_time(),
+            'throughput': len(seen) - len(env.get_snapshot().vehicle_speed),
+            'queue': queue / num_step,
+            'score': score / num_step}
+
+_worker = {} # env and policy of the current scenario and checkpoint of a worker process
+
+def _init_worker(settings):
+    _worker.clear()
+    _worker['settings'] = settings
+
+def _evaluate(task):
+    '''
+    task: (checkpoint, scenario, seed), the env is rebuilt only when the scenario changes
+    and the policy when the checkpoint changes
+    '''
+    ckpt, scenario, seed = task
+    settings = _worker['settings']
+    if _worker.get('scenario') != scenario:
+        cityflow_config = json.load(open(scenario))
+        lane_phase_info = parse_roadnet(cityflow_config['dir'] + cityflow_config['roadnetFile'])
+        env = CityFlowEnvM(lane_phase_info,
+                           list(lane_phase_info.keys()),
+                           num_step=settings['num_step'] // settings['phase_step'],
+                           thread_num=settings['thread_num'],
+                           cityflow_config_file=scenario)
+        env.eng.set_save_replay(False)
+        _worker.update(scenario=scenario, env=env, initial=env.snapshot(), ckpt=None)
+    env = _worker['env']
+    if _worker['ckpt'] != ckpt:
+        if ckpt in BASELINES:
+            policy = ControllerPolicy(ckpt, env, settings['phase_step'])
+        elif ckpt.endswith('.npz'):
+            policy = NumpyAgentPolicy(ckpt, env, settings['phase_step'])
+        else:
+            policy = AgentPolicy(ckpt, env, settings['phase_step'], settings['thread_num'])
+        _worker.update(ckpt=ckpt, policy=policy)
+
+    start = time.time()
+    env.restore(_worker['initial']) # same start for every task, whatever ran before in this worker
+    env.eng.set_random_seed(seed)
+    result = run_episode(env, _worker['policy'], settings['num_step'])
+    result.update(checkpoint=ckpt, scenario=scenario, seed=seed, seconds=time.time() - start)
+    return result
+
+def evaluate(checkpoints, scenarios, seeds, settings, num_workers=1):
+    '''
+    evaluate every checkpoint (or baseline name) on every scenario (cityflow config file) and seed,
+    yield one result dict per run as they finish
+    '''
+    # scenario major order, consecutive tasks of a worker reuse its env and policy
+    tasks = [(ckpt, scenario, seed) for scenario in scenarios for ckpt in checkpoints for seed in seeds]
+    if num_workers <= 1:
+        _init_worker(settings)
+        for task in tasks:
+            yield _evaluate(task)
+        return
+    ctx = mp.get_context('spawn') # TensorFlow is not safe to fork
+    with ctx.Pool(num_workers, initializer=_init_worker, initargs=(settings,)) as pool:
+        for result in pool.imap_unordered(_evaluate, tasks, chunksize=max(1, len(tasks) // (4 * num_workers))):
+            yield result
+
+def main():
+    date = datetime.now().strftime('%Y%m%d_%H%M%S')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt', type=str, nargs='+', required=True,
+                        help='checkpoints (MDQN, MDQN --share_params or DQN/DDQN .h5, exported .npz) or baselines: {}'.format(', '.join(BASELINES)))
+    parser.add_argument('--scenarios', type=str, nargs='+', default=None, help='cityflow config files, the one of --config by default')
+    parser.add_argument('--config', type=str, default='config/global_config_multi.json', help='config file')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='engine random seeds')
+    parser.add_argument('--num_step', type=int, default=3600, help='seconds of every evaluation episode')
+    parser.add_argument('--phase_step', type=int, default=15, help='seconds of one phase')
+    parser.add_argument('--num_workers', type=int, default=mp.cpu_count(), help='evaluation processes, one engine each')
+    parser.add_argument('--thread_num', type=int, default=1, help='engine (and TensorFlow) threads of every worker')
+    parser.add_argument('--output', type=str, default=None, help='results table, result/eval_<date> by default')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios or [json.load(open(args.config))['cityflow_config_file']]
+    output = args.output or 'result/eval_{}'.format(date)
+    if not os.path.exists(os.path.dirname(output) or '.'):
+        os.makedirs(os.path.dirname(output))
+    settings = {'num_step': args.num_step, 'phase_step': args.phase_step, 'thread_num': args.thread_num}
+    num_runs = len(args.ckpt) * len(scenarios) * len(args.seeds)
+
+    results = MetricsWriter(output)
+    rows = []
+    for row in evaluate(args.ckpt, scenarios, args.seeds, settings, min(args.num_workers, num_runs)):
+        rows.append(row)
+        results.append(**row)
+        print("[{}/{}] {} {} seed {}: travel time {:.2f}, throughput {}, queue {:.3f}, score {:.5f} ({:.1f}s)".format(
+            len(rows), num_runs, row['checkpoint'], row['scenario'], row['seed'],
+            row['travel_time'], row['throughput'], row['queue'], row['score'], row['seconds']))
+    results.close()
+
+    # mean over the seeds
+    print('\n{:<40} {:<40} {:>12} {:>12} {:>10} {:>10}'.format('checkpoint', 'scenario', *COLUMNS))
+    for scenario in scenarios:
+        for ckpt in args.ckpt:
+            runs = [row for row in rows if row['checkpoint'] == ckpt and row['scenario'] == scenario]
+            mean = [np.mean([row[key] for row in runs]) for key in COLUMNS]
+            print('{:<40} {:<40} {:>12.2f} {:>12.1f} {:>10.3f} {:>10.5f}'.format(ckpt, scenario, *mean))
+    print("results: {}".format(results.path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Append-only columnar sink for training metrics
+"""
+
+import importlib.util
+import os
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None # otherwise append csv chunks
+
+def _pyarrow():
+    # imported by the first Parquet write only, pyarrow is slow to import
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    return pa, pq
+
+class MetricsWriter(object):
+    '''
+    records (rows of scalar columns) are buffered in memory and written every chunk_size rows,
+    nothing is ever rewritten. with pyarrow every chunk is a new Parquet file in the directory
+    'path' (a readable dataset even if training is killed), otherwise rows are appended to 'path'.csv.
+    all records of one writer must have the same columns
+    '''
+    def __init__(self, path, chunk_size=10000):
+        self.chunk_size = chunk_size
+        self.columns = None # {name: [values]}
+        self.num_buffered = 0
+        if HAS_PYARROW:
+            self.path = path
+            if not os.path.exists(path):
+                os.makedirs(path)
+            self.num_chunks = len(os.listdir(path)) # continue after the chunks of a previous writer
+        else:
+            self.path = path + '.csv'
+            self.num_chunks = 0
+            self._csv_header = not os.path.exists(self.path)
+
+    def append(self, **record):
+        '''
+        one row, e.g. append(epoch=1, step=10, reward=0.5)
+        '''
+        self.extend(**{key: [value] for key, value in record.items()})
+
+    def extend(self, **columns):
+        '''
+        several rows given column-wise, e.g. extend(step=[1, 1], intersection=['a', 'b'], reward=[0.1, 0.2]),
+        scalar values are repeated for every row
+        '''
+        num_rows = max(len(v) for v in columns.values() if isinstance(v, (list, tuple)))
+        if self.columns is None:
+            self.columns = {key: [] for key in columns}
+        assert set(columns) == set(self.columns), "columns changed: {} -> {}".format(sorted(self.columns), sorted(columns))
+        for key, values in columns.items():
+            if isinstance(values, (list, tuple)):
+                self.columns[key].extend(values)
+            else:
+                self.columns[key].extend([values] * num_rows)
+        self.num_buffered += num_rows
+        if self.num_buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.num_buffered:
+            return
+        if HAS_PYARROW:
+            pa, pq = _pyarrow()
+            table = pa.Table.from_pydict(self.columns)
+            pq.write_table(table, os.path.join(self.path, 'part-{:05d}.parquet'.format(self.num_chunks)))
+        else:
+            keys = list(self.columns)
+            with open(self.path, 'a') as f:
+                if self._csv_header:
+                    f.write(','.join(keys) + '\n')
+                    self._csv_header = False
+                for row in zip(*[self.columns[key] for key in keys]):
+                    f.write(','.join(str(v) for v in row) + '\n')
+        self.columns = {key: [] for key in self.columns}
+        self.num_buffered = 0
+        self.num_chunks += 1
+
+    def close(self):
+        self.flush()
+
+def read_metrics(path):
+    '''
+    pandas DataFrame of everything a MetricsWriter wrote to 'path'
+    '''
+    import pandas as pd
+    if os.path.isdir(path):
+        return pd.read_parquet(path)
+    return pd.read_csv(path + '.csv')
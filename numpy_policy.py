@@ -0,0 +1,95 @@
+"""
+Q networks exported to .npz and evaluated with NumPy only, no TensorFlow import
+"""
+
+import numpy as np
+
+def mlp_forward(weights, states):
+    '''
+    Q values of a stack of Dense layers, relu on all but the last one (DQNAgent._build_model).
+    weights: [W1, b1, W2, b2, ...] as returned by keras model.get_weights()
+    '''
+    x = states
+    for k in range(0, len(weights), 2):
+        x = np.dot(x, weights[k]) + weights[k + 1]
+        if k + 2 < len(weights):
+            x = np.maximum(x, 0)
+    return x
+
+def save_policy(path, kind, weights, **extra):
+    '''
+    kind: 'mlp' (DQNAgent), 'embedding_mlp' (SharedDQNAgent, the embedding is weights[0])
+    or 'dueling' (DuelingDQNAgent, extra layers=[shared, value, advantage] dense layer counts).
+    extra state_feature: start lane count in the states, 'vehicle_count' (CityFlowEnv) or 'waiting_vehicle_count' (CityFlowEnvM)
+    weights are stored in order as weight_0, weight_1, ...
+    '''
+    arrays = {'weight_{}'.format(k): np.asarray(w) for k, w in enumerate(weights)}
+    arrays.update({key: np.asarray(value) for key, value in extra.items()})
+    np.savez(path, kind=kind, num_weights=len(weights), **arrays)
+
+def _linear(weights):
+    # a stack of Dense layers without activation as one (W, b)
+    W, b = weights[0], weights[1]
+    for k in range(2, len(weights), 2):
+        W, b = np.dot(W, weights[k]), np.dot(b, weights[k]) + weights[k + 1]
+    return W, b
+
+class NumpyPolicy(object):
+    '''
+    greedy policy of a network written by an agent's export(). every kind is brought down to
+    Dense layers for mlp_forward when loading: the embedding of a shared network becomes a per
+    intersection bias of the first layer, the linear value and advantage heads of the dueling
+    network become one output layer
+    '''
+    def __init__(self, path):
+        data = np.load(path)
+        self.kind = str(data['kind'])
+        weights = [data['weight_{}'.format(k)].astype(np.float64) for k in range(int(data['num_weights']))]
+        self.phase_list = data['phase_list'].tolist() if 'phase_list' in data else None
+        self.intersection_id = data['intersection_id'].tolist() if 'intersection_id' in data else None
+        self.state_feature = str(data['state_feature']) if 'state_feature' in data else None # None: older files
+        self.embedding_bias = None
+
+        if self.kind == 'mlp':
+            self.weights = weights
+        elif self.kind == 'embedding_mlp':
+            embedding, W = weights[0], weights[1]
+            state_size = W.shape[0] - embedding.shape[1]
+            self.embedding_bias = np.dot(embedding, W[state_size:]) + weights[2] # (num_intersections, hidden)
+            self.weights = [W[:state_size], np.zeros_like(weights[2])] + weights[3:] # first bias is in embedding_bias
+        elif self.kind == 'dueling':
+            num_shared, num_value, _ = [int(n) for n in data['layers']]
+            shared = weights[:2 * num_shared]
+            V_W, V_b = _linear(weights[2 * num_shared:2 * (num_shared + num_value)])
+            A_W, A_b = _linear(weights[2 * (num_shared + num_value):])
+            # Q = V + A - mean(A) is linear in the last shared layer
+            Q_W = V_W + A_W - A_W.mean(axis=1, keepdims=True)
+            Q_b = V_b + A_b - A_b.mean()
+            self.weights = shared + [Q_W, Q_b]
+        else:
+            raise Exception("unknown policy kind: {}".format(self.kind))
+        self.state_size = self.weights[0].shape[0]
+        self.action_size = self.weights[-1].shape[-1]
+
+    def q_values(self, states, intersections=None):
+        '''
+        states: (num_states, state_size), intersections: (num_states,) indices into intersection_id,
+        needed by the shared network only
+        '''
+        states = np.reshape(states, [-1, self.state_size])
+        if self.embedding_bias is None:
+            return mlp_forward(self.weights, states)
+        hidden = np.maximum(np.dot(states, self.weights[0]) + self.embedding_bias[np.ravel(intersections)], 0)
+        return mlp_forward(self.weights[2:], hidden)
+
+    def choose_action(self, state, intersection=None):
+        '''
+        index of the greedy action of one state
+        '''
+        return int(np.argmax(self.q_values(state, None if intersection is None else [intersection])[0]))
+
+    def choose_actions(self, states, intersections=None):
+        '''
+        greedy action indices of a batch of states, one forward pass
+        '''
+        return np.argmax(self.q_values(states, intersections), axis=1)
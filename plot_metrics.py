@@ -0,0 +1,29 @@
+'''
+offline plots of the metrics written during training,
+e.g. python plot_metrics.py result/MDQN_20190803_150924
+'''
+import argparse
+import os
+from metrics import read_metrics
+from utility import plot_data_lists
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('result_dir', type=str, help='result dir of a training run')
+    parser.add_argument('--csv', action="store_true", help='also export rewards.csv and scores.csv')
+    args = parser.parse_args()
+
+    df = read_metrics(os.path.join(args.result_dir, 'episodes'))
+    group = 'intersection' if 'intersection' in df.columns else 'env' # multi / single intersection
+    for column, label in [('reward', 'rewards'), ('score', 'scores')]:
+        table = df.pivot_table(index='epoch', columns=group, values=column)
+        if args.csv:
+            table.to_csv(os.path.join(args.result_dir, label + '.csv'))
+        plot_data_lists([table[key].values for key in table.columns],
+                        ['episode {} {}'.format(column, key) for key in table.columns],
+                        x_label='epoch',
+                        y_label=column,
+                        figure_name=os.path.join(args.result_dir, label + '.pdf'))
+
+if __name__ == '__main__':
+    main()
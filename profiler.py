@@ -0,0 +1,100 @@
+"""
+Opt-in timers and counters for the training loops
+"""
+
+import cProfile
+import time
+from metrics import MetricsWriter
+
+class _Section(object):
+    __slots__ = ['profiler', 'name', 'start']
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        profiler.seconds[self.name] = profiler.seconds.get(self.name, 0.0) + time.perf_counter() - self.start
+        profiler.calls[self.name] = profiler.calls.get(self.name, 0) + 1
+        return False
+
+class _NullSection(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SECTION = _NullSection()
+
+class Profiler(object):
+    '''
+    with profiler.section('env_step'): ... accumulates the seconds and calls of a section,
+    profiler.count('transitions', n) adds to a counter. sections may be nested, their times are inclusive.
+
+    a disabled profiler (the default) only returns a shared no-op context manager.
+    end_episode() prints the breakdown of the episode, appends it to the MetricsWriter at 'path'
+    (columns epoch, name, seconds, count; count is the number of calls of a section or the value of a counter)
+    and starts the next episode. with cprofile, the whole run is also profiled by cProfile
+    and the stats are dumped to that file by close() (view with python -m pstats or snakeviz)
+    '''
+    def __init__(self, enabled=False, path=None, cprofile=None):
+        self.enabled = enabled
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.writer = MetricsWriter(path) if enabled and path else None
+        self.cprofile = cprofile
+        self._profile = None
+        if cprofile:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        self._episode_start = time.perf_counter()
+
+    def section(self, name):
+        if not self.enabled:
+            return _NULL_SECTION
+        return _Section(self, name)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def end_episode(self, epoch):
+        '''
+        report and clear the timers and counters of the finished episode
+        '''
+        if not self.enabled:
+            return
+        total = time.perf_counter() - self._episode_start
+        names = sorted(self.seconds, key=self.seconds.get, reverse=True)
+        print("profile, episode {}: {:.2f}s total, ".format(epoch, total) +
+              ", ".join("{} {:.2f}s/{} ({:.0%})".format(name, self.seconds[name], self.calls[name], self.seconds[name] / total)
+                        for name in names) +
+              "".join(", {} {}".format(name, value) for name, value in sorted(self.counters.items())))
+        if self.writer is not None:
+            self.writer.extend(epoch=epoch,
+                               name=['episode'] + names + sorted(self.counters),
+                               seconds=[total] + [self.seconds[name] for name in names] + [0.0] * len(self.counters),
+                               count=[1] + [self.calls[name] for name in names] + [self.counters[name] for name in sorted(self.counters)])
+            self.writer.flush()
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self._episode_start = time.perf_counter()
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.cprofile)
+            print("cProfile stats saved:{}".format(self.cprofile))
+            self._profile = None
@@ -17,7 +17,7 @@ from datetime import datetime
 from tqdm import tqdm
 import argparse
 import json
-from cityflow_env import CityFlowEnvRay
+from cityflow_env_ray import CityFlowEnvRay
 import cityflow
 
 parser = argparse.ArgumentParser()
@@ -33,6 +33,8 @@ parser.add_argument('--save_freq', type=int, default=50, help='model saving freq
 parser.add_argument('--batch_size', type=int, default=128, help='model saving frequency')
 parser.add_argument('--state_time_span', type=int, default=5, help='state interval to receive long term state')
 parser.add_argument('--time_span', type=int, default=30, help='time interval to collect data')
+parser.add_argument('--num_cpus_per_worker', type=int, default=30, help='CPUs ray reserves for every rollout worker')
+parser.add_argument('--thread_num', type=int, default=0, help='engine threads of every env, 0: the CPUs of its worker')
 
 os.environ["CUDA_VISIBLE_DEVICES"]="0, 1" # use GPU
 
@@ -48,7 +50,7 @@ def generate_config(args):
     config["intersection_id"] = intersection_id
     config["state_time_span"] = args.state_time_span
     config["time_span"] = args.time_span
-    config["thread_num"] = 1
+    config["thread_num"] = args.thread_num
     config["state_time_span"] = args.state_time_span
     config["time_span"] = args.time_span
     # phase_list = config['lane_phase_info'][intersection_id]['phase']
@@ -84,7 +86,7 @@ def main():
             # "num_workers": 2,
             "num_gpus_per_worker":1,
             "sample_batch_size": 4,
-            "num_cpus_per_worker": 30,
+            "num_cpus_per_worker": args.num_cpus_per_worker,
             "train_batch_size": 32,
             "exploration_final_eps": 0.0,
             "num_workers": 1,
@@ -0,0 +1,94 @@
+"""
+Signal phase recording and replay file policy
+"""
+
+import os
+import numpy as np
+
+class PhaseRecorder(object):
+    '''
+    phase of every intersection at every tick of the current episode, in a preallocated int16 array
+    (num_ticks, num_intersections) that doubles when full. reset() starts a new episode,
+    save() writes a compressed .npz, save_signal_plan() the signal_plan.txt table
+    '''
+    def __init__(self, intersection_id, capacity=3600):
+        self.intersection_id = list(intersection_id)
+        self.phases = np.zeros((capacity, len(self.intersection_id)), dtype=np.int16)
+        self.length = 0
+
+    def reset(self):
+        self.length = 0
+
+    def _reserve(self, length):
+        if length > len(self.phases):
+            phases = np.zeros((max(length, 2 * len(self.phases)), self.phases.shape[1]), dtype=np.int16)
+            phases[:self.length] = self.phases[:self.length]
+            self.phases = phases
+
+    def record(self, phases):
+        '''
+        phases: one phase per intersection, in the order of intersection_id
+        '''
+        self._reserve(self.length + 1)
+        self.phases[self.length] = phases
+        self.length += 1
+
+    def extend(self, phases):
+        '''
+        phases: (num_ticks, num_intersections)
+        '''
+        self._reserve(self.length + len(phases))
+        self.phases[self.length:self.length + len(phases)] = phases
+        self.length += len(phases)
+
+    @property
+    def log(self):
+        '''
+        (num_ticks, num_intersections) view of the episode so far
+        '''
+        return self.phases[:self.length]
+
+    def save(self, path):
+        np.savez_compressed(path, intersection_id=np.array(self.intersection_id), phases=self.log)
+
+    @staticmethod
+    def load(path):
+        '''
+        return intersection_id list, phases (num_ticks, num_intersections)
+        '''
+        data = np.load(path)
+        return data['intersection_id'].tolist(), data['phases']
+
+    def save_signal_plan(self, path, num_step=None):
+        '''
+        text table with one column per intersection and one row per tick
+        '''
+        np.savetxt(path, self.log[:num_step], fmt='%d', delimiter=',', header=','.join(self.intersection_id), comments='')
+
+class ReplayPolicy(object):
+    '''
+    which training episodes the engine writes a replay file for: every 'every'-th episode (0: none)
+    and the final one. the config must have saveReplay true when the engine is built, so the roadnet
+    log is written and the replay can be switched on later. episode e is written to <replayLogFile>_ep<e>.txt
+    '''
+    def __init__(self, num_episodes, every=0, final=True, replay_file='replay.txt'):
+        self.num_episodes = num_episodes
+        self.every = every
+        self.final = final
+        self.stem, self.ext = os.path.splitext(replay_file)
+
+    def should_record(self, episode):
+        '''
+        episode: 1-based
+        '''
+        return (self.every > 0 and episode % self.every == 0) or (self.final and episode == self.num_episodes)
+
+    def apply(self, eng, episode):
+        '''
+        switch the replay of the engine on or off before episode 'episode' starts, return whether it is on
+        '''
+        record = self.should_record(episode)
+        if record:
+            eng.set_replay_file("{}_ep{}{}".format(self.stem, episode, self.ext))
+        eng.set_save_replay(record)
+        return record
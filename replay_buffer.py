@@ -0,0 +1,276 @@
+"""
+Replay buffer backed by preallocated arrays
+"""
+
+import multiprocessing as mp
+import os
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+class ReplayBuffer(object):
+    '''
+    ring buffer of (state, action, reward, next_state, discount) transitions, discount is the
+    factor of the bootstrapped next_state value (gamma, gamma ** n for n-step returns).
+    transitions live in contiguous arrays, so appending is O(1) and
+    sampling returns ready-to-feed batches without stacking
+    '''
+    def __init__(self, capacity, state_size):
+        self.capacity = capacity
+        self.state_size = state_size
+        self.states = np.zeros((capacity, state_size), dtype=np.float32)
+        self.actions = np.zeros(capacity, dtype=np.int64) # action_list index
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros((capacity, state_size), dtype=np.float32)
+        self.discounts = np.zeros(capacity, dtype=np.float32)
+        self.pointer = 0 # next slot to write
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, state, action, reward, next_state, discount):
+        '''
+        state, next_state: array of state_size elements, e.g. (1, state_size)
+        '''
+        i = self.pointer
+        self.states[i] = np.reshape(state, [self.state_size])
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = np.reshape(next_state, [self.state_size])
+        self.discounts[i] = discount
+        self.pointer = (i + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample_index(self, batch_size):
+        return np.random.randint(0, self.size, size=batch_size)
+
+    def sample(self, batch_size):
+        '''
+        return states (batch_size, state_size), actions (batch_size,),
+        rewards (batch_size,), next_states (batch_size, state_size), discounts (batch_size,)
+        '''
+        index = self.sample_index(batch_size)
+        return self.states[index], self.actions[index], self.rewards[index], self.next_states[index], self.discounts[index]
+
+    def sample_weighted(self, batch_size):
+        '''
+        sample() plus the buffer index of the transitions and their importance sampling weights,
+        None for a uniform buffer
+        '''
+        return self.sample(batch_size) + (None, None)
+
+    def update_priorities(self, index, td_errors):
+        pass # uniform sampling
+
+class SumTree(object):
+    '''
+    binary tree over 'capacity' leaf priorities where every node is the sum of its children,
+    in one array (root at 1, leaf i at num_leaves + i). update and find are O(log capacity)
+    and vectorized over a batch of leaves
+    '''
+    def __init__(self, capacity):
+        self.depth = max(0, (capacity - 1).bit_length())
+        self.num_leaves = 1 << self.depth
+        self.nodes = np.zeros(2 * self.num_leaves)
+
+    @property
+    def total(self):
+        return self.nodes[1]
+
+    def update(self, index, priority):
+        node = np.asarray(index) + self.num_leaves
+        self.nodes[node] = priority
+        for _ in range(self.depth):
+            node = np.unique(node // 2) # parents are recomputed from their children, no drift
+            self.nodes[node] = self.nodes[2 * node] + self.nodes[2 * node + 1]
+
+    def find(self, values):
+        '''
+        leaf index of every value in [0, total), the leaf whose priority interval contains it
+        '''
+        values = np.array(values, dtype=np.float64)
+        node = np.ones(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * node
+            right = values > self.nodes[left]
+            values -= self.nodes[left] * right
+            node = left + right
+        return node - self.num_leaves
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''
+    proportional prioritized replay: transition i is sampled with probability p_i / sum(p),
+    p_i = (|td error| + epsilon) ^ alpha, new transitions get the largest priority so far.
+    a batch takes one transition from each of batch_size equal slices of the total priority (stratified),
+    in random order, so that consecutive parts of a large sample are batches of the same distribution,
+    the importance sampling weights (N * P(i)) ^ -beta are normalized by the largest one of the batch,
+    beta grows linearly to 1 over beta_steps sampled batches
+    '''
+    def __init__(self, capacity, state_size, alpha=0.6, beta=0.4, beta_steps=100000, epsilon=1e-6):
+        super(PrioritizedReplayBuffer, self).__init__(capacity, state_size)
+        self.tree = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = (1.0 - beta) / beta_steps
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+
+    def append(self, state, action, reward, next_state, discount):
+        i = self.pointer
+        super(PrioritizedReplayBuffer, self).append(state, action, reward, next_state, discount)
+        self.tree.update([i], self.max_priority)
+
+    def sample_index(self, batch_size):
+        segment = self.tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.rand(batch_size)) * segment
+        index = np.minimum(self.tree.find(values), self.size - 1) # rounding at the upper end
+        # the strata come out sorted by slot, replay_compiled and the dueling replay split one sample into update_steps batches
+        return index[np.random.permutation(batch_size)]
+
+    def sample_weighted(self, batch_size):
+        index = self.sample_index(batch_size)
+        probabilities = self.tree.nodes[index + self.tree.num_leaves] / self.tree.total
+        weights = (self.size * probabilities) ** -self.beta
+        weights = (weights / weights.max()).astype(np.float32)
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return self.states[index], self.actions[index], self.rewards[index], self.next_states[index], self.discounts[index], index, weights
+
+    def update_priorities(self, index, td_errors):
+        priorities = (np.abs(td_errors) + self.epsilon) ** self.alpha
+        self.tree.update(index, priorities)
+        self.max_priority = max(self.max_priority, priorities.max())
+
+class NStepAccumulator(object):
+    '''
+    n-step transitions between the env loop and the replay buffer: push() the one step transitions of an
+    episode, it returns (state, action, discounted return of the next n rewards, state n steps later, gamma ** n)
+    once n steps are collected (None before), flush() returns the shorter returns of the last
+    steps at the end of the episode. the last n transitions are kept by reference in a circular window,
+    state/action/reward may be arrays (one per env) or {intersection_id: value} dicts, the discount is shared
+    '''
+    def __init__(self, n, gamma):
+        self.n = n
+        self.powers = gamma ** np.arange(n + 1) # gamma ** k
+        self.window = [None] * n
+        self.pointer = 0 # oldest transition
+        self.length = 0
+
+    def reset(self):
+        self.window = [None] * self.n
+        self.pointer = 0
+        self.length = 0
+
+    def _pop(self, num_steps):
+        # transition of the oldest state over the next num_steps steps
+        steps = [self.window[(self.pointer + k) % self.n] for k in range(num_steps)]
+        state, action, reward, _ = steps[0]
+        if isinstance(reward, dict):
+            ret = {key: sum(self.powers[k] * step[2][key] for k, step in enumerate(steps)) for key in reward}
+        else:
+            ret = sum(self.powers[k] * step[2] for k, step in enumerate(steps))
+        self.window[self.pointer] = None
+        self.pointer = (self.pointer + 1) % self.n
+        self.length -= 1
+        return state, action, ret, steps[-1][3], self.powers[num_steps]
+
+    def push(self, state, action, reward, next_state):
+        self.window[(self.pointer + self.length) % self.n] = (state, action, reward, next_state)
+        self.length += 1
+        if self.length == self.n:
+            return self._pop(self.n)
+        return None
+
+    def flush(self):
+        transitions = [self._pop(self.length) for _ in range(self.length)]
+        self.reset()
+        return transitions
+
+def make_replay_buffer(capacity, state_size, prioritized=False):
+    if prioritized:
+        return PrioritizedReplayBuffer(capacity, state_size)
+    return ReplayBuffer(capacity, state_size)
+
+class SharedReplayBuffer(ReplayBuffer):
+    '''
+    ReplayBuffer whose arrays live in shared memory, filled by actor processes and sampled by the learner.
+    create it in the parent, then pass it to the worker processes (it is pickled as the names of its
+    shared memory blocks). append and sample hold a process lock, the owner unlinks the memory in close()
+    '''
+    FIELDS = [('states', np.float32, True), ('actions', np.int64, False),
+              ('rewards', np.float32, False), ('next_states', np.float32, True),
+              ('discounts', np.float32, False)]
+
+    def __init__(self, capacity, state_size, ctx=None):
+        ctx = ctx or mp
+        # processes must share the parent's tracker, otherwise each of them would unlink the buffers on exit
+        resource_tracker.ensure_running()
+        self.capacity = capacity
+        self.state_size = state_size
+        self._lock = ctx.Lock()
+        self._counters = ctx.Array('q', 3, lock=False) # pointer, size, number of appended transitions
+        self._shms = {}
+        for name, dtype, per_state in self.FIELDS:
+            shape = (capacity, state_size) if per_state else (capacity,)
+            self._shms[name] = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        self._owner = os.getpid() # only the creating process unlinks, also under fork
+        self._attach()
+
+    def _attach(self):
+        for name, dtype, per_state in self.FIELDS:
+            shape = (self.capacity, self.state_size) if per_state else (self.capacity,)
+            setattr(self, name, np.ndarray(shape, dtype=dtype, buffer=self._shms[name].buf))
+
+    def __getstate__(self):
+        return {'capacity': self.capacity,
+                'state_size': self.state_size,
+                'lock': self._lock,
+                'counters': self._counters,
+                'names': {name: shm.name for name, shm in self._shms.items()}}
+
+    def __setstate__(self, state):
+        self.capacity = state['capacity']
+        self.state_size = state['state_size']
+        self._lock = state['lock']
+        self._counters = state['counters']
+        self._shms = {name: shared_memory.SharedMemory(name=shm_name) for name, shm_name in state['names'].items()}
+        self._owner = None
+        self._attach()
+
+    @property
+    def pointer(self):
+        return self._counters[0]
+
+    @pointer.setter
+    def pointer(self, value):
+        self._counters[0] = value
+
+    @property
+    def size(self):
+        return self._counters[1]
+
+    @size.setter
+    def size(self, value):
+        self._counters[1] = value
+
+    @property
+    def num_appended(self):
+        return self._counters[2]
+
+    def append(self, state, action, reward, next_state, discount):
+        with self._lock:
+            super(SharedReplayBuffer, self).append(state, action, reward, next_state, discount)
+            self._counters[2] += 1
+
+    def sample(self, batch_size):
+        # fancy indexing copies, the batch stays valid while actors keep writing
+        with self._lock:
+            return super(SharedReplayBuffer, self).sample(batch_size)
+
+    def close(self):
+        for name, _, _ in self.FIELDS:
+            setattr(self, name, None)
+        for shm in self._shms.values():
+            shm.close()
+            if self._owner == os.getpid():
+                shm.unlink()
+        self._shms = {}
@@ -0,0 +1,75 @@
+"""
+Vectorized reward kernels, selected by name with the "reward" entry of the global config
+"""
+
+import numpy as np
+
+REWARDS = {}
+
+def register(name):
+    def decorator(kernel):
+        REWARDS[name] = kernel
+        return kernel
+    return decorator
+
+# every kernel maps the EngineSnapshot of a tick to one reward per row of env.lane_index,
+# start/end lane views are padded with zeros
+
+@register('mean_speed')
+def mean_speed(snapshot, env):
+    '''
+    mean speed of the vehicles on the start lanes * 100
+    '''
+    speed = snapshot.lane_view('speed_sum', 'start').sum(axis=1)
+    count = snapshot.lane_view('vehicle_count', 'start').sum(axis=1)
+    return speed / (count + 1e-5) * 100
+
+@register('lane_mean_speed')
+def lane_mean_speed(snapshot, env):
+    '''
+    mean over the start lanes of their mean vehicle speed * 100, 0 for an intersection without start lanes
+    '''
+    num_start_lane = np.maximum(env.lane_index.num_start_lane, 1) # rows without lanes sum to 0
+    return snapshot.lane_view('speed', 'start').sum(axis=1) / num_start_lane * 100
+
+@register('queue_length')
+def queue_length(snapshot, env):
+    '''
+    waiting vehicles on the start lanes, * -1
+    '''
+    return -snapshot.lane_view('waiting_vehicle_count', 'start').sum(axis=1)
+
+@register('max_queue')
+def max_queue(snapshot, env):
+    '''
+    longest queue of the start lanes, * -1
+    '''
+    return -snapshot.lane_view('waiting_vehicle_count', 'start').max(axis=1)
+
+@register('pressure')
+def pressure(snapshot, env):
+    '''
+    |waiting vehicles on the start lanes - waiting vehicles on the end lanes|, * -1
+    '''
+    return -np.abs(snapshot.lane_view('waiting_vehicle_count', 'start').sum(axis=1) -
+                   snapshot.lane_view('waiting_vehicle_count', 'end').sum(axis=1))
+
+@register('phase_change')
+def phase_change(snapshot, env):
+    '''
+    -1 on the tick the phase changed, 0 otherwise
+    '''
+    return -np.array([env.current_phase_time[id_] == 1 for id_ in env.lane_index.intersection_id], dtype=float)
+
+def make_reward(spec):
+    '''
+    spec: a kernel name, {"name": kernel name} or
+    {"name": "composite", "weights": {kernel name: weight, ...}} for a weighted sum of kernels
+    '''
+    if isinstance(spec, str):
+        spec = {"name": spec}
+    if spec["name"] == 'composite':
+        kernels = [(make_reward(name), weight) for name, weight in spec["weights"].items()]
+        return lambda snapshot, env: sum(weight * kernel(snapshot, env) for kernel, weight in kernels)
+    assert spec["name"] in REWARDS, "unknown reward {}, choose from {} or composite".format(spec["name"], sorted(REWARDS))
+    return REWARDS[spec["name"]]
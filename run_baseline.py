@@ -0,0 +1,46 @@
+'''
+baseline controllers (max queue, max pressure, fixed time) on one scenario, no agent:
+imports the engine and numpy only, for many short evaluation jobs. one json line per seed
+'''
+import argparse
+import json
+import time
+
+from cityflow_env import CityFlowEnvM
+from utility import parse_roadnet
+from evaluate import BASELINES, ControllerPolicy, run_episode
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--controller', type=str, default='max_pressure', choices=BASELINES, help='baseline controller')
+    parser.add_argument('--config', type=str, default='config/global_config_multi.json', help='config file')
+    parser.add_argument('--scenario', type=str, default=None, help='cityflow config file, the one of --config by default')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='engine random seeds')
+    parser.add_argument('--num_step', type=int, default=3600, help='seconds of every episode')
+    parser.add_argument('--phase_step', type=int, default=15, help='seconds of one phase (max queue, max pressure)')
+    parser.add_argument('--thread_num', type=int, default=1, help='engine threads')
+    parser.add_argument('--save_replay', action="store_true", help='write the replay file of the first seed (needs "saveReplay": true in the cityflow config)')
+    args = parser.parse_args()
+
+    scenario = args.scenario or json.load(open(args.config))['cityflow_config_file']
+    cityflow_config = json.load(open(scenario))
+    lane_phase_info = parse_roadnet(cityflow_config['dir'] + cityflow_config['roadnetFile'])
+    env = CityFlowEnvM(lane_phase_info,
+                       list(lane_phase_info.keys()),
+                       num_step=args.num_step // args.phase_step,
+                       thread_num=args.thread_num,
+                       cityflow_config_file=scenario)
+    initial = env.snapshot()
+    policy = ControllerPolicy(args.controller, env, args.phase_step)
+
+    for k, seed in enumerate(args.seeds):
+        start = time.time()
+        env.restore(initial) # every seed from the same start
+        env.eng.set_random_seed(seed)
+        env.eng.set_save_replay(args.save_replay and k == 0)
+        result = run_episode(env, policy, args.num_step)
+        result.update(controller=args.controller, scenario=scenario, seed=seed, seconds=time.time() - start)
+        print(json.dumps(result))
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,237 @@ import argparse
 import json
 import logging
 import os
+import multiprocessing as mp
 import numpy as np
 from datetime import datetime
 from tqdm import tqdm
-import pandas as pd
 
 
-import cityflow
-from cityflow_env import CityFlowEnv
+from cityflow_env import CityFlowEnv, WarmStartPool
 # from test.cityflow_env import CityFlowEnv
 from utility import parse_roadnet, plot_data_lists
-from dqn_agent import DQNAgent, DDQNAgent
-from duelingDQN import DuelingDQNAgent
+# agents (keras, tensorflow) are imported by make_agent, .npz inference runs without them
+from vec_env import VecCityFlowEnv
+from replay_buffer import SharedReplayBuffer, NStepAccumulator
+from actor_learner import ActorPool, SharedWeights
+from numpy_policy import NumpyPolicy
+from controllers import StateMaxQueueController
+from metrics import MetricsWriter
+from recorder import ReplayPolicy
+from profiler import Profiler
 # import ray
 
 # os.environ["CUDA_VISIBLE_DEVICES"]="0" # use GPU
 
+def make_env_configs(config, cityflow_config, num_envs):
+    '''
+    one cityflow config file per parallel environment, with its own seed and no replay file
+    '''
+    config_files = []
+    for k in range(num_envs):
+        env_config = dict(cityflow_config, seed=cityflow_config.get("seed", 0) + k, saveReplay=False)
+        config_file = config["cityflow_config_file"].replace(".json", "_env{}.json".format(k))
+        json.dump(env_config, open(config_file, 'w'))
+        config_files.append(config_file)
+    return config_files
+
+def make_agent(algo, config, phase_list, env, prioritized=False):
+    '''
+    DQN, DDQN or DuelDQN agent, imports keras or tensorflow on first call
+    '''
+    if algo == 'DuelDQN':
+        from duelingDQN import DuelingDQNAgent
+        return DuelingDQNAgent(config)
+    from dqn_agent import DQNAgent, DDQNAgent
+    from compiled_update import set_session_threads
+    set_session_threads(config["intra_op_threads"], config["inter_op_threads"])
+    agent = DQNAgent if algo == 'DQN' else DDQNAgent
+    return agent(config["intersection_id"],
+                state_size=config["state_size"],
+                action_size=config["action_size"],
+                batch_size=config["batch_size"],
+                phase_list=phase_list,
+                env=env,
+                memory_size=config["memory_size"],
+                prioritized=prioritized,
+                update_steps=config["update_steps"])
+
+def save_training(args, agent, epoch, model_dir, metrics):
+    with agent.profiler.section('checkpoint'):
+        if args.algo != 'DuelDQN':
+            agent.model.save(model_dir + "/{}-{}.h5".format(args.algo, epoch))
+        else:
+            agent.save(model_dir + "/{}-ckpt".format(args.algo), epoch)
+        agent.export(model_dir + "/{}-{}.npz".format(args.algo, epoch)) # for numpy_policy, inference without TensorFlow
+
+        # rewards and scores so far, plot them with plot_metrics.py
+        for writer in metrics:
+            writer.flush()
+
+def remember_envs(agent, transition):
+    # one n-step transition of every environment, the discount is shared
+    states, actions, rewards, next_states, discount = transition
+    for k in range(len(actions)):
+        agent.remember(states[k], actions[k], rewards[k], next_states[k], discount)
+
+def make_rule(args, config, phase_list):
+    '''
+    the max vehicle count rule of --behavior_policy rule, None for the epsilon greedy network
+    '''
+    if args.behavior_policy == 'rule':
+        return StateMaxQueueController(config["lane_phase_info"], config["intersection_id"], phase_list)
+    return None
+
+def train_parallel(args, agent, env, phase_list, model_dir, result_dir,
+                    learning_start, update_model_freq, update_target_model_freq, rule=None):
+    '''
+    training with a VecCityFlowEnv, actions of all environments come from one call of the
+    behavior policy (rule, or one forward pass of the agent), and every step stores num_envs transitions
+    '''
+    profiler = agent.profiler
+    phases = np.array(phase_list)
+    n_step = NStepAccumulator(args.n_step, agent.gamma)
+    total_step = 0
+    step_metrics = MetricsWriter(result_dir + '/steps')
+    episode_metrics = MetricsWriter(result_dir + '/episodes')
+    env_index = list(range(env.num_envs))
+    with tqdm(total=args.epoch*args.num_step) as pbar:
+        for i in range(args.epoch):
+            state = env.reset()
+
+            episode_length = 0
+            episode_reward = np.zeros(env.num_envs)
+            episode_score = np.zeros(env.num_envs)
+            while episode_length < args.num_step:
+
+                with profiler.section('action'):
+                    # index of action, one per environment
+                    action = rule.choose_actions(state) if rule is not None else agent.choose_actions(state)
+                    action_phase = phases[action] # actual action
+                # keep the phase for phase_step seconds, reward is the mean over them
+                with profiler.section('env_step'):
+                    next_state, reward, score = env.step_n(action_phase, args.phase_step, with_score=True)
+                profiler.count('env_ticks', args.phase_step * env.num_envs)
+                episode_length += 1
+                total_step += 1
+                episode_reward += reward
+                episode_score += score
+                with profiler.section('io'):
+                    step_metrics.extend(epoch=i+1, step=episode_length, env=env_index,
+                                        action=action_phase.tolist(), reward=reward.tolist(), score=score.tolist())
+
+                pbar.update(1)
+                # store to replay buffer
+                if episode_length > learning_start:
+                    with profiler.section('remember'):
+                        transition = n_step.push(state, action_phase, reward, next_state)
+                        if transition is not None:
+                            remember_envs(agent, transition)
+                    profiler.count('transitions', env.num_envs)
+
+                state = next_state
+
+                # training
+                if episode_length > learning_start and total_step % update_model_freq == 0:
+                    if len(agent.memory) > args.batch_size:
+                        with profiler.section('replay'):
+                            agent.replay()
+
+                # update target Q netwark
+                if episode_length > learning_start and total_step % update_target_model_freq == 0:
+                    with profiler.section('target_sync'):
+                        agent.update_target_network()
+
+                pbar.set_description(
+                    "total_step:{}, episode:{}, episode_step:{}, reward:{}".format(total_step, i+1, episode_length, reward.mean()))
+
+            for transition in n_step.flush():
+                remember_envs(agent, transition)
+
+            # save episode rewards, record episode mean reward
+            episode_metrics.extend(epoch=i+1, env=env_index,
+                                    reward=(episode_reward/args.num_step).tolist(), score=episode_score.tolist())
+            print("score: {}, mean reward:{}".format(episode_score.mean(), episode_reward.mean()/args.num_step))
+
+            # save model
+            if (i + 1) % args.save_freq == 0:
+                save_training(args, agent, i+1, model_dir, [step_metrics, episode_metrics])
+            profiler.end_episode(i+1)
+
+    step_metrics.close()
+    episode_metrics.close()
+
+def train_async(args, agent, env_kwargs, phase_list, model_dir, result_dir,
+                learning_start, update_target_model_freq):
+    '''
+    training with actor processes (one CityFlowEnv each) filling a shared replay buffer, while this process
+    trains the agent. weights are published to the actors every args.publish_freq updates, and the learner
+    does at most args.replay_ratio updates per stored transition (0: as many as it can)
+    '''
+    profiler = agent.profiler
+    num_actors = len(env_kwargs)
+    ctx = mp.get_context('spawn')
+    agent.memory = SharedReplayBuffer(args.memory_size, agent.state_size, ctx=ctx)
+    weights = SharedWeights([w.shape for w in agent.model.get_weights()], ctx=ctx)
+    weights.publish(agent.model.get_weights(), agent.epsilon)
+    actors = ActorPool(env_kwargs, agent.memory, weights, {
+                            "num_episodes": -(-args.epoch // num_actors),
+                            "num_step": args.num_step,
+                            "phase_step": args.phase_step,
+                            "learning_start": learning_start,
+                            "phase_list": phase_list,
+                            "behavior_policy": args.behavior_policy,
+                            "n_step": args.n_step,
+                            "gamma": agent.gamma,
+                            "sync_freq": args.sync_freq,
+                            "seed": np.random.randint(2**31)}, ctx=ctx)
+
+    step_metrics = MetricsWriter(result_dir + '/steps')
+    episode_metrics = MetricsWriter(result_dir + '/episodes')
+    num_updates = 0
+    num_episodes = 0
+    try:
+        with tqdm(total=num_actors * -(-args.epoch // num_actors)) as pbar:
+            while actors.num_running > 0:
+                ready = len(agent.memory) > args.batch_size and \
+                        (args.replay_ratio <= 0 or num_updates < args.replay_ratio * agent.memory.num_appended)
+                with profiler.section('wait' if not ready else 'io'):
+                    episodes = actors.poll(timeout=None if ready else 0.1)
+                for index, episode, steps in episodes:
+                    num_episodes += 1
+                    step_metrics.extend(epoch=episode, env=index, **steps)
+                    episode_metrics.append(epoch=episode, env=index,
+                                            reward=np.mean(steps["reward"]), score=float(np.sum(steps["score"])))
+                    pbar.update(1)
+                    pbar.set_description("actor:{}, episode:{}, updates:{}, score:{}".format(
+                        index, episode, num_updates, np.sum(steps["score"])))
+
+                    # an epoch is over when every actor finished one more episode
+                    if num_episodes % num_actors == 0:
+                        epoch = num_episodes // num_actors
+                        if epoch % args.save_freq == 0:
+                            save_training(args, agent, epoch, model_dir, [step_metrics, episode_metrics])
+                        profiler.end_episode(epoch)
+                if not ready:
+                    continue
+
+                with profiler.section('replay'):
+                    agent.replay()
+                num_updates += 1
+                if num_updates % update_target_model_freq == 0:
+                    with profiler.section('target_sync'):
+                        agent.update_target_network()
+                if num_updates % args.publish_freq == 0:
+                    with profiler.section('publish'):
+                        weights.publish(agent.model.get_weights(), agent.epsilon)
+
+        actors.close()
+    finally: # also when an actor failed, the shared memory must not leak
+        step_metrics.close()
+        episode_metrics.close()
+        agent.memory.close()
+        weights.close()
+
 def main():
     logging.getLogger().setLevel(logging.INFO)
     date = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -26,12 +241,30 @@ def main():
     parser.add_argument('--config', type=str, default='config/global_config.json', help='config file')
     parser.add_argument('--algo', type=str, default='DQN', choices=['DQN', 'DDQN', 'DuelDQN'], help='choose an algorithm')
     parser.add_argument('--inference', action="store_true", help='inference or training')
-    parser.add_argument('--ckpt', type=str, help='inference or training')
+    parser.add_argument('--ckpt', type=str, help='checkpoint for inference, an exported .npz runs without building the TensorFlow model')
     parser.add_argument('--epoch', type=int, default=10, help='number of training epochs')
     parser.add_argument('--num_step', type=int, default=200, help='number of timesteps for one episode, and for inference')
     parser.add_argument('--save_freq', type=int, default=1, help='model saving frequency')
     parser.add_argument('--batch_size', type=int, default=64, help='batchsize for training')
     parser.add_argument('--phase_step', type=int, default=15, help='seconds of one phase')
+    parser.add_argument('--memory_size', type=int, default=3000, help='capacity of the replay buffer')
+    parser.add_argument('--prioritized', action="store_true", help='prioritized experience replay (sum-tree) instead of uniform sampling')
+    parser.add_argument('--n_step', type=int, default=1, help='transitions with the discounted return of n steps, bootstrapped from the state n steps later')
+    parser.add_argument('--update_steps', type=int, default=0, help='gradient steps per replay, one session call of the compiled update each, on as many batches sampled at once, 0: keras fit')
+    parser.add_argument('--intra_op_threads', type=int, default=0, help='TensorFlow threads of one op, 0: all cores')
+    parser.add_argument('--inter_op_threads', type=int, default=0, help='TensorFlow ops run in parallel, 0: TensorFlow decides')
+    parser.add_argument('--summary_freq', type=int, default=100, help='replays between two TensorBoard summaries of DuelDQN')
+    parser.add_argument('--behavior_policy', type=str, default='rule', choices=['rule', 'network'],
+                        help='actions of training, for any --num_envs or --num_actors: rule (max vehicle count phase) or network (epsilon greedy)')
+    parser.add_argument('--num_envs', type=int, default=1, help='number of environments stepped in parallel worker processes for training')
+    parser.add_argument('--num_actors', type=int, default=0, help='train asynchronously, with this many actor processes stepping environments (DQN, DDQN), acting with --behavior_policy like the synchronous loop')
+    parser.add_argument('--publish_freq', type=int, default=50, help='learner updates between publishing weights to the actors')
+    parser.add_argument('--sync_freq', type=int, default=10, help='actor steps between checks for new weights')
+    parser.add_argument('--replay_ratio', type=float, default=1.0, help='max learner updates per stored transition, 0 for no limit')
+    parser.add_argument('--replay_every', type=int, default=0, help='save the replay file of every N-th training episode, the final one is always saved')
+    parser.add_argument('--warm_start', type=int, default=0, help='start episodes from this many cached snapshots taken after the learning_start warm-up steps, instead of reset')
+    parser.add_argument('--profile', action="store_true", help='time env step, action selection, replay and I/O, print a breakdown every episode')
+    parser.add_argument('--cprofile', action="store_true", help='also dump cProfile stats of the training to result_dir/train.prof')
     
     args = parser.parse_args()
 
@@ -39,6 +272,7 @@ def main():
     # # for environment
     config = json.load(open(args.config))
     config["num_step"] = args.num_step
+    config.setdefault("reward", "mean_speed") # see rewards.py, e.g. "pressure" or {"name": "composite", "weights": {...}}
     
     assert "1x1" in config['cityflow_config_file'], "please use 1x1 config file for cityflow"
 
@@ -54,6 +288,12 @@ def main():
     phase_list = config['lane_phase_info'][config["intersection_id"]]['phase']
     config["action_size"] = len(phase_list)
     config["batch_size"] = args.batch_size
+    config["memory_size"] = args.memory_size
+    config["summary_freq"] = args.summary_freq
+    config["prioritized"] = args.prioritized
+    config["update_steps"] = args.update_steps
+    config["intra_op_threads"] = args.intra_op_threads
+    config["inter_op_threads"] = args.inter_op_threads
     
     logging.info(phase_list)
 
@@ -71,29 +311,28 @@ def main():
 
     if not args.inference:
         # build cityflow environment
-        cityflow_config["saveReplay"] = True
+        cityflow_config["saveReplay"] = True # switched off except for the episodes of the ReplayPolicy
         json.dump(cityflow_config, open(config["cityflow_config_file"], 'w'))
-        env = CityFlowEnv(
-            lane_phase_info=config["lane_phase_info"],
-            intersection_id=config["intersection_id"], # for single agent
-            num_step=args.num_step,
-            cityflow_config_file = config["cityflow_config_file"]
-            )
+        if args.num_envs > 1:
+            env = VecCityFlowEnv(CityFlowEnv, [dict(
+                lane_phase_info=config["lane_phase_info"],
+                intersection_id=config["intersection_id"], # for single agent
+                num_step=args.num_step,
+                cityflow_config_file=config_file,
+                reward=config["reward"]
+                ) for config_file in make_env_configs(config, cityflow_config, args.num_envs)])
+        else:
+            env = CityFlowEnv(
+                lane_phase_info=config["lane_phase_info"],
+                intersection_id=config["intersection_id"], # for single agent
+                num_step=args.num_step,
+                cityflow_config_file = config["cityflow_config_file"],
+                reward=config["reward"]
+                )
 
         # build agent
         config["state_size"] = env.state_size
-        if args.algo == 'DQN':
-            agent = DQNAgent(intersection_id,
-                            state_size=config["state_size"],
-                            action_size=config["action_size"],
-                            batch_size=config["batch_size"],
-                            phase_list=phase_list,
-                            env=env)
-        
-        elif args.algo == 'DDQN':
-            agent = DDQNAgent(config)
-        elif args.algo == 'DuelDQN':
-            agent = DuelingDQNAgent(config)
+        agent = make_agent(args.algo, config, phase_list, env, prioritized=args.prioritized)
 
         # make dirs
         if not os.path.exists("model"):
@@ -104,53 +343,100 @@ def main():
             os.makedirs(model_dir)
         if not os.path.exists(result_dir):
             os.makedirs(result_dir)
+
+        # per episode breakdown in result_dir/profile, off by default
+        profiler = Profiler(enabled=args.profile or args.cprofile, path=result_dir + '/profile',
+                            cprofile=result_dir + '/train.prof' if args.cprofile else None)
+        agent.profiler = profiler
+        rule = make_rule(args, config, phase_list)
         
+        if args.num_actors > 0:
+            assert args.algo in ('DQN', 'DDQN'), "asynchronous training supports DQN and DDQN"
+            assert not args.prioritized, "asynchronous training samples the shared buffer uniformly"
+            train_async(args, agent, [dict(
+                lane_phase_info=config["lane_phase_info"],
+                intersection_id=config["intersection_id"],
+                num_step=args.num_step,
+                cityflow_config_file=config_file,
+                reward=config["reward"]
+                ) for config_file in make_env_configs(config, cityflow_config, args.num_actors)],
+                phase_list, model_dir, result_dir, learning_start, update_target_model_freq)
+            profiler.close()
+            return
+
+        if args.num_envs > 1:
+            train_parallel(args, agent, env, phase_list, model_dir, result_dir,
+                            learning_start, update_model_freq, update_target_model_freq, rule)
+            env.close()
+            profiler.close()
+            return
+
         # training
         total_step = 0
-        episode_rewards = []
-        episode_scores = []
-        with tqdm(total=EPISODES*args.num_step) as pbar:
+        step_metrics = MetricsWriter(result_dir + '/steps')
+        episode_metrics = MetricsWriter(result_dir + '/episodes')
+        # warm-up steps are simulated once for the pool, episodes start where learning starts
+        # replay files only for the episodes the policy selects, and the phases of those episodes
+        replay_policy = ReplayPolicy(EPISODES, every=args.replay_every, replay_file=cityflow_config["replayLogFile"])
+        env.eng.set_save_replay(False)
+        first_step = 0
+        if args.warm_start > 0:
+            assert args.num_step > learning_start, "num_step must be larger than the {} warm-up steps".format(learning_start)
+            warm_start_pool = WarmStartPool(env, args.warm_start, learning_start, args.phase_step)
+            first_step = learning_start
+        n_step = NStepAccumulator(args.n_step, agent.gamma)
+        with tqdm(total=EPISODES*(args.num_step - first_step)) as pbar:
             for i in range(EPISODES):
                 # print("episode: {}".format(i))
-                env.reset()
+                if args.warm_start > 0:
+                    warm_start_pool.restore()
+                else:
+                    env.reset()
+                recording = replay_policy.apply(env.eng, i+1)
                 state = env.get_state()
 
-                episode_length = 0
+                episode_length = first_step
                 episode_reward = 0
                 episode_score = 0
                 while episode_length < args.num_step:
                     
-                    action = agent.choose_action_(state) # index of action
-                    action_phase = phase_list[action] # actual action
-                    # no yellow light
-                    next_state, reward = env.step(action_phase) # one step
+                    with profiler.section('action'):
+                        # index of action
+                        action = int(rule.choose_actions(state)[0]) if rule is not None else agent.choose_action(state)
+                        action_phase = phase_list[action] # actual action
+                    # no yellow light, keep the phase for phase_step seconds, reward is the mean over them
+                    with profiler.section('env_step'):
+                        next_state, reward, score = env.step_n(action_phase, args.phase_step, with_score=True)
+                    profiler.count('env_ticks', args.phase_step)
                     # last_action_phase = action_phase
                     episode_length += 1
                     total_step += 1
                     episode_reward += reward
-                    episode_score += env.get_score()
-
-                    for _ in range(args.phase_step-1):
-                        next_state, reward_ = env.step(action_phase)
-                        reward += reward_
-                    
-                    reward /= args.phase_step 
+                    episode_score += score
+                    with profiler.section('io'):
+                        step_metrics.append(epoch=i+1, step=episode_length, env=0, action=action_phase, reward=reward, score=score)
 
                     pbar.update(1)
                     # store to replay buffer
                     if episode_length > learning_start:
-                        agent.remember(state, action_phase, reward, next_state)
+                        with profiler.section('remember'):
+                            transition = n_step.push(state, action_phase, reward, next_state)
+                            if transition is not None:
+                                agent.remember(*transition)
+                        profiler.count('transitions')
 
                     state = next_state
 
                     # training
                     if episode_length > learning_start and total_step % update_model_freq == 0:
                         if len(agent.memory) > args.batch_size:
-                            agent.replay()
+                            with profiler.section('replay'):
+                                agent.replay()
 
                     # update target Q netwark
                     if episode_length > learning_start and total_step % update_target_model_freq == 0:
-                        agent.update_target_network()
+                        with profiler.section('target_sync'):
+                            agent.update_target_network()
 
                     # logging
                     # logging.info("\repisode:{}/{}, total_step:{}, action:{}, reward:{}"
@@ -159,29 +445,25 @@ def main():
                         "total_step:{}, episode:{}, episode_step:{}, reward:{}".format(total_step, i+1, episode_length, reward))
 
 
+                for transition in n_step.flush():
+                    agent.remember(*transition)
+
                 # save episode rewards
-                episode_rewards.append(episode_reward/args.num_step) # record episode mean reward
-                episode_scores.append(episode_score)
-                print("score: {}, mean reward:{}".format(episode_score, episode_reward/args.num_step))
+                episode_reward /= args.num_step - first_step
+                episode_metrics.append(epoch=i+1, env=0, reward=episode_reward, score=episode_score) # record episode mean reward
+                print("score: {}, mean reward:{}".format(episode_score, episode_reward))
+
+                if recording:
+                    env.recorder.save(result_dir + '/phases_ep{}.npz'.format(i+1))
 
                 # save model
                 if (i + 1) % args.save_freq == 0:
-                    if args.algo != 'DuelDQN':
-                        agent.model.save(model_dir + "/{}-{}.h5".format(args.algo, i+1))
-                    else:
-                        agent.save(model_dir + "/{}-ckpt".format(args.algo), i+1)
-            
-                    # save reward to file
-                    df = pd.DataFrame({"rewards": episode_rewards})
-                    df.to_csv(result_dir + '/rewards.csv', index=None)
-
-                    df = pd.DataFrame({"rewards": episode_scores})
-                    df.to_csv(result_dir + '/scores.csv', index=None)
-
-
-                    # save figure
-                    plot_data_lists([episode_rewards], ['episode reward'], figure_name=result_dir + '/rewards.pdf')
-                    plot_data_lists([episode_scores], ['episode score'], figure_name=result_dir + '/scores.pdf')
+                    save_training(args, agent, i+1, model_dir, [step_metrics, episode_metrics])
+                profiler.end_episode(i+1)
+
+        step_metrics.close()
+        episode_metrics.close()
+        profiler.close()
         
 
     else:
@@ -192,40 +474,26 @@ def main():
             lane_phase_info=config["lane_phase_info"],
             intersection_id=config["intersection_id"], # for single agent
             num_step=args.num_step,
-            cityflow_config_file = config["cityflow_config_file"]
+            cityflow_config_file = config["cityflow_config_file"],
+            reward=config["reward"]
             )
         env.reset()
 
         # build agent
         config["state_size"] = env.state_size
-        if args.algo == 'DQN':
-            agent = DQNAgent(intersection_id,
-                            state_size=config["state_size"],
-                            action_size=config["action_size"],
-                            batch_size=config["batch_size"],
-                            phase_list=phase_list,
-                            env=env)
-                        
-        elif args.algo == 'DDQN':
-            agent = DDQNAgent(config)
-        elif args.algo == 'DuelDQN':
-            agent = DuelingDQNAgent(config)
-        agent.load(args.ckpt)   
+        if args.ckpt.endswith('.npz'):
+            agent = NumpyPolicy(args.ckpt) # exported weights, greedy actions without TensorFlow
+        else:
+            agent = make_agent(args.algo, config, phase_list, env)
+            agent.load(args.ckpt)
         
         state = env.get_state()
         scores = []
         for i in range(args.num_step): 
             action = agent.choose_action(state) # index of action
             action_phase = phase_list[action] # actual action
-            next_state, reward = env.step(action_phase) # one step
-
-            for _ in range(args.phase_step-1):
-                next_state, reward_ = env.step(action_phase)
-                reward += reward_
-                    
-            reward /= args.phase_step 
-
-            score = env.get_score()
+            # score after the last second of the phase, as in the inf_scores.csv of earlier runs
+            next_state, reward, score = env.step_n(action_phase, args.phase_step, with_score=True, score_reduce='last')
             scores.append(score)
             state = next_state
 
@@ -233,6 +501,7 @@ def main():
             logging.info("step:{}/{}, action:{}, reward:{}, score:{}"
                             .format(i+1, args.num_step, action, reward, score))
 
+        import pandas as pd
         inf_result_dir = "result/" + args.ckpt.split("/")[1] 
         df = pd.DataFrame({"inf_scores": scores})
         df.to_csv(inf_result_dir + '/inf_scores.csv', index=None) 
@@ -8,13 +8,15 @@ import os
 import numpy as np
 from datetime import datetime
 from tqdm import tqdm
-import pandas as pd
 
 import cityflow
-from cityflow_env import CityFlowEnvM
+from cityflow_env import CityFlowEnvM, WarmStartPool
 # from test.cityflow_env import CityFlowEnv
-from utility import parse_roadnet, plot_data_lists
-from dqn_agent import MDQNAgent
+from utility import parse_roadnet
+from replay_buffer import NStepAccumulator
+from metrics import MetricsWriter
+from recorder import ReplayPolicy
+from profiler import Profiler
 # import ray
 
 os.environ["CUDA_VISIBLE_DEVICES"]="0, 1, 2, 3" # use GPU
@@ -33,19 +35,34 @@ def main():
     parser.add_argument('--save_freq', type=int, default=1, help='model saving frequency')
     parser.add_argument('--batch_size', type=int, default=32, help='batchsize for training')
     parser.add_argument('--phase_step', type=int, default=15, help='seconds of one phase')
+    parser.add_argument('--memory_size', type=int, default=3000, help='capacity of the replay buffer')
+    parser.add_argument('--prioritized', action="store_true", help='prioritized experience replay (sum-tree) instead of uniform sampling')
+    parser.add_argument('--n_step', type=int, default=1, help='transitions with the discounted return of n steps, bootstrapped from the state n steps later')
+    parser.add_argument('--update_steps', type=int, default=0, help='gradient steps per replay, one session call of the compiled update each, on as many batches sampled at once, 0: keras fit')
+    parser.add_argument('--intra_op_threads', type=int, default=0, help='TensorFlow threads of one op, 0: all cores')
+    parser.add_argument('--inter_op_threads', type=int, default=0, help='TensorFlow ops run in parallel, 0: TensorFlow decides')
+    parser.add_argument('--share_params', action="store_true", help='one Q network for all intersections with the same action size')
+    parser.add_argument('--behavior_policy', type=str, default='rule', choices=['rule', 'network'],
+                        help='actions of training, with or without --share_params: rule (max vehicle count phase) or network (epsilon greedy). inference always uses the greedy network')
+    parser.add_argument('--replay_every', type=int, default=0, help='save the replay file of every N-th training episode, the final one is always saved')
+    parser.add_argument('--warm_start', type=int, default=0, help='start episodes from this many cached snapshots taken after the learning_start warm-up steps, instead of reset')
+    parser.add_argument('--profile', action="store_true", help='time env step, action selection, replay and I/O, print a breakdown every episode')
+    parser.add_argument('--cprofile', action="store_true", help='also dump cProfile stats of the training to result_dir/train.prof')
     
     args = parser.parse_args()
 
     config = json.load(open(args.config))
     config["num_step"] = args.num_step
+    config.setdefault("reward", "lane_mean_speed") # see rewards.py, e.g. "pressure" or {"name": "composite", "weights": {...}}
     cityflow_config = json.load(open(config['cityflow_config_file']))
     roadnetFile = cityflow_config['dir'] + cityflow_config['roadnetFile']
 
-    cityflow_config["saveReplay"] = True if args.inference else False
+    cityflow_config["saveReplay"] = True # training switches it off except for the episodes of its ReplayPolicy
     json.dump(cityflow_config, open(config["cityflow_config_file"], 'w'))
     
     config["lane_phase_info"] = parse_roadnet(roadnetFile)
     config["batch_size"] = args.batch_size
+    config["memory_size"] = args.memory_size
     intersection_id = list(config['lane_phase_info'].keys()) # all intersections
     config["intersection_id"] = intersection_id
     phase_list = {id_:config["lane_phase_info"][id_]["phase"] for id_ in intersection_id}
@@ -75,58 +92,81 @@ def main():
                         intersection_id,
                         num_step=config["num_step"],
                         thread_num=1,
-                        cityflow_config_file=config["cityflow_config_file"]
+                        cityflow_config_file=config["cityflow_config_file"],
+                        reward=config["reward"]
                         )
     
     config["state_size"] = env.state_size
     if args.algo == 'MDQN':
+        from dqn_agent import MDQNAgent # keras and tensorflow load here, not on import
+        from compiled_update import set_session_threads
+        set_session_threads(args.intra_op_threads, args.inter_op_threads)
         Magent = MDQNAgent(intersection_id,
                             state_size=config["state_size"],
                             batch_size=config["batch_size"],
                             phase_list=config["phase_list"], # action_size is len(phase_list[id_])
-                            env=env
+                            env=env,
+                            memory_size=config["memory_size"],
+                            share_params=args.share_params,
+                            prioritized=args.prioritized,
+                            update_steps=args.update_steps,
+                            behavior_policy='network' if args.inference else args.behavior_policy
                             )
     else:
         raise Exception("{} algorithm not implemented now".format(args.algo))
 
     if not args.inference:  # training
         total_step = 0
-        episode_rewards = {id_:[] for id_ in intersection_id}
-        episode_scores = {id_:[] for id_ in intersection_id}
-        with tqdm(total=EPISODES*args.num_step) as pbar:
+        step_metrics = MetricsWriter(result_dir + '/steps')
+        episode_metrics = MetricsWriter(result_dir + '/episodes')
+        # per episode breakdown in result_dir/profile, off by default
+        profiler = Profiler(enabled=args.profile or args.cprofile, path=result_dir + '/profile',
+                            cprofile=result_dir + '/train.prof' if args.cprofile else None)
+        Magent.set_profiler(profiler)
+        # warm-up steps are simulated once for the pool, episodes start where learning starts
+        # replay files only for the episodes the policy selects, and the phases of those episodes
+        replay_policy = ReplayPolicy(EPISODES, every=args.replay_every, replay_file=cityflow_config["replayLogFile"])
+        env.eng.set_save_replay(False)
+        first_step = 0
+        if args.warm_start > 0:
+            assert args.num_step > learning_start, "num_step must be larger than the {} warm-up steps".format(learning_start)
+            warm_start_pool = WarmStartPool(env, args.warm_start, learning_start, args.phase_step)
+            first_step = learning_start
+        n_step = NStepAccumulator(args.n_step, Magent.gamma)
+        with tqdm(total=EPISODES*(args.num_step - first_step)) as pbar:
             for i in range(EPISODES):
                 # print("episode: {}".format(i))
-                env.reset()
+                if args.warm_start > 0:
+                    warm_start_pool.restore()
+                else:
+                    env.reset()
+                recording = replay_policy.apply(env.eng, i+1)
                 state = env.get_state()
 
-                episode_length = 0
+                episode_length = first_step
                 episode_reward = {id_:0 for id_ in intersection_id} # for every agent
                 episode_score = {id_:0 for id_ in intersection_id} # for everg agent
                 while episode_length < args.num_step:
                     
-                    action = Magent.choose_action(state) # index of action
-                    action_phase = {}
-                    for id_, a in action.items():
-                        action_phase[id_] = phase_list[id_][a]
+                    with profiler.section('action'):
+                        action = Magent.choose_action(state) # index of action
+                        action_phase = {}
+                        for id_, a in action.items():
+                            action_phase[id_] = phase_list[id_][a]
                     
-                    next_state, reward = env.step(action_phase) # one step
-                    score = env.get_score()
-
-                    # consistent time of every phase
-                    for _ in range(args.phase_step-1):
-                        next_state, reward_ = env.step(action_phase)
-                        score_ = env.get_score()
-                        for id_ in intersection_id:
-                            reward[id_] += reward_[id_]
-                            score[id_] += score_[id_]
-
-                    for id_ in intersection_id:
-                        reward[id_] /= args.phase_step
-                        score[id_] /= args.phase_step
+                    # consistent time of every phase, reward and score are the mean over phase_step seconds
+                    with profiler.section('env_step'):
+                        next_state, reward, score = env.step_n(action_phase, args.phase_step, with_score=True)
+                    profiler.count('env_ticks', args.phase_step)
 
                     for id_ in intersection_id:
                         episode_reward[id_] += reward[id_]
                         episode_score[id_] += score[id_]
+                    with profiler.section('io'):
+                        step_metrics.extend(epoch=i+1, step=episode_length+1, intersection=intersection_id,
+                                            action=[action_phase[id_] for id_ in intersection_id],
+                                            reward=[reward[id_] for id_ in intersection_id],
+                                            score=[score[id_] for id_ in intersection_id])
 
                     episode_length += 1
                     total_step += 1
@@ -134,18 +174,24 @@ def main():
 
                     # store to replay buffer
                     if episode_length > learning_start:
-                        Magent.remember(state, action_phase, reward, next_state)
+                        with profiler.section('remember'):
+                            transition = n_step.push(state, action_phase, reward, next_state)
+                            if transition is not None:
+                                Magent.remember(*transition)
+                        profiler.count('transitions', len(intersection_id))
 
                     state = next_state
 
                     # training
                     if episode_length > learning_start and total_step % update_model_freq == 0 :
-                        if len(Magent.agents[intersection_id[0]].memory) > args.batch_size:
-                            Magent.replay()
+                        if Magent.memory_len() > args.batch_size:
+                            with profiler.section('replay'):
+                                Magent.replay()
 
                     # update target Q netwark
                     if episode_length > learning_start and total_step % update_target_model_freq == 0 :
-                        Magent.update_target_network()
+                        with profiler.section('target_sync'):
+                            Magent.update_target_network()
 
                     # logging.info("\repisode:{}/{}, total_step:{}, action:{}, reward:{}"
                     #             .format(i+1, EPISODES, total_step, action, reward))
@@ -153,40 +199,47 @@ def main():
                     pbar.set_description(
                         "t_st:{}, epi:{}, st:{}, r:{}".format(total_step, i+1, episode_length, print_reward))
 
+                for transition in n_step.flush():
+                    Magent.remember(*transition)
+
                 # compute episode mean reward
                 for id_ in intersection_id:
-                    episode_reward[id_] /= args.num_step
+                    episode_reward[id_] /= args.num_step - first_step
                 
                 # save episode rewards
-                for id_ in intersection_id:
-                    episode_rewards[id_].append(episode_reward[id_])
-                    episode_scores[id_].append(episode_score[id_])
+                episode_metrics.extend(epoch=i+1, intersection=intersection_id,
+                                        reward=[episode_reward[id_] for id_ in intersection_id],
+                                        score=[episode_score[id_] for id_ in intersection_id])
                 
                 print_episode_reward = {'_'.join(k.split('_')[1:]):v for k, v in episode_reward.items()}
                 print_episode_score = {'_'.join(k.split('_')[1:]):v for k, v in episode_score.items()}
                 print('\n')
                 print("Episode:{}, Mean reward:{}, Score: {}".format(i+1, print_episode_reward, print_episode_score))
 
+                if recording:
+                    env.recorder.save(result_dir + '/phases_ep{}.npz'.format(i+1))
+
                 # save model
                 if (i + 1) % args.save_freq == 0:
-                    if args.algo == 'MDQN':
-                        # Magent.save(model_dir + "/{}-ckpt".format(args.algo), i+1)
-                        Magent.save(model_dir + "/{}-{}.h5".format(args.algo, i+1))
-                        
-                    # save reward to file
-                    df = pd.DataFrame(episode_rewards)
-                    df.to_csv(result_dir + '/rewards.csv', index=None)
-
-                    df = pd.DataFrame(episode_scores)
-                    df.to_csv(result_dir + '/scores.csv', index=None)
-
-                    # save figure
-                    plot_data_lists([episode_rewards[id_] for id_ in intersection_id], intersection_id, figure_name=result_dir + '/rewards.pdf')
-                    plot_data_lists([episode_scores[id_] for id_ in intersection_id], intersection_id, figure_name=result_dir + '/scores.pdf')
+                    with profiler.section('checkpoint'):
+                        if args.algo == 'MDQN':
+                            # Magent.save(model_dir + "/{}-ckpt".format(args.algo), i+1)
+                            Magent.save(model_dir + "/{}-{}.h5".format(args.algo, i+1))
+                            Magent.export(model_dir + "/{}-{}.h5".format(args.algo, i+1)) # .npz files for numpy_policy
+
+                        # rewards and scores so far, plot them with plot_metrics.py
+                        step_metrics.flush()
+                        episode_metrics.flush()
+                profiler.end_episode(i+1)
+
+            step_metrics.close()
+            episode_metrics.close()
+            profiler.close()
         
 
     else: # inference
         Magent.load(args.ckpt)   
+        Magent.set_epsilon(0) # greedy actions of the checkpoint
         
         episode_reward = {id_:[] for id_ in intersection_id} # for every agent
         episode_score = {id_:[] for id_ in intersection_id} # for everg agent
@@ -200,19 +253,9 @@ def main():
                 action_phase[id_] = phase_list[id_][a]
 
             # one step #####  
-            next_state, reward = env.step(action_phase) # one step
-            score = env.get_score()
-
-            for _ in range(args.phase_step-1):
-                next_state, reward_ = env.step(action_phase)
-                score_ = env.get_score()
-                for id_ in intersection_id:
-                    reward[id_] += reward_[id_]
-                    score[id_] += score_[id_]
-
-            for id_ in intersection_id:
-                reward[id_] /= args.phase_step
-                score[id_] /= args.phase_step
+            # reward and score are the means over the phase_step seconds, as this loop summed and divided them before step_n
+            next_state, reward, score = env.step_n(action_phase, args.phase_step, reward_reduce='mean',
+                                                   with_score=True, score_reduce='mean')
             # one step #####
 
             for id_ in intersection_id:
@@ -0,0 +1,43 @@
+import numpy as np
+
+from rewards import REWARDS, make_reward
+
+class LaneIndex(object):
+    # start lanes of 2 intersections, the second one has none
+    intersection_id = ['intersection_1_1', 'intersection_1_2']
+    num_start_lane = np.array([2, 0])
+    num_end_lane = np.array([2, 0])
+
+class Env(object):
+    lane_index = LaneIndex()
+    current_phase_time = {'intersection_1_1': 1, 'intersection_1_2': 3}
+
+class Snapshot(object):
+    '''
+    lane views padded with zeros, like EngineSnapshot.lane_view
+    '''
+    views = {'speed': [[4.0, 2.0], [0, 0]],
+             'speed_sum': [[8.0, 2.0], [0, 0]],
+             'vehicle_count': [[2, 1], [0, 0]],
+             'waiting_vehicle_count': [[1, 0], [0, 0]]}
+
+    def lane_view(self, name, side):
+        return np.array(self.views[name], dtype=float)
+
+def test_lane_mean_speed_without_start_lanes():
+    reward = make_reward('lane_mean_speed')(Snapshot(), Env())
+    assert np.allclose(reward, [300.0, 0.0])
+
+def test_rewards_finite_without_start_lanes():
+    for name in REWARDS:
+        reward = make_reward(name)(Snapshot(), Env())
+        assert np.all(np.isfinite(reward)), name
+
+def test_composite():
+    reward = make_reward({"name": "composite", "weights": {"queue_length": 2.0, "lane_mean_speed": 0.5}})(Snapshot(), Env())
+    assert np.allclose(reward, [-2.0 + 150.0, 0.0])
+
+if __name__ == '__main__':
+    test_lane_mean_speed_without_start_lanes()
+    test_rewards_finite_without_start_lanes()
+    test_composite()
@@ -1,5 +1,9 @@
 import json
 import argparse
+import hashlib
+import os
+from collections.abc import Mapping
+import numpy as np
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
@@ -7,52 +11,252 @@ def parse_arguments():
     parser.add_argument("--num_step", type=int, default=3600)
     return parser.parse_args()
 
-def parse_roadnet(roadnetFile):
-    roadnet = json.load(open(roadnetFile))
-    lane_phase_info_dict ={}
-
-    # many intersections exist in the roadnet and virtual intersection is controlled by signal
-    for intersection in roadnet["intersections"]:
-        if intersection['virtual']:
-            continue
-        lane_phase_info_dict[intersection['id']] = {"start_lane": [],
-                                                     "end_lane": [],
-                                                     "phase": [],
-                                                     "phase_startLane_mapping": {},
-                                                     "phase_roadLink_mapping": {}}
-        road_links = intersection["roadLinks"]
-
-        start_lane = []
-        end_lane = []
-        roadLink_lane_pair = {ri: [] for ri in
-                              range(len(road_links))}  # roadLink includes some lane_pair: (start_lane, end_lane)
-
-        for ri in range(len(road_links)):
-            road_link = road_links[ri]
-            for lane_link in road_link["laneLinks"]:
-                sl = road_link['startRoad'] + "_" + str(lane_link["startLaneIndex"])
-                el = road_link['endRoad'] + "_" + str(lane_link["endLaneIndex"])
-                start_lane.append(sl)
-                end_lane.append(el)
-                roadLink_lane_pair[ri].append((sl, el))
-
-        lane_phase_info_dict[intersection['id']]["start_lane"] = sorted(list(set(start_lane)))
-        lane_phase_info_dict[intersection['id']]["end_lane"] = sorted(list(set(end_lane)))
-
-        for phase_i in range(1, len(intersection["trafficLight"]["lightphases"])):
-        # for phase_i in range(0, len(intersection["trafficLight"]["lightphases"])): # change for test_roadnet_1*1.json file, intersection id: intersection_1*1
-            p = intersection["trafficLight"]["lightphases"][phase_i]
-            lane_pair = []
+class RoadnetIndex(object):
+    '''
+    integer index of the signal controlled intersections of a roadnet:
+    lanes are numbered by their position in self.lanes (sorted by name), and every
+    per-intersection or per-phase list is stored CSR style as a flat int32 array plus
+    a pointer array, e.g. the start lanes of intersection i are
+    start_lane[start_lane_ptr[i]:start_lane_ptr[i+1]].
+    phases of all intersections are numbered globally in the order of the phase array
+    '''
+    ARRAYS = ['start_lane_ptr', 'start_lane', 'end_lane_ptr', 'end_lane',
+              'phase_ptr', 'phase',
+              'phase_start_lane_ptr', 'phase_start_lane',
+              'phase_lane_pair_ptr', 'phase_lane_pair']
+
+    def __init__(self, intersection_id, lanes, arrays):
+        self.intersection_id = intersection_id
+        self.lanes = lanes
+        self.row = {id_: i for i, id_ in enumerate(intersection_id)}
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+
+    def lane_phase_info(self):
+        '''
+        {intersection_id: {"start_lane", "end_lane", "phase", "phase_startLane_mapping", "phase_roadLink_mapping"}}
+        as a read-only LanePhaseInfo, entries are built from the arrays on first access
+        '''
+        return LanePhaseInfo(self)
+
+    def save(self, path):
+        '''
+        binary layout: magic, header length (uint64), json header, int32 arrays (8 byte aligned)
+        '''
+        header = {"intersection_id": self.intersection_id, "lanes": self.lanes, "arrays": {}}
+        offset = 0
+        for name in self.ARRAYS:
+            size = len(getattr(self, name))
+            header["arrays"][name] = [offset, size]
+            offset += size
+        header = json.dumps(header).encode()
+        header += b" " * (-(len(ROADNET_INDEX_MAGIC) + 8 + len(header)) % 8)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            f.write(ROADNET_INDEX_MAGIC)
+            f.write(np.uint64(len(header)).tobytes())
+            f.write(header)
+            for name in self.ARRAYS:
+                f.write(np.ascontiguousarray(getattr(self, name), dtype=np.int32).tobytes())
+        os.replace(tmp_path, path) # readers never see a partial file
+
+    @classmethod
+    def load(cls, path):
+        '''
+        the arrays are memory mapped views of the file
+        '''
+        with open(path, "rb") as f:
+            assert f.read(len(ROADNET_INDEX_MAGIC)) == ROADNET_INDEX_MAGIC, "not a roadnet index file: {}".format(path)
+            header_size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_size).decode())
+        data_offset = len(ROADNET_INDEX_MAGIC) + 8 + header_size
+        total = sum(size for _, size in header["arrays"].values())
+        data = np.memmap(path, dtype=np.int32, mode="r", offset=data_offset, shape=(total,)) if total else np.zeros(0, dtype=np.int32)
+        arrays = {name: data[offset:offset + size] for name, (offset, size) in header["arrays"].items()}
+        return cls(header["intersection_id"], header["lanes"], arrays)
+
+    @classmethod
+    def compile(cls, roadnet):
+        '''
+        roadnet: loaded roadnet json
+        '''
+        intersection_id = []
+        start_lanes, end_lanes = [], [] # per intersection, lane names
+        phases, phase_start_lanes, phase_lane_pairs = [], [], [] # per intersection / per phase
+
+        # many intersections exist in the roadnet and virtual intersection is controlled by signal
+        for intersection in roadnet["intersections"]:
+            if intersection['virtual']:
+                continue
+            intersection_id.append(intersection['id'])
+            road_links = intersection["roadLinks"]
+
             start_lane = []
-            for ri in p["availableRoadLinks"]:
-                lane_pair.extend(roadLink_lane_pair[ri])
-                if roadLink_lane_pair[ri][0][0] not in start_lane:
-                    start_lane.append(roadLink_lane_pair[ri][0][0])
-            lane_phase_info_dict[intersection['id']]["phase"].append(phase_i)
-            lane_phase_info_dict[intersection['id']]["phase_startLane_mapping"][phase_i] = start_lane
-            lane_phase_info_dict[intersection['id']]["phase_roadLink_mapping"][phase_i] = lane_pair
-
-    return lane_phase_info_dict
+            end_lane = []
+            roadLink_lane_pair = {ri: [] for ri in
+                                  range(len(road_links))}  # roadLink includes some lane_pair: (start_lane, end_lane)
+
+            for ri in range(len(road_links)):
+                road_link = road_links[ri]
+                for lane_link in road_link["laneLinks"]:
+                    sl = road_link['startRoad'] + "_" + str(lane_link["startLaneIndex"])
+                    el = road_link['endRoad'] + "_" + str(lane_link["endLaneIndex"])
+                    start_lane.append(sl)
+                    end_lane.append(el)
+                    roadLink_lane_pair[ri].append((sl, el))
+
+            start_lanes.append(sorted(set(start_lane)))
+            end_lanes.append(sorted(set(end_lane)))
+
+            phase = []
+            for phase_i in range(1, len(intersection["trafficLight"]["lightphases"])):
+            # for phase_i in range(0, len(intersection["trafficLight"]["lightphases"])): # change for test_roadnet_1*1.json file, intersection id: intersection_1*1
+                p = intersection["trafficLight"]["lightphases"][phase_i]
+                lane_pair = []
+                start_lane = []
+                for ri in p["availableRoadLinks"]:
+                    lane_pair.extend(roadLink_lane_pair[ri])
+                    if roadLink_lane_pair[ri][0][0] not in start_lane:
+                        start_lane.append(roadLink_lane_pair[ri][0][0])
+                phase.append(phase_i)
+                phase_start_lanes.append(start_lane)
+                phase_lane_pairs.append(lane_pair)
+            phases.append(phase)
+
+        lanes = sorted(set(lane for lane_list in start_lanes + end_lanes for lane in lane_list))
+        lane_column = {lane: k for k, lane in enumerate(lanes)}
+
+        def csr(lists, convert):
+            ptr = np.zeros(len(lists) + 1, dtype=np.int32)
+            ptr[1:] = np.cumsum([len(x) for x in lists])
+            values = np.array([convert(v) for x in lists for v in x], dtype=np.int32).reshape(-1)
+            return ptr, values
+
+        arrays = {}
+        arrays['start_lane_ptr'], arrays['start_lane'] = csr(start_lanes, lane_column.get)
+        arrays['end_lane_ptr'], arrays['end_lane'] = csr(end_lanes, lane_column.get)
+        arrays['phase_ptr'], arrays['phase'] = csr(phases, int)
+        arrays['phase_start_lane_ptr'], arrays['phase_start_lane'] = csr(phase_start_lanes, lane_column.get)
+        arrays['phase_lane_pair_ptr'], arrays['phase_lane_pair'] = csr(phase_lane_pairs,
+                                                                       lambda pair: (lane_column[pair[0]], lane_column[pair[1]]))
+        arrays['phase_lane_pair'] = arrays['phase_lane_pair'].reshape(-1) # (num_pairs * 2,)
+        return cls(intersection_id, lanes, arrays)
+
+ROADNET_INDEX_MAGIC = b"RNINDEX1"
+
+def csr_rows(ptr, values, rows):
+    '''
+    values of the CSR rows 'rows' concatenated, and the length of every row
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    starts = np.asarray(ptr[rows], dtype=np.int64)
+    lengths = np.asarray(ptr[rows + 1], dtype=np.int64) - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.asarray(values)[offsets], lengths
+
+class IntersectionInfo(Mapping):
+    '''
+    lane_phase_info entry of intersection row i of a RoadnetIndex, every key is built on first access
+    '''
+    KEYS = ("start_lane", "end_lane", "phase", "phase_startLane_mapping", "phase_roadLink_mapping")
+
+    def __init__(self, index, i):
+        self.index = index
+        self.i = i
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key not in self.KEYS:
+                raise KeyError(key)
+            self._values[key] = getattr(self, '_' + key)()
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+    def _lane_names(self, values):
+        lanes = self.index.lanes
+        return [lanes[k] for k in values.tolist()]
+
+    def _start_lane(self):
+        ptr = self.index.start_lane_ptr
+        return self._lane_names(self.index.start_lane[ptr[self.i]:ptr[self.i + 1]])
+
+    def _end_lane(self):
+        ptr = self.index.end_lane_ptr
+        return self._lane_names(self.index.end_lane[ptr[self.i]:ptr[self.i + 1]])
+
+    def _phase_range(self):
+        return range(int(self.index.phase_ptr[self.i]), int(self.index.phase_ptr[self.i + 1]))
+
+    def _phase(self):
+        return [int(self.index.phase[p]) for p in self._phase_range()]
+
+    def _phase_startLane_mapping(self):
+        index = self.index
+        ptr = index.phase_start_lane_ptr
+        return {int(index.phase[p]): self._lane_names(index.phase_start_lane[ptr[p]:ptr[p + 1]]) for p in self._phase_range()}
+
+    def _phase_roadLink_mapping(self):
+        index = self.index
+        ptr = index.phase_lane_pair_ptr
+        mapping = {}
+        for p in self._phase_range():
+            pairs = self._lane_names(index.phase_lane_pair[2 * ptr[p]:2 * ptr[p + 1]])
+            mapping[int(index.phase[p])] = list(zip(pairs[0::2], pairs[1::2]))
+        return mapping
+
+class LanePhaseInfo(Mapping):
+    '''
+    read-only {intersection_id: IntersectionInfo} over a RoadnetIndex, what parse_roadnet returns.
+    LaneIndex and the envs use roadnet_index directly, the per-intersection dicts are only built
+    for the keys a caller reads
+    '''
+    def __init__(self, roadnet_index):
+        self.roadnet_index = roadnet_index
+        self._items = {}
+
+    def __getitem__(self, id_):
+        if id_ not in self._items:
+            self._items[id_] = IntersectionInfo(self.roadnet_index, self.roadnet_index.row[id_])
+        return self._items[id_]
+
+    def __iter__(self):
+        return iter(self.roadnet_index.intersection_id)
+
+    def __len__(self):
+        return len(self.roadnet_index.intersection_id)
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_roadnet_index(roadnetFile, cache=True):
+    '''
+    compiled index of roadnetFile. with cache, it is stored in a sidecar file
+    "<roadnetFile>.<sha1 of the roadnet>.index" on first use and memory mapped afterwards
+    '''
+    if not cache:
+        return RoadnetIndex.compile(json.load(open(roadnetFile)))
+    index_file = "{}.{}.index".format(roadnetFile, file_hash(roadnetFile)[:16])
+    if os.path.exists(index_file):
+        return RoadnetIndex.load(index_file)
+    index = RoadnetIndex.compile(json.load(open(roadnetFile)))
+    try:
+        index.save(index_file)
+    except OSError as e: # e.g. read-only roadnet dir, keep the compiled index in memory only
+        print("roadnet index not cached: {}".format(e))
+    return index
+
+def parse_roadnet(roadnetFile, cache=True):
+    return load_roadnet_index(roadnetFile, cache=cache).lane_phase_info()
 
 def plot_data_lists(data_list, 
                     label_list, 
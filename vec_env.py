@@ -0,0 +1,159 @@
+"""
+Several cityflow environments stepped in lockstep in worker processes
+"""
+
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+def _worker(remote, env_class, env_kwargs):
+    '''
+    build one environment and serve step/reset/score commands from the parent,
+    states and rewards are written into the shared memory buffers
+    '''
+    env = env_class(**env_kwargs)
+    single = not isinstance(env.intersection_id, list)
+    intersection_id = [env.intersection_id] if single else env.intersection_id
+    remote.send((env.state_size, intersection_id, single))
+
+    index, state_name, reward_name, shape = remote.recv()
+    state_shm = shared_memory.SharedMemory(name=state_name)
+    reward_shm = shared_memory.SharedMemory(name=reward_name)
+    states = np.ndarray(shape, dtype=np.float32, buffer=state_shm.buf)[index] # (num_intersections, state_size)
+    rewards = np.ndarray(shape[:2], dtype=np.float32, buffer=reward_shm.buf)[index] # (num_intersections,)
+
+    def write_state(state):
+        if single:
+            states[0] = state[0]
+        else:
+            for k, id_ in enumerate(intersection_id):
+                states[k] = state[id_][0]
+
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                action = data[0] if single else dict(zip(intersection_id, data.tolist()))
+                state, reward = env.step(action)
+                write_state(state)
+                rewards[:] = [reward] if single else [reward[id_] for id_ in intersection_id]
+                remote.send(None)
+            elif cmd == 'step_n':
+                action, n, reward_reduce = data
+                action = action[0] if single else dict(zip(intersection_id, action.tolist()))
+                state, reward, score = env.step_n(action, n, reward_reduce=reward_reduce, with_score=True)
+                write_state(state)
+                rewards[:] = [reward] if single else [reward[id_] for id_ in intersection_id]
+                remote.send([score] if single else [score[id_] for id_ in intersection_id])
+            elif cmd == 'reset':
+                env.reset()
+                write_state(env.get_state())
+                remote.send(None)
+            elif cmd == 'score':
+                score = env.get_score()
+                remote.send([score] if single else [score[id_] for id_ in intersection_id])
+            elif cmd == 'close':
+                break
+    finally:
+        del states, rewards
+        state_shm.close()
+        reward_shm.close()
+        remote.close()
+
+class VecCityFlowEnv(object):
+    '''
+    num_envs copies of CityFlowEnv or CityFlowEnvM, one engine per worker process.
+
+    env_kwargs: dict of constructor arguments shared by all copies, or a list with one dict per copy
+    (e.g. cityflow config files with different seeds).
+    actions are phases: (num_envs,) for CityFlowEnv, (num_envs, num_intersections) for CityFlowEnvM,
+    columns in the order of self.intersection_id.
+    states/rewards are returned as (num_envs, state_size)/(num_envs,) for CityFlowEnv and
+    (num_envs, num_intersections, state_size)/(num_envs, num_intersections) for CityFlowEnvM
+    '''
+    def __init__(self, env_class, env_kwargs, num_envs=None, start_method=None):
+        if isinstance(env_kwargs, dict):
+            env_kwargs = [env_kwargs] * num_envs
+        self.num_envs = len(env_kwargs)
+        ctx = mp.get_context(start_method)
+        # workers must share the parent's tracker, otherwise each of them would unlink the buffers on exit
+        resource_tracker.ensure_running()
+
+        self.remotes, self.processes = [], []
+        for kwargs in env_kwargs:
+            remote, worker_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(worker_remote, env_class, kwargs), daemon=True)
+            process.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+        infos = [remote.recv() for remote in self.remotes]
+        self.state_size, self.intersection_id, self.single = infos[0]
+        assert all(info == infos[0] for info in infos), "all environments must share one roadnet"
+        self.num_intersections = len(self.intersection_id)
+
+        shape = (self.num_envs, self.num_intersections, self.state_size)
+        self._state_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * 4)
+        self._reward_shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape[:2])) * 4)
+        self._states = np.ndarray(shape, dtype=np.float32, buffer=self._state_shm.buf)
+        self._rewards = np.ndarray(shape[:2], dtype=np.float32, buffer=self._reward_shm.buf)
+        for i, remote in enumerate(self.remotes):
+            remote.send((i, self._state_shm.name, self._reward_shm.name, shape))
+        self.closed = False
+
+    def _wait(self):
+        for remote in self.remotes:
+            remote.recv()
+
+    def _batch(self, array):
+        # copy, the buffers are overwritten by the next step
+        return array[:, 0].copy() if self.single else array.copy()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        self._wait()
+        return self._batch(self._states)
+
+    def get_state(self):
+        return self._batch(self._states)
+
+    def step(self, actions):
+        actions = np.reshape(np.asarray(actions), [self.num_envs, self.num_intersections])
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', action))
+        self._wait()
+        return self._batch(self._states), self._batch(self._rewards)
+
+    def step_n(self, actions, n, reward_reduce='mean', with_score=False):
+        '''
+        step_n of every environment, see CityFlowEnv.step_n
+        '''
+        actions = np.reshape(np.asarray(actions), [self.num_envs, self.num_intersections])
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step_n', (action, n, reward_reduce)))
+        score = np.array([remote.recv() for remote in self.remotes])
+        if with_score:
+            return self._batch(self._states), self._batch(self._rewards), score[:, 0] if self.single else score
+        return self._batch(self._states), self._batch(self._rewards)
+
+    def get_score(self):
+        for remote in self.remotes:
+            remote.send(('score', None))
+        score = np.array([remote.recv() for remote in self.remotes])
+        return score[:, 0] if self.single else score
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        del self._states, self._rewards
+        self._state_shm.close()
+        self._state_shm.unlink()
+        self._reward_shm.close()
+        self._reward_shm.unlink()
+        self.closed = True